@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Compares the render engines with a generated stack of many templates.
+
+Each template defines one variable that depends on the variable defined
+by the previous template, plus one that depends on a variable defined by
+the next template, accessed with `var[name]` so the static analysis cannot
+see it. The pool engine renders templates again when they access variables
+that are not defined yet, while the async engine waits for them.
+
+Templates are compiled before timing each engine, and the render cache
+is limited to zero bytes, so only rendering and scheduling are measured.
+
+Usage: python benchmarks/engines.py [count ...]
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+template = '''\
+{{% set name = "dynamic_{next}" %}}
+variable "static_{index}" {{
+  default = "{{{{ var.static_{previous} }}}}"
+}}
+
+variable "dynamic_{index}" {{
+  default = "{{{{ {dynamic} }}}}"
+}}
+'''
+
+
+def generate(project_dir, count):
+    """
+    Creates a project with a single stack containing the templates,
+    in reverse order so that dependencies are listed last.
+
+    """
+
+    stack_dir = os.path.join(project_dir, 'stack')
+    os.makedirs(stack_dir)
+    with open(os.path.join(project_dir, '.jinjaformrc'), 'w') as open_file:
+        open_file.write('WORKSPACE_CREATE\nTERRAFORM_RUN\n')
+    with open(os.path.join(stack_dir, 'static.tf'), 'w') as open_file:
+        open_file.write('variable "static_0" {\n  default = "static"\n}\n')
+    sources = [os.path.join(stack_dir, 'static.tf')]
+    for index in range(1, count + 1):
+        source = os.path.join(stack_dir, 't{:05d}.tf'.format(count - index))
+        with open(source, 'w') as open_file:
+            open_file.write(template.format(
+                index=index,
+                previous=index - 1,
+                next=index + 1,
+                dynamic='var[name]' if index < count else '"dynamic"',
+            ))
+        sources.append(source)
+    return stack_dir, sources
+
+
+def render(stack_dir, sources, engine, count):
+    """
+    Renders the generated templates with an engine. Returns the duration.
+
+    """
+
+    from jinjaform import config, render
+
+    config.load(stack_dir, [])
+    os.environ['JINJAFORM_RENDER_ENGINE'] = engine
+    renderer = render.create_renderer()
+    for source in sources:
+        renderer.add_template(source)
+    start_time = time.time()
+    success, rendered = renderer.start()
+    duration = time.time() - start_time
+    if not success:
+        raise SystemExit('{} engine failed to render {} templates'.format(engine, count))
+    return duration
+
+
+def run(count):
+    """
+    Renders the generated templates with each engine in a new project.
+    Returns the durations.
+
+    """
+
+    os.environ['JINJAFORM_RENDER_CACHE_SIZE'] = '0'
+    project_dir = tempfile.mkdtemp(prefix='jinjaform-benchmark-')
+    try:
+        stack_dir, sources = generate(project_dir, count)
+        durations = []
+        for engine in ('pool', 'async'):
+            # Compile the templates first.
+            render(stack_dir, sources, engine, count)
+            durations.append(render(stack_dir, sources, engine, count))
+    finally:
+        shutil.rmtree(project_dir)
+    return durations
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 3000]
+    print('{:>10} {:>10} {:>10}'.format('templates', 'pool', 'async'))
+    for count in counts:
+        print('{:>10} {:>9.2f}s {:>9.2f}s'.format(count, *run(count)))
+
+
+if __name__ == '__main__':
+    main()
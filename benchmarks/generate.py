@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Generates synthetic Jinjaform projects for benchmarking.
+
+A project contains a hierarchy of directories, each with its own .tf files,
+ending in a single stack directory. Every file defines some variables, some
+of which form a chain of `var.*` references across files, so templates must
+be rendered in dependency order. Files can also contain loops and use
+custom filters from the project's .jinja directory.
+
+Usage: python benchmarks/generate.py path [option=value ...]
+
+"""
+
+import os
+import sys
+
+
+defaults = {
+    # The number of directory levels above the stack.
+    'depth': 3,
+    # The number of .tf files in each directory.
+    'files': 4,
+    # The number of independent variables in each file.
+    'variables': 10,
+    # The number of files in the chain of variable references.
+    'chain': 5,
+    # The number of iterations of the loop in each file.
+    'loops': 0,
+    # The number of custom filters, each used once per file.
+    'filters': 0,
+}
+
+jinjaformrc = '''\
+WORKSPACE_CREATE
+TERRAFORM_RUN
+'''
+
+filter_template = '''
+def bench_{index}(value):
+    """
+    Returns the value with a suffix.
+
+    """
+
+    return '{{}}-{index}'.format(value)
+'''
+
+
+def _write(path, contents):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as open_file:
+        open_file.write(contents)
+
+
+def _render_file(name, options, chain_index):
+    """
+    Returns the contents of a generated .tf file.
+
+    """
+
+    lines = []
+    for index in range(options['variables']):
+        lines.append('variable "{}_{}" {{'.format(name, index))
+        lines.append('  default = "{}-{}"'.format(name, index))
+        lines.append('}')
+        lines.append('')
+
+    if chain_index is not None:
+        if chain_index == 0:
+            default = 'chain'
+        else:
+            default = '{{{{ var.chain_{} }}}}'.format(chain_index - 1)
+        lines.append('variable "chain_{}" {{'.format(chain_index))
+        lines.append('  default = "{}"'.format(default))
+        lines.append('}')
+        lines.append('')
+
+    if options['loops']:
+        lines.append('{{% for index in range({}) %}}'.format(options['loops']))
+        lines.append('resource "null_resource" "{}_{{{{ index }}}}" {{'.format(name))
+        lines.append('  triggers = {')
+        lines.append('  {% for key, value in {"a": index, "b": index * 2} | dictsort %}')
+        lines.append('    {{ key }} = "{{ value }}"')
+        lines.append('  {% endfor %}')
+        lines.append('  }')
+        lines.append('}')
+        lines.append('{% endfor %}')
+        lines.append('')
+
+    for index in range(options['filters']):
+        lines.append('locals {{ {}_filter_{} = "{{{{ "{}" | bench_{} }}}}" }}'.format(name, index, name, index))
+
+    return '\n'.join(lines) + '\n'
+
+
+def generate(path, **options):
+    """
+    Creates a project in a directory. Returns the stack directory.
+
+    """
+
+    options = dict(defaults, **options)
+    unknown = set(options) - set(defaults)
+    if unknown:
+        raise ValueError('unknown options: {}'.format(', '.join(sorted(unknown))))
+
+    _write(os.path.join(path, '.jinjaformrc'), jinjaformrc)
+
+    if options['filters']:
+        filters = [filter_template.format(index=index) for index in range(options['filters'])]
+        names = ', '.join("'bench_{}'".format(index) for index in range(options['filters']))
+        filters.append('\n__all__ = [{}]\n'.format(names))
+        _write(os.path.join(path, '.jinja', 'filters', 'bench.py'), '\n'.join(filters).lstrip())
+
+    # Spread the chain over the files, starting at the top of the hierarchy,
+    # with files listed in reverse order so that dependencies come last.
+    directories = [path]
+    for level in range(1, options['depth'] + 1):
+        directories.append(os.path.join(directories[-1], 'level{}'.format(level)))
+    chain_files = []
+    for level, directory in enumerate(directories):
+        for index in reversed(range(options['files'])):
+            chain_files.append((level, index))
+    chain_files = chain_files[:options['chain']]
+
+    for level, directory in enumerate(directories):
+        for index in range(options['files']):
+            name = 'l{}_f{}'.format(level, index)
+            if (level, index) in chain_files:
+                chain_index = chain_files.index((level, index))
+            else:
+                chain_index = None
+            _write(os.path.join(directory, name + '.tf'), _render_file(name, options, chain_index))
+
+    _write(os.path.join(path, 'terraform.tfvars'), 'l0_f0_0 = "from tfvars"\n')
+
+    return directories[-1]
+
+
+def parse_options(args):
+    """
+    Parses option=value arguments into generator options.
+
+    """
+
+    options = {}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        options[name] = int(value)
+    return options
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise SystemExit(__doc__.strip())
+    stack_dir = generate(sys.argv[1], **parse_options(sys.argv[2:]))
+    print(stack_dir)
+
+
+if __name__ == '__main__':
+    main()
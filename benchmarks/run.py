@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Runs benchmarks against generated projects and saves the results as JSON.
+
+Each scenario generates a project with benchmarks/generate.py and measures:
+
+* populate (cold): creating the workspace with empty caches
+* populate (warm): creating the workspace again, using the caches
+* varstore: defining and reading the project's variables
+* parse: scanning the rendered files for blocks and parsing the tfvars
+
+Every measurement runs in a new process, so that the wall time, CPU time
+and peak memory usage of each one are recorded separately. A fake terraform
+binary is used, so Terraform does not need to be installed.
+
+Usage: python benchmarks/run.py [-o results.json] [-r repeats]
+                                [--compare baseline.json] [--threshold 0.2]
+                                [scenario ...]
+
+When comparing with a previous results file, the exit code is 1 if any
+measurement is slower than the baseline by more than the threshold.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from generate import generate
+
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+scenarios = {
+    'small': dict(depth=1, files=4, variables=5, chain=4),
+    'deep': dict(depth=8, files=4, variables=10, chain=20),
+    'wide': dict(depth=1, files=200, variables=10, chain=20),
+    'chain': dict(depth=2, files=50, variables=2, chain=150),
+    'loops': dict(depth=1, files=20, variables=2, chain=10, loops=200),
+    'filters': dict(depth=1, files=20, variables=2, chain=10, filters=20),
+}
+
+measurements = ('populate (cold)', 'populate (warm)', 'varstore', 'parse')
+
+
+def _clean(project_dir):
+    """
+    Removes the workspaces and caches from a generated project.
+
+    """
+
+    for dir_path, dir_names, file_names in os.walk(project_dir):
+        if '.jinjaform' in dir_names:
+            shutil.rmtree(os.path.join(dir_path, '.jinjaform'))
+            dir_names.remove('.jinjaform')
+
+
+def _measure(stack_dir, measurement):
+    """
+    Runs a measurement in this process, which is a new process for each one.
+    Returns the wall time and CPU time in seconds.
+
+    """
+
+    sys.path.insert(0, repo_root)
+    os.chdir(stack_dir)
+
+    from jinjaform import config, workspace
+    config.load(stack_dir, ['validate'])
+
+    if measurement.startswith('populate'):
+        os.makedirs(config.terraform_dir, exist_ok=True)
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        workspace._populate()
+        return time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    import hcl
+    from jinjaform import render, scanner
+
+    tf_paths = []
+    tfvars_paths = []
+    for name in sorted(os.listdir(config.workspace_dir)):
+        path = os.path.join(config.workspace_dir, name)
+        if name.endswith('.tf'):
+            tf_paths.append(path)
+        elif name.endswith('.tfvars'):
+            tfvars_paths.append(path)
+    tf_contents = []
+    for path in tf_paths:
+        with open(path) as open_file:
+            tf_contents.append(open_file.read())
+    tfvars_contents = []
+    for path in tfvars_paths:
+        with open(path) as open_file:
+            tfvars_contents.append(open_file.read())
+
+    if measurement == 'varstore':
+        names = []
+        for contents in tf_contents:
+            for block in scanner.scan(contents, types={'variable'}):
+                if block.type == 'variable':
+                    names.append((block.labels[0], render._get_default(block)))
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        var_store = render.VarStore()
+        var_view = render.VarView(var_store)
+        for name, default in names:
+            var_store._define_variable(name, default)
+        for repeat in range(100):
+            for name, default in names:
+                var_view[name]
+        var_store._snapshot()
+        return time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    if measurement == 'parse':
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        for contents in tf_contents:
+            for block in scanner.scan(contents, types=render.wanted_block_types):
+                if block.type == 'variable':
+                    render._get_default(block)
+        for contents in tfvars_contents:
+            hcl.loads(contents)
+        return time.perf_counter() - start_wall, time.process_time() - start_cpu
+
+    raise ValueError('unknown measurement {}'.format(measurement))
+
+
+def measure(stack_dir, measurement, env):
+    """
+    Runs a measurement in a new process. Returns the wall time,
+    CPU time and peak memory usage in megabytes.
+
+    """
+
+    process = subprocess.run(
+        [sys.executable, __file__, '--child', stack_dir, measurement],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode:
+        raise SystemExit('{} failed in {}:\n{}{}'.format(measurement, stack_dir, process.stdout, process.stderr))
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def run_scenario(name, options, repeats, env):
+    """
+    Generates a project for a scenario and runs each measurement.
+    Returns a list of results.
+
+    """
+
+    results = []
+    project_dir = tempfile.mkdtemp(prefix='jinjaform-benchmark-')
+    try:
+        stack_dir = generate(project_dir, **options)
+        samples = {measurement: [] for measurement in measurements}
+        for repeat in range(repeats):
+            _clean(project_dir)
+            for measurement in measurements:
+                samples[measurement].append(measure(stack_dir, measurement, env))
+        for measurement in measurements:
+            results.append({
+                'scenario': name,
+                'options': options,
+                'measurement': measurement,
+                'wall': statistics.median(sample['wall'] for sample in samples[measurement]),
+                'cpu': statistics.median(sample['cpu'] for sample in samples[measurement]),
+                'max_rss_mb': max(sample['max_rss_mb'] for sample in samples[measurement]),
+                'samples': samples[measurement],
+            })
+    finally:
+        shutil.rmtree(project_dir)
+    return results
+
+
+def compare(results, baseline_path, threshold):
+    """
+    Compares results with a baseline results file.
+    Returns the number of regressions.
+
+    """
+
+    with open(baseline_path) as open_file:
+        baseline = json.load(open_file)
+    previous = {(result['scenario'], result['measurement']): result for result in baseline['results']}
+
+    regressions = 0
+    for result in results:
+        before = previous.get((result['scenario'], result['measurement']))
+        if not before or not before['wall']:
+            continue
+        change = result['wall'] / before['wall'] - 1
+        if change > threshold:
+            regressions += 1
+            print('regression: {} {} {:.4f}s -> {:.4f}s ({:+.0%})'.format(
+                result['scenario'], result['measurement'], before['wall'], result['wall'], change,
+            ))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=repo_root,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    if sys.argv[1:2] == ['--child']:
+        stack_dir, measurement = sys.argv[2:4]
+        with open(os.devnull, 'w') as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            wall, cpu = _measure(stack_dir, measurement)
+            sys.stdout = stdout
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print(json.dumps({'wall': wall, 'cpu': cpu, 'max_rss_mb': round(rss / 1024, 1)}))
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmarks Jinjaform with generated projects.')
+    parser.add_argument('scenarios', nargs='*', choices=[[]] + sorted(scenarios), metavar='scenario')
+    parser.add_argument('-o', '--output', help='file to save the results in')
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    parser.add_argument('--compare', metavar='BASELINE', help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    # Use a fake terraform binary, which Jinjaform requires to be installed.
+    bin_dir = tempfile.mkdtemp(prefix='jinjaform-benchmark-bin-')
+    terraform_path = os.path.join(bin_dir, 'terraform')
+    with open(terraform_path, 'w') as open_file:
+        open_file.write('#!/bin/sh\nexit 0\n')
+    os.chmod(terraform_path, 0o755)
+    env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    env.pop('JINJAFORM_TRACE', None)
+
+    try:
+        results = []
+        print('{:<10} {:<16} {:>10} {:>10} {:>10}'.format('scenario', 'measurement', 'wall', 'cpu', 'rss'))
+        for name in args.scenarios or sorted(scenarios):
+            for result in run_scenario(name, scenarios[name], args.repeats, env):
+                print('{:<10} {:<16} {:>9.4f}s {:>9.4f}s {:>7.1f} MB'.format(
+                    result['scenario'], result['measurement'], result['wall'], result['cpu'], result['max_rss_mb'],
+                ))
+                results.append(result)
+    finally:
+        shutil.rmtree(bin_dir)
+
+    sys.path.insert(0, repo_root)
+    import jinja2
+    import jinjaform
+
+    output = {
+        'version': 1,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'commit': _git_commit(),
+        'jinjaform': jinjaform.__version__,
+        'jinja2': jinja2.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'environment': {key: value for key, value in os.environ.items() if key.startswith('JINJAFORM_')},
+        'repeats': args.repeats,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as open_file:
+            json.dump(output, open_file, indent=2)
+            open_file.write('\n')
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,11 @@
+import contextlib
 import os
 import subprocess
 import sys
 
-from jinjaform import aws, git, log, rc, terraform, workspace, __version__
-from jinjaform.config import args, cmd, cwd, env, project_root, terraform_bin, workspace_dir
+from functools import partial
+
+from jinjaform import aws, batch, config, git, log, modules, parallel, rc, terraform, trace, workspace, __version__
 
 
 commands_bypassed = (
@@ -17,85 +19,163 @@ commands_forbidden = (
 )
 
 
-def main():
+def run_step(rc_cmd, rc_arg, parallel_step=False):
+    """
+    Runs a command from the .jinjaformrc file. Steps running in
+    a PARALLEL group run their commands with prefixed output, and
+    stop between stages if another step in the group fails.
 
-    if cmd == 'create':
-        sys.exit(rc.create())
+    """
 
-    if cmd in ('version', '-v', '-version', '--version'):
-        log.ok('version: {}'.format(__version__))
+    if parallel_step:
+        parallel.check_cancelled()
 
-    workspace_required = False
+    if rc_cmd == 'GIT_CHECK_BRANCH':
 
-    if cmd:
+        with trace.span('git', check='branch'):
+            git.check_branch(desired=rc_arg)
 
-        if cmd in commands_forbidden:
-            log.bad('{} is disabled in jinjaform', cmd)
-            sys.exit(1)
+    elif rc_cmd == 'GIT_CHECK_CLEAN':
 
-        if cmd not in commands_bypassed:
+        with trace.span('git', check='clean'):
+            git.check_clean()
 
-            if not project_root:
-                log.bad('could not find .jinjaformrc file in current or parent directories')
-                log.bad('to start a new jinjaform project in the current directory, run "jinjaform create"')
-                sys.exit(1)
+    elif rc_cmd == 'GIT_CHECK_REMOTE':
 
-            workspace_required = True
+        with trace.span('git', check='remote'):
+            git.check_remote()
 
-    if workspace_required:
+    elif rc_cmd == 'RUN':
 
-        if cwd == project_root:
-            log.bad('cannot run from the jinjaform project root directory, aborting')
-            sys.exit(1)
+        log.ok('run: {}'.format(rc_arg))
+        with trace.span('run', command=rc_arg):
+            if parallel_step:
+                returncode = parallel.call(rc_arg, env=config.env)
+            else:
+                returncode = subprocess.call(rc_arg, env=config.env, shell=True)
+        if returncode != 0:
+            sys.exit(returncode)
 
-        for rc_cmd, rc_arg in rc.read():
+    elif rc_cmd == 'TERRAFORM_RUN':
 
-            if rc_cmd == 'GIT_CHECK_BRANCH':
+        log.ok('run: terraform')
+        os.chdir(config.workspace_dir)
+        modules.before_terraform(config.args)
+        if config.cmd == 'init':
+            # Wait for "jinjaform plugins prefetch" to finish
+            # copying plugins into the shared plugin cache.
+            from jinjaform import plugins
+            cache_lock = plugins.lock_cache(shared=True)
+        else:
+            cache_lock = contextlib.nullcontext()
+        with cache_lock, trace.span('terraform', args=config.args):
+            returncode = terraform.execute(config.terraform_bin, config.args, config.env)
+        if returncode != 0:
+            sys.exit(returncode)
+        with trace.span('modules'):
+            modules.store(config.args)
 
-                git.check_branch(desired=rc_arg)
+    elif rc_cmd == 'WORKSPACE_CREATE':
 
-            elif rc_cmd == 'GIT_CHECK_CLEAN':
+        with trace.span('workspace'):
+            workspace.create()
 
-                git.check_clean()
+        if parallel_step:
+            parallel.check_cancelled()
 
-            elif rc_cmd == 'GIT_CHECK_REMOTE':
+        with trace.span('aws credentials'):
+            aws.credentials_setup()
 
-                git.check_remote()
+        if parallel_step:
+            parallel.check_cancelled()
 
-            elif rc_cmd == 'RUN':
+        if config.cmd == 'init':
+            with trace.span('aws backend'):
+                aws.backend_setup()
 
-                log.ok('run: {}'.format(rc_arg))
-                returncode = subprocess.call(rc_arg, env=env, shell=True)
-                if returncode != 0:
-                    sys.exit(returncode)
+    else:
 
-            elif rc_cmd == 'TERRAFORM_RUN':
+        log.bad('configuration: {} is not a valid command', rc_cmd)
+        sys.exit(1)
 
-                log.ok('run: terraform')
-                os.chdir(workspace_dir)
-                returncode = terraform.execute(terraform_bin, args, env)
-                if returncode != 0:
-                    sys.exit(returncode)
 
-            elif rc_cmd == 'WORKSPACE_CREATE':
+def main():
 
-                workspace.clean()
-                workspace.create()
+    options, args = batch.parse_args(config.args)
+    if options:
+        sys.exit(batch.main(options, args, target=main))
 
-                aws.credentials_setup()
+    if config.cmd == 'daemon':
+        from jinjaform import daemon
+        sys.exit(daemon.main(config.args[1:]))
 
-                if cmd == 'init':
-                    aws.backend_setup()
+    if config.cmd in commands_bypassed and not trace.path:
+        # Replace this process with Terraform, so that commands which
+        # do not need Jinjaform, such as "terraform fmt" run by editors,
+        # have as little overhead as possible.
+        if config.cmd in ('version', '-v', '-version', '--version'):
+            log.ok('version: {}'.format(__version__))
+        sys.stdout.flush()
+        os.execve(config.terraform_bin, [config.terraform_bin] + config.args, config.env)
 
-            else:
+    if config.cmd == 'create':
+        sys.exit(rc.create())
 
-                log.bad('configuration: {} is not a valid command', rc_cmd)
+    if config.cmd == 'affected':
+        from jinjaform import index
+        sys.exit(index.main(config.args[1:]))
+
+    if config.cmd == 'plugins':
+        from jinjaform import plugins
+        sys.exit(plugins.main(config.args[1:]))
+
+    if config.cmd in ('version', '-v', '-version', '--version'):
+        log.ok('version: {}'.format(__version__))
+
+    workspace_required = False
+
+    if config.cmd:
+
+        if config.cmd in commands_forbidden:
+            log.bad('{} is disabled in jinjaform', config.cmd)
+            sys.exit(1)
+
+        if config.cmd not in commands_bypassed:
+
+            if not config.project_root:
+                log.bad('could not find .jinjaformrc file in current or parent directories')
+                log.bad('to start a new jinjaform project in the current directory, run "jinjaform create"')
                 sys.exit(1)
 
+            workspace_required = True
+
+    if workspace_required:
+
+        if config.cwd == config.project_root:
+            log.bad('cannot run from the jinjaform project root directory, aborting')
+            sys.exit(1)
+
+        rc_commands = list(rc.read())
+
+        # Start reading the state of the git checkout, which is shared
+        # by the git checks. They run in the order of the .jinjaformrc
+        # file, so checks before WORKSPACE_CREATE run before rendering.
+        git.start(remote=('GIT_CHECK_REMOTE', None) in rc_commands)
+
+        for step in rc.group(rc_commands):
+            if isinstance(step, list):
+                parallel.run([
+                    (rc_arg if rc_cmd == 'RUN' else rc_cmd.lower(), partial(run_step, rc_cmd, rc_arg, parallel_step=True))
+                    for rc_cmd, rc_arg in step
+                ])
+            else:
+                run_step(*step)
+
     else:
 
         log.ok('run: terraform')
-        returncode = terraform.execute(terraform_bin, args, env)
+        with trace.span('terraform', args=config.args):
+            returncode = terraform.execute(config.terraform_bin, config.args, config.env)
         if returncode != 0:
             sys.exit(returncode)
 
@@ -1,12 +1,15 @@
-import boto_source_profile_mfa
-import boto3
+import importlib
+import json
+import os
 import sys
 import threading
+import time
 
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
 
-from jinjaform import log
-from jinjaform.config import env
+from jinjaform import cache, config, credentials, log
+from jinjaform.cache import digest
 
 
 aws_provider = {}
@@ -14,106 +17,268 @@ s3_backend = {}
 
 lock = threading.Lock()
 
+# Backends that were verified recently are not checked again until
+# this many minutes have passed. Results are shared between processes.
+backend_check_ttl = int(os.environ.get('JINJAFORM_BACKEND_CHECK_TTL', 60)) * 60
 
-@lru_cache()
-def _get_session(**kwargs):
+# Backends verified by this process, and locks for checking them.
+verified = {}
+verifying = {}
+
+# Sessions and clients created by this process, and locks for creating
+# them. Sessions for different profiles and roles are created at the same
+# time, while requests for the same one wait for it to be created once.
+sessions = {}
+session_locks = {}
+clients = {}
+client_locks = {}
+
+# The botocore data loader shared by every session, if preloaded.
+data_loader = None
+
+
+def _create_session(**kwargs):
+    # Import the AWS libraries only when they are used,
+    # because they take a long time to import.
     if 'profile_name' in kwargs:
-        return boto_source_profile_mfa.get_session(**kwargs)
+        import boto_source_profile_mfa
+        session = boto_source_profile_mfa.get_session(**kwargs)
     else:
-        return boto3.Session(**kwargs)
+        import boto3
+        kwargs.pop('mfa_prompter', None)
+        session = boto3.Session(**kwargs)
+    # Use the service data loaded by preload().
+    if data_loader:
+        session._session.register_component('data_loader', data_loader)
+    # Share temporary credentials for assumed roles with other processes,
+    # unless credentials were provided.
+    if 'aws_access_key_id' not in kwargs:
+        credentials.use_cache(session)
+    return session
+
+
+def _get_max_pool_connections():
+    """
+    Returns the number of connections to keep for each client, which is
+    enough for every thread rendering templates to use it at the same time.
+
+    """
+
+    threads = int(os.environ.get('JINJAFORM_RENDER_THREADS', 0))
+    if not threads:
+        # The default for ThreadPoolExecutor.
+        threads = min(32, (os.cpu_count() or 1) + 4)
+    return max(10, threads)
+
+
+def get_provider_session_kwargs(provider):
+    """
+    Returns the boto3 session arguments for a Terraform AWS provider block.
+
+    """
+
+    session_kwargs = {'mfa_prompter': log.secret}
+    terraform_boto_session_map = {
+        'access_key': 'aws_access_key_id',
+        'secret_key': 'aws_secret_access_key',
+        'token': 'aws_session_token',
+        'profile': 'profile_name',
+        'region': 'region_name',
+    }
+    for terraform_key, boto_key in terraform_boto_session_map.items():
+        value = provider.get(terraform_key)
+        if value:
+            session_kwargs[boto_key] = value
+    return session_kwargs
 
 
 def get_default_session():
-    session_kwargs = {}
-    if aws_provider:
-        terraform_boto_session_map = {
-            'access_key': 'aws_access_key_id',
-            'secret_key': 'aws_secret_access_key',
-            'token': 'aws_session_token',
-            'profile': 'profile_name',
-            'region': 'region_name',
-        }
-        for terraform_key, boto_key in terraform_boto_session_map.items():
-            value = aws_provider.get(terraform_key)
-            if value:
-                session_kwargs[boto_key] = value
-    return get_session(**session_kwargs)
+    return get_session(**get_provider_session_kwargs(aws_provider))
 
 
 def get_session(**kwargs):
+    """
+    Returns a boto3 session, creating it the first time that it is used
+    with these arguments. The MFA prompter is only used for profiles.
+
+    """
+
+    key = tuple(sorted(kwargs.items(), key=lambda item: item[0]))
     with lock:
-        return _get_session(**kwargs)
+        session = sessions.get(key)
+        if session:
+            return session
+        key_lock = session_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        session = sessions.get(key)
+        if not session:
+            session = sessions[key] = _create_session(**kwargs)
+    return session
+
+
+def get_client(session, service_name, region_name=None):
+    """
+    Returns a client for a session, service and region, which is shared
+    by every thread. Clients are thread safe, but sessions are not,
+    so clients for each session are created one at a time.
 
+    """
 
-def backend_setup():
+    key = (session, service_name, region_name)
+    with lock:
+        client = clients.get(key)
+        if client:
+            return client
+        session_lock = client_locks.setdefault(session, threading.Lock())
+    with session_lock:
+        client = clients.get(key)
+        if not client:
+            import botocore.config
+            client_config = botocore.config.Config(max_pool_connections=_get_max_pool_connections())
+            client = clients[key] = session.client(service_name, region_name=region_name, config=client_config)
+    return client
+
+
+def get_session_client(service_name, **kwargs):
+    """
+    Returns a shared client for a service, using a session
+    created from the other arguments.
 
-    region = s3_backend.get('region')
-    if not region:
-        return
+    Usage: {{ aws.client('s3', profile_name='example').list_buckets() }}
 
-    bucket = s3_backend.get('bucket')
-    if bucket:
+    """
 
-        log.ok('backend: s3://{} in {}', bucket, region)
+    return get_client(get_session(**kwargs), service_name)
 
-        s3_client = get_default_session().client('s3')
+
+def preload():
+    """
+    Imports the AWS libraries and loads the data for the AWS services
+    used by Jinjaform. Sessions created afterwards share the data loader,
+    so the daemon can load the data once for every command that it runs.
+
+    """
+
+    global data_loader
+
+    import boto3
+    importlib.import_module('boto_source_profile_mfa')
+
+    session = boto3.Session(region_name='us-east-1')
+    for service_name in ('dynamodb', 's3', 'sts'):
+        session.client(service_name)
+    data_loader = session._session.get_component('data_loader')
+
+
+def _check_bucket(s3_client, account_id, region, bucket):
+    """
+    Checks that an S3 bucket exists with versioning enabled. Returns what
+    needs to be done: "create", "enable versioning", or None if nothing.
+
+    """
+
+    key = ('s3', account_id, region, bucket)
+    with _verifying(key):
+
+        if _is_verified(key):
+            return None
 
         try:
             response = s3_client.get_bucket_versioning(
                 Bucket=bucket
             )
         except s3_client.exceptions.NoSuchBucket:
-            bucket_exists = False
-            bucket_versioning = False
-        else:
-            bucket_exists = True
-            bucket_versioning = response['Status'] == 'Enabled'
+            return 'create'
 
-        if not bucket_exists:
+        if response.get('Status') != 'Enabled':
+            return 'enable versioning'
 
-            if not log.accept('backend: create s3://{} in {}', bucket, region):
-                log.bad('backend: bucket not created')
-                sys.exit(1)
+        _set_verified(key)
+        return None
 
-            log.ok('backend: creating bucket')
-            s3_client.create_bucket(
-                ACL='private',
-                Bucket=bucket,
-                CreateBucketConfiguration={
-                    'LocationConstraint': region,
-                },
-            )
-            s3_client.get_waiter('bucket_exists').wait(Bucket=bucket)
 
-        if not bucket_versioning:
-            log.ok('backend: enabling versioning')
-            s3_client.put_bucket_versioning(
-                Bucket=bucket,
-                VersioningConfiguration={
-                    'Status': 'Enabled',
-                },
-            )
+def _check_table(dynamodb_client, account_id, region, table):
+    """
+    Checks that a DynamoDB table exists. Returns what needs to be done:
+    "create", or None if nothing.
 
-    dynamodb_table = s3_backend.get('dynamodb_table')
-    if dynamodb_table:
+    """
 
-        log.ok('backend: dynamodb://{} in {}', dynamodb_table, region)
+    key = ('dynamodb', account_id, region, table)
+    with _verifying(key):
 
-        dynamodb_client = get_default_session().client('dynamodb')
+        if _is_verified(key):
+            return None
 
         try:
             dynamodb_client.describe_table(
-                TableName=dynamodb_table,
+                TableName=table,
             )
         except dynamodb_client.exceptions.ResourceNotFoundException:
+            return 'create'
 
-            if not log.accept('backend: create dynamodb://{} in {}', dynamodb_table, region):
-                log.bad('backend: table not created')
-                sys.exit(1)
+        _set_verified(key)
+        return None
+
+
+def _create_bucket(s3_client, account_id, region, bucket, action):
+    """
+    Creates an S3 bucket and enables versioning. The lock for the bucket
+    is held while doing this, and another stack may have created the
+    bucket since it was checked, in which case this only makes sure
+    that versioning is enabled.
+
+    """
 
-            log.ok('creating table')
+    key = ('s3', account_id, region, bucket)
+    with _verifying(key):
+
+        if _is_verified(key):
+            return
+
+        if action == 'create':
+            log.ok('backend: creating bucket')
+            try:
+                s3_client.create_bucket(
+                    ACL='private',
+                    Bucket=bucket,
+                    CreateBucketConfiguration={
+                        'LocationConstraint': region,
+                    },
+                )
+            except s3_client.exceptions.BucketAlreadyOwnedByYou:
+                log.ok('backend: bucket already created')
+            s3_client.get_waiter('bucket_exists').wait(Bucket=bucket)
+
+        log.ok('backend: enabling versioning')
+        s3_client.put_bucket_versioning(
+            Bucket=bucket,
+            VersioningConfiguration={
+                'Status': 'Enabled',
+            },
+        )
+
+        _set_verified(key)
+
+
+def _create_table(dynamodb_client, account_id, region, table, action):
+    """
+    Creates a DynamoDB table. The lock for the table is held while doing
+    this, and another stack may have created the table since it was
+    checked, in which case this waits for it to be ready.
+
+    """
+
+    key = ('dynamodb', account_id, region, table)
+    with _verifying(key):
+
+        if _is_verified(key):
+            return
+
+        log.ok('creating table')
+        try:
             dynamodb_client.create_table(
-                TableName=dynamodb_table,
+                TableName=table,
                 AttributeDefinitions=[
                     {
                         'AttributeName': 'LockID',
@@ -128,6 +293,125 @@ def backend_setup():
                 ],
                 BillingMode='PAY_PER_REQUEST',
             )
+        except dynamodb_client.exceptions.ResourceInUseException:
+            log.ok('table already created')
+        dynamodb_client.get_waiter('table_exists').wait(TableName=table)
+
+        _set_verified(key)
+
+
+def _get_account_id(session):
+    """
+    Returns the account ID for the session's credentials. This is cached
+    using the access key, which is shared between processes when
+    temporary credentials come from the credentials cache.
+
+    """
+
+    access_key = session.get_credentials().get_frozen_credentials().access_key
+    key = ('account', access_key)
+    with _verifying(key):
+        account_id = _is_verified(key)
+        if not account_id:
+            account_id = get_client(session, 'sts').get_caller_identity()['Account']
+            _set_verified(key, account_id)
+    return account_id
+
+
+def _get_verified_path(key):
+    return os.path.join(config.jinjaform_root, 'cache', 'backend', digest(*key))
+
+
+def _is_verified(key):
+    """
+    Returns the value recorded for a key if it was verified recently,
+    by this or another process, otherwise None.
+
+    """
+
+    if key in verified:
+        return verified[key]
+    data = cache.read(_get_verified_path(key))
+    if data:
+        with suppress(KeyError, ValueError):
+            entry = json.loads(data.decode('utf-8'))
+            if time.time() - entry['time'] < backend_check_ttl:
+                verified[key] = entry['value']
+                return entry['value']
+    return None
+
+
+def _set_verified(key, value=True):
+    verified[key] = value
+    data = json.dumps({'time': time.time(), 'value': value})
+    cache.write(_get_verified_path(key), data.encode('utf-8'))
+
+
+@contextmanager
+def _verifying(key):
+    """
+    Allows only one thread or process to check a key at the same time,
+    so that others can use the result instead of checking it again.
+
+    """
+
+    with lock:
+        key_lock = verifying.setdefault(key, threading.Lock())
+    with key_lock:
+        with cache.lock(_get_verified_path(key) + '.lock'):
+            yield
+
+
+def backend_setup():
+
+    region = s3_backend.get('region')
+    if not region:
+        return
+
+    bucket = s3_backend.get('bucket')
+    dynamodb_table = s3_backend.get('dynamodb_table')
+    if not bucket and not dynamodb_table:
+        return
+
+    session = get_default_session()
+    account_id = _get_account_id(session)
+
+    checks = []
+    if bucket:
+        log.ok('backend: s3://{} in {}', bucket, region)
+        checks.append((_check_bucket, _create_bucket, get_client(session, 's3'), bucket))
+    if dynamodb_table:
+        log.ok('backend: dynamodb://{} in {}', dynamodb_table, region)
+        checks.append((_check_table, _create_table, get_client(session, 'dynamodb'), dynamodb_table))
+
+    # Check the bucket and table at the same time.
+    with ThreadPoolExecutor(len(checks)) as executor:
+        futures = [
+            executor.submit(check, client, account_id, region, name)
+            for check, create, client, name in checks
+        ]
+        actions = [future.result() for future in futures]
+
+    # Ask before creating anything, one question at a time.
+    creates = []
+    for (check, create, client, name), action in zip(checks, actions):
+        if action == 'create':
+            scheme = 's3' if create is _create_bucket else 'dynamodb'
+            if not log.accept('backend: create {}://{} in {}', scheme, name, region):
+                log.bad('backend: {} not created', 'bucket' if scheme == 's3' else 'table')
+                sys.exit(1)
+        if action:
+            creates.append((create, client, name, action))
+
+    # Then create them at the same time.
+    if creates:
+        with ThreadPoolExecutor(len(creates)) as executor:
+            futures = [
+                executor.submit(create, client, account_id, region, name, action)
+                for create, client, name, action in creates
+            ]
+            for future in futures:
+                future.result()
 
 
 def credentials_setup():
@@ -148,15 +432,15 @@ def credentials_setup():
         sys.exit(1)
 
     if creds.access_key:
-        env['AWS_ACCESS_KEY_ID'] = creds.access_key
+        config.env['AWS_ACCESS_KEY_ID'] = creds.access_key
 
     if creds.secret_key:
-        env['AWS_SECRET_ACCESS_KEY'] = creds.secret_key
+        config.env['AWS_SECRET_ACCESS_KEY'] = creds.secret_key
 
     if creds.token:
-        env['AWS_SECURITY_TOKEN'] = creds.token
-        env['AWS_SESSION_TOKEN'] = creds.token
+        config.env['AWS_SECURITY_TOKEN'] = creds.token
+        config.env['AWS_SESSION_TOKEN'] = creds.token
 
     if session.region_name:
-        env['AWS_REGION'] = session.region_name
-        env['AWS_DEFAULT_REGION'] = session.region_name
+        config.env['AWS_REGION'] = session.region_name
+        config.env['AWS_DEFAULT_REGION'] = session.region_name
@@ -0,0 +1,323 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from jinjaform import aws, config, index, log, trace
+
+
+def _get_providers(stacks):
+    """
+    Returns the default AWS provider blocks with literal attributes in the
+    .tf files used by the stacks, which are in each stack directory and
+    its parent directories. Attributes that are set by templates
+    cannot be found without rendering them, so they are left out.
+
+    """
+
+    from jinjaform import scanner
+
+    providers = []
+    scanned = set()
+    for stack in stacks:
+        current = stack
+        while (current + '/').startswith(config.project_root + '/'):
+            if current in scanned:
+                break
+            scanned.add(current)
+            for entry in os.scandir(current):
+                if entry.name.startswith('.') or not entry.name.lower().endswith('.tf') or entry.is_dir():
+                    continue
+                with open(entry.path) as open_file:
+                    source = open_file.read()
+                try:
+                    blocks = scanner.scan(source, types=('provider',))
+                except scanner.ScanError:
+                    continue
+                for block in blocks:
+                    if block.labels != ['aws']:
+                        continue
+                    provider = {}
+                    for name, value in block.attributes().items():
+                        if isinstance(value, str) and not isinstance(value, scanner.Expression) and '{{' not in value:
+                            provider[name] = value
+                    if 'alias' not in block.attributes():
+                        providers.append(provider)
+            current = os.path.dirname(current)
+    return providers
+
+
+def get_credentials(stacks):
+    """
+    Gets AWS credentials for the providers used by the stacks before
+    they run, so that MFA prompts are answered once here rather than
+    by every stack. Stacks run in forked processes that share the
+    sessions created here, and sessions for assumed roles also share
+    their credentials through the cache in the user's cache directory.
+
+    """
+
+    seen = set()
+    for provider in _get_providers(stacks):
+        session_kwargs = aws.get_provider_session_kwargs(provider)
+        if 'profile_name' not in session_kwargs:
+            continue
+        key = tuple(sorted(session_kwargs.items(), key=lambda item: item[0]))
+        if key in seen:
+            continue
+        seen.add(key)
+        try:
+            aws.get_session(**session_kwargs).get_credentials()
+        except KeyboardInterrupt:
+            print()
+            log.bad('aborted')
+            return False
+        except Exception as error:
+            # Leave the stacks to report the error.
+            log.bad('aws credentials: {}: {}', session_kwargs['profile_name'], error)
+    return True
+
+
+def discover_stacks(path):
+    """
+    Returns the stack directories under a path, using the project index
+    so that unchanged directories are not listed again.
+
+    """
+
+    return index.find_stacks(path)
+
+
+def parse_args(args):
+    """
+    Parses the options for running against multiple stacks, which must
+    come before the Terraform command. Returns the options and the
+    remaining arguments.
+
+    """
+
+    options = {}
+    args = list(args)
+    while args:
+        arg = args[0]
+        if arg == '-all':
+            options['all'] = True
+        elif arg.startswith('-dir='):
+            options.setdefault('dirs', []).append(arg[len('-dir='):])
+        elif arg == '-dir' and len(args) > 1:
+            options.setdefault('dirs', []).append(args.pop(1))
+        elif arg.startswith('-since='):
+            options['since'] = arg[len('-since='):]
+        elif arg == '-since' and len(args) > 1:
+            options['since'] = args.pop(1)
+        elif arg.startswith('-j='):
+            options['jobs'] = arg[len('-j='):]
+        elif arg == '-j' and len(args) > 1:
+            options['jobs'] = args.pop(1)
+        else:
+            break
+        args.pop(0)
+    return options, args
+
+
+def main(options, args, target):
+    """
+    Runs the target function for each stack selected by the options.
+    Returns an exit code.
+
+    """
+
+    if not config.project_root:
+        log.bad('could not find .jinjaformrc file in current or parent directories')
+        return 1
+
+    try:
+        jobs = int(options.get('jobs', 1))
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        log.bad('-j must be a positive number')
+        return 1
+
+    stacks = []
+    if options.get('all'):
+        stacks.extend(discover_stacks(config.cwd))
+    if options.get('since'):
+        try:
+            changed_paths = index.get_changed_paths(options['since'])
+        except subprocess.CalledProcessError:
+            return 1
+        affected = index.get_affected_stacks(discover_stacks(config.cwd), changed_paths)
+        if not affected and not stacks and not options.get('dirs'):
+            log.ok('no stacks affected since {}', options['since'])
+            return 0
+        stacks.extend(affected)
+    for path in options.get('dirs', []):
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            log.bad('{} is not a directory', path)
+            return 1
+        if config.find_project_root(path) != config.project_root:
+            log.bad('{} is not in the project {}', path, config.project_root)
+            return 1
+        stacks.append(path)
+
+    if not stacks:
+        log.bad('no stacks found')
+        return 1
+
+    return run(sorted(set(stacks)), args, jobs, target)
+
+
+def run(stacks, args, jobs, target, action=None, credentials=True):
+    """
+    Runs the target function in multiple stack directories, with up to
+    the specified number of jobs running at the same time. Each stack runs
+    in a forked process, which shares the modules and Jinja2 environment
+    already loaded by this process. Output from each stack is shown when
+    it finishes, followed by a summary. Returns an exit code.
+
+    The action describes what the target does, for the output. AWS
+    credentials for the providers are only fetched beforehand if the
+    target needs them.
+
+    """
+
+    # Load the Jinja2 environment, custom extensions and HCL parser
+    # once, so that every forked process inherits them.
+    from jinjaform import render, workspace
+    env, extensions = render.get_environment(config.project_root)
+    extensions.preload()
+    workspace.get_hcl_parser()
+
+    # Read the state of the git checkout once, and fetch the upstream
+    # branch if required, so that every forked process can use it.
+    if args and args[0] == 'apply':
+        from jinjaform import git, rc
+        config.load(config.cwd, args)
+        git.start(remote=('GIT_CHECK_REMOTE', None) in list(rc.read()))
+        git.get_status()
+
+    if credentials:
+        with trace.span('aws credentials'):
+            if not get_credentials(stacks):
+                return 1
+
+    log.ok('{} in {} stacks', action or 'running ' + (' '.join(args) or 'terraform'), len(stacks))
+
+    pending = list(stacks)
+    running = {}
+    results = {}
+
+    while pending or running:
+
+        while pending and len(running) < jobs:
+            stack = pending.pop(0)
+            if jobs == 1:
+                # Show output as it happens when running one at a time.
+                log.ok('stack: {}', os.path.relpath(stack, config.project_root))
+                output_path = None
+            else:
+                fd, output_path = tempfile.mkstemp(prefix='jinjaform-')
+                os.close(fd)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                _run_stack(stack, args, target, output_path)
+            running[pid] = (stack, output_path, time.time())
+
+        try:
+            pid, exit_status = os.wait()
+        except KeyboardInterrupt:
+            # Child processes receive the interrupt too,
+            # so stop starting new stacks and let them finish.
+            pending.clear()
+            continue
+        except ChildProcessError:
+            break
+
+        stack, output_path, start_time = running.pop(pid)
+        exit_code = os.waitstatus_to_exitcode(exit_status)
+        end_time = time.time()
+        results[stack] = (exit_code, end_time - start_time)
+        trace.add_span('stack', start_time, end_time, stack=stack, exit_code=exit_code)
+
+        if output_path:
+            log.ok('stack: {}', os.path.relpath(stack, config.project_root))
+            with open(output_path, 'rb') as output_file:
+                sys.stdout.flush()
+                sys.stdout.buffer.write(output_file.read())
+                sys.stdout.flush()
+            os.remove(output_path)
+
+    log.ok('summary:')
+    failed = 0
+    for stack in stacks:
+        relative_path = os.path.relpath(stack, config.project_root)
+        if stack not in results:
+            failed += 1
+            log.bad('{}: not run', relative_path)
+            continue
+        exit_code, duration = results[stack]
+        if exit_code == 0:
+            log.ok('{}: ok ({:.1f}s)', relative_path, duration)
+        else:
+            failed += 1
+            log.bad('{}: failed with exit code {} ({:.1f}s)', relative_path, exit_code, duration)
+
+    if failed:
+        log.bad('{} of {} stacks failed', failed, len(stacks))
+        return 1
+    return 0
+
+
+def _run_stack(stack, args, target, output_path):
+    """
+    Runs the target function for a single stack in a forked process.
+    This function never returns.
+
+    """
+
+    exit_code = 1
+    try:
+
+        if output_path:
+            output_fd = os.open(output_path, os.O_WRONLY)
+            os.dup2(output_fd, 1)
+            os.dup2(output_fd, 2)
+            os.close(output_fd)
+            # Prompts cannot be answered when running stacks in parallel,
+            # so commands that need an answer fail rather than assuming one.
+            input_fd = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(input_fd, 0)
+            os.close(input_fd)
+            log.interactive = False
+
+        config.load(stack, args)
+        if output_path:
+            config.env['TF_INPUT'] = '0'
+        os.chdir(stack)
+
+        try:
+            target()
+        except SystemExit as error:
+            if error.code is None:
+                exit_code = 0
+            elif isinstance(error.code, int):
+                exit_code = error.code
+            else:
+                print(error.code, file=sys.stderr)
+        else:
+            exit_code = 0
+
+    except BaseException:
+        traceback.print_exc()
+
+    finally:
+        trace.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
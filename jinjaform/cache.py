@@ -0,0 +1,100 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+from contextlib import contextmanager, suppress
+
+
+def digest(*values):
+    """
+    Returns a stable hash of JSON-serialisable values.
+
+    """
+
+    data = json.dumps(values, sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def evict(path, max_size):
+    """
+    Removes the least recently used files from a cache directory
+    until the total size of the files is within the limit.
+
+    """
+
+    entries = []
+    total_size = 0
+    with suppress(FileNotFoundError):
+        for entry in os.scandir(path):
+            if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                stat = entry.stat(follow_symlinks=False)
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+    if total_size <= max_size:
+        return
+
+    for mtime, size, file_path in sorted(entries):
+        with suppress(FileNotFoundError):
+            os.remove(file_path)
+        total_size -= size
+        if total_size <= max_size:
+            break
+
+
+@contextmanager
+def lock(path, shared=False):
+    """
+    Holds an exclusive lock on a file while the context is active,
+    waiting for other processes and threads to release it first.
+    A shared lock can be held by many processes at the same time,
+    but not while another process holds an exclusive lock.
+
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read(path):
+    """
+    Returns the contents of a cache file, or None if it does not exist.
+    Reading a file marks it as recently used.
+
+    """
+
+    try:
+        with open(path, 'rb') as open_file:
+            data = open_file.read()
+    except FileNotFoundError:
+        return None
+    with suppress(FileNotFoundError):
+        os.utime(path)
+    return data
+
+
+def write(path, data):
+    """
+    Writes a cache file atomically, so that other processes
+    never see a partially written file.
+
+    """
+
+    dir_path = os.path.dirname(path)
+    os.makedirs(dir_path, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as open_file:
+            open_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
@@ -1,16 +1,12 @@
 import os
 import sys
 
-from jinjaform import log
-
+from functools import lru_cache
 
-args = sys.argv[1:]
-cmd = args[0] if args else None
-cwd = os.getcwd()
-env = os.environ.copy()
+from jinjaform import log
 
 
-def find_project_root():
+def find_project_root(cwd):
     current = cwd
     while True:
         path = os.path.join(current, '.jinjaformrc')
@@ -21,6 +17,7 @@ def find_project_root():
             return ''
 
 
+@lru_cache()
 def find_terraform_bin():
     for path in os.environ['PATH'].split(os.pathsep):
         terraform_path = os.path.join(path, 'terraform')
@@ -36,11 +33,36 @@ def find_terraform_bin():
     sys.exit(1)
 
 
-project_root = find_project_root()
-jinjaform_root = os.path.join(project_root, '.jinjaform')
-terraform_bin = find_terraform_bin()
-workspace_dir = os.path.join(cwd, '.jinjaform')
-terraform_dir = os.path.join(workspace_dir, '.terraform')
+def load(directory, arguments):
+    """
+    Sets the configuration for running in a directory with arguments.
+    This happens when the module is imported, and again for each stack
+    when running against multiple stacks.
+
+    """
+
+    global args, cmd, cwd, env, project_root, jinjaform_root, workspace_dir, terraform_dir
+
+    args = list(arguments)
+    cmd = args[0] if args else None
+    cwd = directory
+    env = os.environ.copy()
+
+    project_root = find_project_root(cwd)
+    jinjaform_root = os.path.join(project_root, '.jinjaform')
+    workspace_dir = os.path.join(cwd, '.jinjaform')
+    terraform_dir = os.path.join(workspace_dir, '.terraform')
+
+    env['JINJAFORM_PROJECT_ROOT'] = project_root
+    env['JINJAFORM_WORKSPACE'] = workspace_dir
+
+
+def __getattr__(name):
+    # Find Terraform when it is first used rather than when this module
+    # is imported, so that commands which do not run it start faster.
+    if name == 'terraform_bin':
+        return find_terraform_bin()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
 
-env['JINJAFORM_PROJECT_ROOT'] = project_root
-env['JINJAFORM_WORKSPACE'] = workspace_dir
+load(os.getcwd(), sys.argv[1:])
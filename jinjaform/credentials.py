@@ -0,0 +1,132 @@
+import json
+import os
+
+from datetime import datetime, timedelta, timezone
+
+from jinjaform import cache
+
+
+# Set JINJAFORM_AWS_CREDENTIALS_CACHE=0 to disable the cache.
+enabled = os.environ.get('JINJAFORM_AWS_CREDENTIALS_CACHE') != '0'
+
+# Cached credentials are refreshed when they have less than this many
+# minutes left, so that long Terraform runs do not use expired credentials.
+# Botocore refreshes credentials with less than 15 minutes left,
+# so cached credentials must have more than that.
+refresh_minutes = max(int(os.environ.get('JINJAFORM_AWS_CREDENTIALS_REFRESH', 30)), 16)
+
+
+def _get_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser(os.path.join('~', '.cache'))
+    return os.path.join(cache_home, 'jinjaform', 'aws-credentials')
+
+
+def _get_cache_key(session):
+    """
+    Returns a cache key for the credentials of a boto3 session, based on
+    its profile, or None if the credentials do not come from assuming
+    a role or using MFA, in which case there is nothing to gain.
+
+    """
+
+    from botocore.exceptions import ProfileNotFound
+
+    try:
+        profile_config = session._session.get_scoped_config()
+    except ProfileNotFound:
+        return None
+
+    role_arn = profile_config.get('role_arn')
+    mfa_serial = profile_config.get('mfa_serial')
+    if not role_arn and not mfa_serial:
+        return None
+
+    return cache.digest(
+        session.profile_name,
+        role_arn,
+        mfa_serial,
+        profile_config.get('source_profile'),
+        profile_config.get('external_id'),
+        profile_config.get('role_session_name'),
+        profile_config.get('duration_seconds'),
+    )
+
+
+def _load(path):
+    """
+    Returns cached credentials if they exist and will not expire soon.
+
+    """
+
+    data = cache.read(path)
+    if not data:
+        return None
+    try:
+        metadata = json.loads(data.decode('utf-8'))
+        expiry_time = datetime.fromisoformat(metadata['expiry_time'])
+    except (KeyError, ValueError):
+        return None
+    if expiry_time - datetime.now(timezone.utc) < timedelta(minutes=refresh_minutes):
+        return None
+    return metadata
+
+
+def use_cache(session):
+    """
+    Makes a boto3 session share its temporary credentials with other
+    sessions and Jinjaform processes using a file in the user's cache
+    directory. A lock is held while fetching credentials, so when many
+    processes need credentials for the same role at the same time,
+    only one of them calls STS or prompts for MFA.
+
+    """
+
+    if not enabled:
+        return
+
+    key = _get_cache_key(session)
+    if not key:
+        return
+
+    from botocore.credentials import DeferredRefreshableCredentials
+    from botocore.exceptions import NoCredentialsError
+
+    botocore_session = session._session
+    resolver = botocore_session.get_component('credential_provider')
+    path = os.path.join(_get_cache_dir(), key + '.json')
+    sources = []
+
+    def refresh():
+        # The cached files are only readable by the current user.
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with cache.lock(path + '.lock'):
+
+            metadata = _load(path)
+            if metadata:
+                return metadata
+
+            # Get credentials in the usual way. These are kept between
+            # refreshes because they are also refreshable credentials.
+            if not sources:
+                sources.append(resolver.load_credentials())
+            credentials = sources[0]
+            if credentials is None:
+                raise NoCredentialsError()
+            frozen = credentials.get_frozen_credentials()
+
+            expiry_time = getattr(credentials, '_expiry_time', None)
+            metadata = {
+                'access_key': frozen.access_key,
+                'secret_key': frozen.secret_key,
+                'token': frozen.token,
+                'expiry_time': (expiry_time or datetime.now(timezone.utc) + timedelta(hours=1)).isoformat(),
+            }
+            if expiry_time:
+                cache.write(path, json.dumps(metadata).encode('utf-8'))
+
+            return metadata
+
+    botocore_session._credentials = DeferredRefreshableCredentials(
+        method='jinjaform-cache',
+        refresh_using=refresh,
+    )
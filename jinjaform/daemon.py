@@ -0,0 +1,580 @@
+import hashlib
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from contextlib import suppress
+
+from jinjaform import __version__
+from jinjaform.config import find_project_root
+
+
+# Set JINJAFORM_DAEMON=0 to always run commands in the current process.
+enabled = os.environ.get('JINJAFORM_DAEMON') != '0'
+
+# The daemon stops after this many minutes without any commands,
+# or never if this is 0.
+idle_timeout = float(os.environ.get('JINJAFORM_DAEMON_TIMEOUT', 60)) * 60
+
+header = struct.Struct('!I')
+
+
+def get_socket_path(project_root):
+    """
+    Returns the path of the socket for the daemon of a project. It is in
+    a directory that only the current user can use, and is named after the
+    project root, because socket paths must be short.
+
+    """
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    socket_dir = os.path.join(runtime_dir, 'jinjaform-{}'.format(os.getuid()))
+    name = hashlib.sha256(project_root.encode('utf-8')).hexdigest()[:32]
+    return os.path.join(socket_dir, name + '.sock')
+
+
+def get_settings(env):
+    """
+    Returns the environment variables that are read when Jinjaform
+    is imported, which must be the same for the daemon and its clients.
+
+    """
+
+    return {
+        name: value for name, value in env.items()
+        if name.startswith('JINJAFORM_') and not name.startswith('JINJAFORM_DAEMON')
+    }
+
+
+def _get_fingerprint(project_root):
+    """
+    Returns the names, sizes and modification times of the custom Jinja2
+    extensions, which the daemon has loaded and must load again
+    if they have changed.
+
+    """
+
+    files = []
+    jinja_path = os.path.join(project_root, '.jinja')
+    for dir_path, dir_names, file_names in os.walk(jinja_path):
+        dir_names[:] = sorted(name for name in dir_names if name != '__pycache__')
+        for name in sorted(file_names):
+            path = os.path.join(dir_path, name)
+            stat = os.stat(path)
+            files.append([os.path.relpath(path, jinja_path), stat.st_size, stat.st_mtime_ns])
+    return files
+
+
+def _receive(connection, size=None):
+    """
+    Returns a message from a socket, or None if it was closed,
+    along with any file descriptors that were sent with it.
+
+    """
+
+    data = b''
+    fds = []
+    while size is None or len(data) < size:
+        wanted = (header.size if size is None else size) - len(data)
+        chunk, chunk_fds, _, _ = socket.recv_fds(connection, wanted, 3)
+        fds.extend(chunk_fds)
+        if not chunk:
+            return None, fds
+        data += chunk
+        if size is None and len(data) == header.size:
+            size = header.unpack(data)[0]
+            data = b''
+    return json.loads(data.decode('utf-8')), fds
+
+
+def _send(connection, message, fds=()):
+    data = json.dumps(message).encode('utf-8')
+    if fds:
+        socket.send_fds(connection, [header.pack(len(data)) + data], list(fds))
+    else:
+        connection.sendall(header.pack(len(data)) + data)
+
+
+def request(args):
+    """
+    Runs a command in the daemon for the current project, with the
+    current directory, environment variables and terminal. Returns the
+    exit code, or None if there is no daemon or it cannot run the command,
+    in which case it should run in the current process.
+
+    """
+
+    if not enabled or (args and args[0] == 'daemon'):
+        return None
+
+    cwd = os.getcwd()
+    project_root = find_project_root(cwd)
+    if not project_root:
+        return None
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(get_socket_path(project_root))
+    except OSError:
+        connection.close()
+        return None
+
+    with connection:
+
+        try:
+            _send(connection, {
+                'args': args,
+                'cwd': cwd,
+                'env': dict(os.environ),
+                'umask': os.umask(os.umask(0)),
+                'version': __version__,
+            }, fds=(0, 1, 2))
+            message, _ = _receive(connection)
+        except OSError:
+            return None
+
+        if not message or 'pid' not in message:
+            return None
+
+        # The command runs in its own process group,
+        # so pass on interrupts from the terminal.
+        pid = message['pid']
+
+        def interrupt(signum, frame):
+            with suppress(ProcessLookupError):
+                os.killpg(pid, signum)
+
+        signal.signal(signal.SIGINT, interrupt)
+        signal.signal(signal.SIGTERM, interrupt)
+
+        try:
+            message, _ = _receive(connection)
+        except OSError:
+            message = None
+
+        if not message:
+            print('[jinjaform] lost connection to daemon', file=sys.stderr)
+            return 1
+        return message['exit_code']
+
+
+def _run_command(message, fds):
+    """
+    Runs a command in a process forked from the daemon, as if it was run
+    in the client's process. This function never returns.
+
+    """
+
+    exit_code = 1
+    try:
+
+        os.setpgid(0, 0)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        for target_fd, fd in enumerate(fds):
+            os.dup2(fd, target_fd)
+            os.close(fd)
+
+        # Create new streams, because the existing ones
+        # are buffered for a log file rather than a terminal.
+        from jinjaform import config, log, trace
+        trace.restart()
+        log.reset()
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', closefd=False)
+        sys.stderr = open(2, 'w', closefd=False, errors='backslashreplace')
+
+        os.umask(message['umask'])
+        os.environ.clear()
+        os.environ.update(message['env'])
+        os.chdir(message['cwd'])
+        sys.argv[1:] = message['args']
+        config.load(message['cwd'], message['args'])
+
+        from jinjaform.__main__ import main
+        main()
+        exit_code = 0
+
+    except SystemExit as error:
+        if error.code is None:
+            exit_code = 0
+        elif isinstance(error.code, int):
+            exit_code = error.code
+        else:
+            print(error.code, file=sys.stderr)
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+
+    finally:
+        # Finish writing output before the daemon tells the client that
+        # the command has finished, and exit without returning to the
+        # daemon's code.
+        from jinjaform import trace
+        if trace.path:
+            trace.save()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+class Server(object):
+    """
+    Keeps the modules, custom Jinja2 extensions and compiled templates
+    of a project loaded, and runs commands for clients in forked processes
+    which inherit them, so that commands start without importing or
+    loading anything.
+
+    """
+
+    def __init__(self, project_root):
+        self.project_root = project_root
+        self.socket_path = get_socket_path(project_root)
+        self.settings = get_settings(os.environ)
+        self.fingerprint = _get_fingerprint(project_root)
+        self.commands = {}
+        self.count = 0
+        self.last_time = time.time()
+        self.restarting = False
+        self.start_time = time.time()
+        self.stopping = False
+
+    def _check(self, message):
+        """
+        Returns the reason that the daemon cannot run a command,
+        or None if it can.
+
+        """
+
+        if message.get('version') != __version__:
+            return 'different jinjaform version'
+        if find_project_root(message['cwd']) != self.project_root:
+            return 'different project'
+        if get_settings(message['env']) != self.settings:
+            return 'different JINJAFORM_ environment variables'
+        if self.restarting:
+            return 'restarting'
+        if _get_fingerprint(self.project_root) != self.fingerprint:
+            self.restarting = True
+            return 'custom extensions have changed'
+        return None
+
+    def _handle(self, connection):
+        """
+        Handles a message from a client.
+
+        """
+
+        message, fds = _receive(connection)
+        if not message:
+            connection.close()
+            return
+
+        if message.get('stop'):
+            _send(connection, {'stopping': True})
+            connection.close()
+            self.stopping = True
+            return
+
+        if message.get('status'):
+            _send(connection, {
+                'commands': self.count,
+                'pid': os.getpid(),
+                'project_root': self.project_root,
+                'running': len(self.commands),
+                'uptime': time.time() - self.start_time,
+            })
+            connection.close()
+            return
+
+        # Only run commands for the same user.
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', credentials)
+        reason = 'not the same user' if uid != os.getuid() else self._check(message)
+        if reason or len(fds) != 3:
+            _send(connection, {'fallback': reason or 'terminal not received'})
+            connection.close()
+            for fd in fds:
+                os.close(fd)
+            return
+
+        self._refresh()
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.listener.close()
+            connection.close()
+            _run_command(message, fds)
+
+        for fd in fds:
+            os.close(fd)
+        _send(connection, {'pid': pid})
+        self.commands[pid] = connection
+        self.count += 1
+        self.last_time = time.time()
+
+    def _reap(self):
+        """
+        Tells clients the exit codes of commands that have finished.
+
+        """
+
+        while self.commands:
+            try:
+                pid, exit_status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            connection = self.commands.pop(pid, None)
+            if connection:
+                exit_code = os.waitstatus_to_exitcode(exit_status)
+                if exit_code < 0:
+                    # Use the exit code a shell would for a signal.
+                    exit_code = 128 - exit_code
+                try:
+                    _send(connection, {'exit_code': exit_code})
+                except OSError:
+                    pass
+                connection.close()
+                self.last_time = time.time()
+
+    def _preload(self):
+        """
+        Loads everything that commands might need, so that the processes
+        running them inherit it.
+
+        """
+
+        from jinjaform import aws, render, workspace
+
+        # Import the libraries that take a long time to import,
+        # and load the AWS service data used by Jinjaform.
+        importlib.import_module('jinjaform.__main__')
+        aws.preload()
+        workspace.get_hcl_parser()
+
+        enable_async = os.environ.get('JINJAFORM_RENDER_ENGINE') == 'async'
+        env, extensions = render.get_environment(self.project_root, enable_async=enable_async)
+        extensions.preload()
+
+        self._refresh()
+
+    def _refresh(self):
+        """
+        Loads compiled templates that were added since the last command.
+
+        """
+
+        from jinjaform import render
+        render.preload_bytecode(self.project_root)
+
+    def serve(self):
+        from jinjaform import log
+
+        self._preload()
+
+        socket_dir = os.path.dirname(self.socket_path)
+        os.makedirs(socket_dir, mode=0o700, exist_ok=True)
+        stat = os.stat(socket_dir)
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            log.bad('daemon: {} must only be accessible by the current user', socket_dir)
+            return 1
+
+        if ping(self.project_root):
+            log.bad('daemon: already running for {}', self.project_root)
+            return 1
+        with suppress(FileNotFoundError):
+            os.remove(self.socket_path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(self.socket_path)
+        self.listener.listen(64)
+        socket_ino = os.stat(self.socket_path).st_ino
+
+        # Wake up when commands finish.
+        wakeup_read, wakeup_write = os.pipe()
+        os.set_blocking(wakeup_read, False)
+        os.set_blocking(wakeup_write, False)
+        signal.set_wakeup_fd(wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+
+        log.ok('daemon: serving {} on {}', self.project_root, self.socket_path)
+        sys.stdout.flush()
+
+        try:
+            while True:
+
+                self._reap()
+
+                if self.stopping and not self.commands:
+                    break
+                if self.restarting and not self.commands:
+                    break
+                if idle_timeout and not self.commands and time.time() - self.last_time > idle_timeout:
+                    log.ok('daemon: stopping after {} minutes without commands', idle_timeout / 60)
+                    break
+
+                ready, _, _ = select.select([self.listener, wakeup_read], [], [], 10)
+                if wakeup_read in ready:
+                    while True:
+                        try:
+                            if not os.read(wakeup_read, 1024):
+                                break
+                        except BlockingIOError:
+                            break
+                if self.listener in ready and not self.stopping:
+                    connection, _ = self.listener.accept()
+                    try:
+                        self._handle(connection)
+                    except OSError:
+                        connection.close()
+
+        finally:
+            self.listener.close()
+            # Leave the socket alone if another daemon has replaced it.
+            with suppress(FileNotFoundError):
+                if os.stat(self.socket_path).st_ino == socket_ino:
+                    os.remove(self.socket_path)
+
+        if self.restarting:
+            # Start again with the changed extensions.
+            log.ok('daemon: custom extensions have changed, restarting')
+            sys.stdout.flush()
+            os.execv(sys.executable, [sys.executable, '-m', 'jinjaform', 'daemon', 'run'])
+
+        return 0
+
+
+def ping(project_root, message=None):
+    """
+    Sends a message to the daemon for a project and returns the response,
+    or None if it is not running.
+
+    """
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with connection:
+        try:
+            connection.connect(get_socket_path(project_root))
+            _send(connection, message or {'status': True})
+            response, _ = _receive(connection)
+        except OSError:
+            return None
+    return response
+
+
+def start(project_root):
+    """
+    Starts the daemon in the background, with its output written to
+    a log file, and waits for it to be ready.
+
+    """
+
+    from jinjaform import config, log
+
+    log_path = os.path.join(config.jinjaform_root, 'daemon.log')
+    os.makedirs(config.jinjaform_root, exist_ok=True)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+        # Detach from the terminal.
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        os.chdir(project_root)
+        input_fd = os.open(os.devnull, os.O_RDONLY)
+        output_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        os.dup2(input_fd, 0)
+        os.dup2(output_fd, 1)
+        os.dup2(output_fd, 2)
+        os.close(input_fd)
+        os.close(output_fd)
+        os.execv(sys.executable, [sys.executable, '-m', 'jinjaform', 'daemon', 'run'])
+    os.waitpid(pid, 0)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        status = ping(project_root)
+        if status:
+            log.ok('daemon: started with pid {}', status['pid'])
+            return 0
+        time.sleep(0.1)
+
+    log.bad('daemon: did not start, see {}', log_path)
+    return 1
+
+
+def main(args):
+    """
+    Runs the "jinjaform daemon" command. Returns an exit code.
+
+    """
+
+    from jinjaform import config, log
+
+    if not config.project_root:
+        log.bad('could not find .jinjaformrc file in current or parent directories')
+        return 1
+
+    action = args[0] if len(args) == 1 else None
+
+    if action == 'run':
+        return Server(config.project_root).serve()
+
+    if action == 'start':
+        if ping(config.project_root):
+            log.ok('daemon: already running for {}', config.project_root)
+            return 0
+        return start(config.project_root)
+
+    if action == 'stop':
+        if not ping(config.project_root, {'stop': True}):
+            log.ok('daemon: not running')
+            return 0
+        while ping(config.project_root):
+            time.sleep(0.1)
+        log.ok('daemon: stopped')
+        return 0
+
+    if action == 'status':
+        status = ping(config.project_root)
+        if not status:
+            log.ok('daemon: not running')
+            return 3
+        log.ok('daemon: running with pid {} for {}', status['pid'], status['project_root'])
+        log.ok('daemon: {} commands run, {} running, up for {:.0f}s', status['commands'], status['running'], status['uptime'])
+        return 0
+
+    log.bad('usage: jinjaform daemon start|stop|status|run')
+    return 1
+
+
+def client_main():
+    """
+    The entry point of the jinjaform command, which runs commands in the
+    daemon for the project if there is one, and otherwise runs them
+    in the current process.
+
+    """
+
+    exit_code = request(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+
+    from jinjaform.__main__ import main
+    main()
@@ -0,0 +1,225 @@
+import ast
+import hashlib
+import importlib
+import importlib.machinery
+import importlib.util
+import json
+import os
+import sys
+
+from jinjaform import cache
+from jinjaform.cache import digest
+
+
+kinds = ('context', 'filters', 'tests')
+
+# Extensions are imported as modules of a package with this name and
+# a hash of the project root, so that the "context", "filters" and "tests"
+# directories do not clash with installed packages of the same names.
+package_prefix = '_jinjaform_extensions_'
+
+
+def _get_all_names(source):
+    """
+    Returns the names in the __all__ list of a module without importing
+    it, or None if the list is not made of literal strings.
+
+    """
+
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+
+    names = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, (ast.AugAssign, ast.AnnAssign)):
+            targets = [node.target]
+        else:
+            continue
+        if not any(isinstance(target, ast.Name) and target.id == '__all__' for target in targets):
+            continue
+        try:
+            value = ast.literal_eval(node.value)
+        except ValueError:
+            return None
+        if not isinstance(value, (list, tuple)) or not all(isinstance(name, str) for name in value):
+            return None
+        if isinstance(node, ast.AugAssign):
+            if names is None:
+                return None
+            names = names + list(value)
+        else:
+            names = list(value)
+    return names or []
+
+
+class LazyFunctions(dict):
+    """
+    The filters or tests of a Jinja2 environment, which imports custom
+    ones from the project the first time that they are used.
+
+    """
+
+    def __init__(self, values, registry, kind):
+        super().__init__(values)
+        self._registry = registry
+        self._kind = kind
+
+    def _load(self, name):
+        if not dict.__contains__(self, name) and name in self._registry.names[self._kind]:
+            dict.__setitem__(self, name, self._registry.load(self._kind, name))
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self._registry.names[self._kind]
+
+    def __getitem__(self, name):
+        self._load(name)
+        return dict.__getitem__(self, name)
+
+    def get(self, name, default=None):
+        self._load(name)
+        return dict.get(self, name, default)
+
+
+class Registry(object):
+    """
+    The custom context values, filters and tests in the .jinja directory
+    of a project. The names that each module provides are read from its
+    __all__ list without importing it, and cached along with a hash of
+    the module until it is modified. Modules are only imported when
+    a template uses one of their names.
+
+    """
+
+    version = 1
+
+    def __init__(self, project_root):
+        self.path = os.path.join(project_root, '.jinja')
+        self.package = package_prefix + digest(project_root)[:16]
+
+        # Hashes of the extension source files, so that changes
+        # to them will cause templates to be rendered again.
+        self.files = {}
+
+        # The module providing each name, for each kind of extension.
+        self.names = {kind: {} for kind in kinds}
+
+        self._cache_path = os.path.join(project_root, '.jinjaform', 'cache', 'extensions.json')
+        self._scan()
+
+    def _scan(self):
+        if not os.path.isdir(self.path):
+            return
+
+        previous = {}
+        data = cache.read(self._cache_path)
+        if data:
+            try:
+                previous = json.loads(data.decode('utf-8'))
+            except ValueError:
+                previous = {}
+            if previous.get('version') != self.version:
+                previous = {}
+        previous_files = previous.get('files', {})
+
+        scanned = {}
+        eager = []
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            dir_names[:] = sorted(name for name in dir_names if name != '__pycache__')
+            for name in sorted(file_names):
+                if not name.endswith('.py'):
+                    continue
+
+                path = os.path.join(dir_path, name)
+                relative_path = os.path.relpath(path, self.path)
+                stat = os.stat(path)
+                entry = previous_files.get(relative_path)
+                if not entry or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                    with open(path, 'rb') as open_file:
+                        source = open_file.read()
+                    entry = {
+                        'all': _get_all_names(source),
+                        'mtime': stat.st_mtime_ns,
+                        'sha256': hashlib.sha256(source).hexdigest(),
+                        'size': stat.st_size,
+                    }
+                scanned[relative_path] = entry
+                self.files[relative_path] = entry['sha256']
+
+                # Modules directly in the context, filters and tests
+                # directories provide names, as do packages there.
+                parts = relative_path[:-len('.py')].split(os.sep)
+                if parts[-1] == '__init__':
+                    parts = parts[:-1]
+                if len(parts) != 2 or parts[0] not in kinds:
+                    continue
+                kind, module_name = parts
+                if entry['all'] is None:
+                    eager.append((kind, module_name))
+                else:
+                    for name in entry['all']:
+                        self.names[kind][name] = module_name
+
+        if scanned != previous_files:
+            data = json.dumps({'version': self.version, 'files': scanned}, sort_keys=True)
+            cache.write(self._cache_path, data.encode('utf-8'))
+
+        # Import modules with an __all__ list that could not be read
+        # without running them.
+        for kind, module_name in eager:
+            module = self._import(kind, module_name)
+            for name in getattr(module, '__all__', []):
+                self.names[kind][name] = module_name
+
+    def _import(self, kind, module_name):
+        for package, path in ((self.package, self.path), (self.package + '.' + kind, os.path.join(self.path, kind))):
+            if package not in sys.modules:
+                spec = importlib.machinery.ModuleSpec(package, None, is_package=True)
+                spec.submodule_search_locations = [path]
+                sys.modules[package] = importlib.util.module_from_spec(spec)
+        return importlib.import_module('{}.{}.{}'.format(self.package, kind, module_name))
+
+    def get_context(self, names):
+        """
+        Returns the custom context values with the specified names,
+        importing their modules if necessary.
+
+        """
+
+        return {
+            name: self.load('context', name)
+            for name in names
+            if name in self.names['context']
+        }
+
+    def install(self, env):
+        """
+        Makes the custom filters and tests available in a Jinja2 environment.
+
+        """
+
+        env.filters = LazyFunctions(env.filters, self, 'filters')
+        env.tests = LazyFunctions(env.tests, self, 'tests')
+
+    def load(self, kind, name):
+        """
+        Returns a custom context value, filter or test,
+        importing its module if necessary.
+
+        """
+
+        module = self._import(kind, self.names[kind][name])
+        return getattr(module, name)
+
+    def preload(self):
+        """
+        Imports every extension module.
+
+        """
+
+        for kind in kinds:
+            for name in self.names[kind]:
+                self.load(kind, name)
@@ -0,0 +1,106 @@
+import errno
+import fcntl
+import os
+
+from contextlib import suppress
+
+
+chunk_size = 1024 * 1024
+
+# The Linux ioctl for cloning a file on filesystems that support it,
+# such as Btrfs and XFS, which shares the data until it is modified.
+FICLONE = 0x40049409
+
+# Errors meaning that a method of copying is not supported
+# for these files, so the next method should be tried.
+unsupported_errors = {
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EPERM,
+    errno.EXDEV,
+}
+
+
+def _clone(source_file, destination_file):
+    try:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    except OSError as error:
+        if error.errno in unsupported_errors:
+            return False
+        raise
+    return True
+
+
+def _copy_data(source_fd, destination_fd):
+    """
+    Copies the rest of a file to the end of another. The data is copied
+    by the kernel if possible, otherwise it is read and written in chunks,
+    so large files are never read into memory.
+
+    """
+
+    # Both of these copy from the current positions in the files,
+    # so the next method can continue if one stops working.
+    for kernel_copy in (_copy_file_range, _sendfile):
+        try:
+            while kernel_copy(source_fd, destination_fd):
+                pass
+            return
+        except OSError as error:
+            if error.errno not in unsupported_errors:
+                raise
+
+    while True:
+        chunk = os.read(source_fd, chunk_size)
+        if not chunk:
+            return
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(destination_fd, view):]
+
+
+def _copy_file_range(source_fd, destination_fd):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+    return os.copy_file_range(source_fd, destination_fd, chunk_size)
+
+
+def _sendfile(source_fd, destination_fd):
+    return os.sendfile(destination_fd, source_fd, None, chunk_size)
+
+
+def copy(source_paths, destination_path, mode=None):
+    """
+    Creates a file containing the contents of the source files, in order,
+    as cheaply as possible. A single file is cloned if possible, and files
+    are otherwise copied by the kernel if possible. Files are never hard
+    linked, because writing to a linked file would change the source too.
+    The destination file is replaced atomically. If a mode is specified,
+    it is applied to the new file.
+
+    """
+
+    temp_path = os.path.join(
+        os.path.dirname(destination_path),
+        '.tmp-' + os.path.basename(destination_path),
+    )
+    with suppress(FileNotFoundError):
+        os.remove(temp_path)
+
+    try:
+        with open(temp_path, 'wb') as destination_file:
+            for source_path in source_paths:
+                with open(source_path, 'rb') as source_file:
+                    if len(source_paths) == 1 and _clone(source_file, destination_file):
+                        break
+                    _copy_data(source_file.fileno(), destination_file.fileno())
+        if mode is not None:
+            os.chmod(temp_path, mode)
+        os.replace(temp_path, destination_path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
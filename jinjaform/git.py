@@ -1,9 +1,133 @@
 import os
 import sys
 import subprocess
+import threading
+import time
 
-from jinjaform import log
-from jinjaform.config import cmd
+from jinjaform import cache, config, log
+from jinjaform.cache import digest
+
+
+# Set JINJAFORM_GIT_FETCH_TTL to a number of minutes to skip fetching
+# the upstream branch if it was fetched more recently than that.
+fetch_ttl = float(os.environ.get('JINJAFORM_GIT_FETCH_TTL', 0)) * 60
+
+_lock = threading.Lock()
+_thread = None
+_status = None
+
+
+class Status(object):
+    """
+    The state of the git checkout, read in a single pass.
+
+    """
+
+    def __init__(self):
+        self.branch = None
+        self.upstream = None
+        self.ahead = 0
+        self.behind = 0
+        self.changes = []
+        self.error = None
+
+
+def _git(*args):
+    return subprocess.check_output(
+        ('git',) + args,
+        cwd=config.project_root,
+        stderr=subprocess.STDOUT,
+    ).decode('utf-8')
+
+
+def _fetch_upstream(branch):
+    """
+    Fetches only the upstream branch of the current branch, unless it was
+    fetched within the TTL. A lock is held while fetching so that other
+    processes can use the result instead of fetching it again.
+
+    """
+
+    remote = merge = None
+    prefix = 'branch.{}.'.format(branch)
+    output = _git('config', '--get-regexp', r'^branch\..*\.(remote|merge)$')
+    for line in output.splitlines():
+        name, _, value = line.partition(' ')
+        if name == prefix + 'remote':
+            remote = value
+        elif name == prefix + 'merge':
+            merge = value
+    if not remote or not merge or remote == '.':
+        return
+
+    path = os.path.join(config.jinjaform_root, 'cache', 'git', digest(config.project_root, remote, merge))
+    with cache.lock(path + '.lock'):
+        fetched_time = cache.read(path)
+        if fetch_ttl and fetched_time and time.time() - float(fetched_time) < fetch_ttl:
+            return
+        _git('fetch', '--quiet', remote, merge)
+        cache.write(path, str(time.time()).encode('utf-8'))
+
+
+def _parse_change(line):
+    """
+    Converts a changed file from the porcelain v2 format
+    to the shorter porcelain v1 format.
+
+    """
+
+    kind = line[0]
+    if kind == '1':
+        parts = line.split(' ', 8)
+        return parts[1].replace('.', ' ') + ' ' + parts[8]
+    if kind == '2':
+        parts = line.split(' ', 9)
+        path, original_path = parts[9].split('\t', 1)
+        return parts[1].replace('.', ' ') + ' ' + original_path + ' -> ' + path
+    if kind == 'u':
+        parts = line.split(' ', 10)
+        return parts[1] + ' ' + parts[10]
+    return kind + kind + ' ' + line[2:]
+
+
+def _read_status(remote):
+    """
+    Reads the branch, changed files and upstream state with as few
+    git commands as possible. The upstream branch is fetched first
+    if the remote check is enabled.
+
+    """
+
+    status = Status()
+    try:
+
+        output = _git('status', '--porcelain=v2', '--branch')
+        for line in output.splitlines():
+            if line.startswith('# branch.head '):
+                status.branch = line[len('# branch.head '):]
+                # Show a detached HEAD like "git rev-parse --abbrev-ref HEAD".
+                if status.branch == '(detached)':
+                    status.branch = 'HEAD'
+            elif line.startswith('# branch.upstream '):
+                status.upstream = line[len('# branch.upstream '):]
+            elif line.startswith('# branch.ab '):
+                ahead, behind = line[len('# branch.ab '):].split()
+                status.ahead = int(ahead)
+                status.behind = -int(behind)
+            elif not line.startswith('#'):
+                status.changes.append(_parse_change(line))
+
+        if remote and status.upstream:
+            _fetch_upstream(status.branch)
+            output = _git('rev-list', '--left-right', '--count', 'HEAD...@{upstream}')
+            ahead, behind = output.split()
+            status.ahead = int(ahead)
+            status.behind = int(behind)
+
+    except subprocess.CalledProcessError as error:
+        status.error = error.output.rstrip().decode('utf-8')
+
+    return status
 
 
 def abort():
@@ -17,55 +141,90 @@ def abort():
 
 def check_branch(desired):
 
-    if cmd != 'apply':
+    if config.cmd != 'apply':
         return
 
-    branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD']).rstrip().decode('utf-8')
-    if branch != desired:
-        log.bad('git: working in branch {}', branch)
+    status = get_status()
+    if status.error:
+        log.bad('git: {}', status.error)
+        abort()
+    elif status.branch != desired:
+        log.bad('git: working in branch {}', status.branch)
         log.bad('git: should be in branch {}', desired)
         abort()
 
 
 def check_clean():
 
-    if cmd != 'apply':
+    if config.cmd != 'apply':
         return
 
-    diff = subprocess.check_output(['git', 'status', '--porcelain']).rstrip().decode('utf-8')
-    if diff:
+    status = get_status()
+    if status.error:
+        log.bad('git: {}', status.error)
+        abort()
+    elif status.changes:
         log.bad('git: working directory not clean')
-        for line in diff.splitlines():
+        for line in status.changes:
             log.bad('git: {}', line)
         abort()
 
 
 def check_remote():
 
-    if cmd != 'apply':
+    if config.cmd != 'apply':
         return
 
     log.ok('git: checking remote')
-    subprocess.check_output(['git', 'remote', 'update'])
-    local = subprocess.check_output(['git', 'rev-parse', 'HEAD']).rstrip().decode('utf-8')
-
-    try:
-        remote = subprocess.check_output(
-            ['git', 'rev-parse', '@{upstream}'],
-            stderr=subprocess.STDOUT,
-        ).rstrip().decode('utf-8')
-    except subprocess.CalledProcessError as error:
-        # There may not be any upstream configured for the branch.
-        output = error.output.rstrip().decode('utf-8')
-        log.bad('git: {}', output)
+    status = get_status()
+    if status.error:
+        log.bad('git: {}', status.error)
         abort()
-    else:
-        if local != remote:
-            status = subprocess.check_output(['git', 'status']).rstrip().decode('utf-8')
-            for line in status.splitlines():
-                if 'branch' in line and ('ahead' in line or 'behind' in line):
-                    log.bad('git: {}', line.lower())
-                    break
-            else:
-                log.bad('git: out of date')
-            abort()
+    elif not status.upstream:
+        log.bad('git: no upstream configured for branch {}', status.branch)
+        abort()
+    elif status.ahead and status.behind:
+        log.bad('git: branch and {} have diverged, with {} and {} different commits', status.upstream, status.ahead, status.behind)
+        abort()
+    elif status.ahead:
+        log.bad('git: branch is ahead of {} by {} commits', status.upstream, status.ahead)
+        abort()
+    elif status.behind:
+        log.bad('git: branch is behind {} by {} commits', status.upstream, status.behind)
+        abort()
+
+
+def get_status():
+    """
+    Returns the state of the git checkout, waiting for it
+    if it is being read in the background.
+
+    """
+
+    start(remote=True)
+    _thread.join()
+    return _status
+
+
+def start(remote):
+    """
+    Starts reading the state of the git checkout in a background thread,
+    so that it can happen while the .jinjaformrc commands before the
+    first check run. This only happens once, and the result is shared
+    by the checks and by stacks forked after it has finished.
+
+    """
+
+    global _thread
+
+    if config.cmd != 'apply':
+        return
+
+    def read():
+        global _status
+        _status = _read_status(remote)
+
+    with _lock:
+        if _thread is None:
+            _thread = threading.Thread(target=read, daemon=True)
+            _thread.start()
@@ -0,0 +1,232 @@
+import json
+import os
+import subprocess
+import sys
+
+from jinjaform import cache, config, log
+
+
+index_name = 'index.json'
+
+
+class Index(object):
+    """
+    A persistent index of the directories and files in the project.
+    Each directory's listing is reused while its inode and modification
+    time are unchanged, which is the case unless entries were added,
+    removed or renamed, so walking the project only needs to stat each
+    directory rather than list it.
+
+    """
+
+    version = 1
+
+    def __init__(self, root):
+        self.root = root
+        self._path = os.path.join(root, '.jinjaform', index_name)
+        self._previous = {}
+        self._dirs = {}
+        data = cache.read(self._path)
+        if data:
+            try:
+                data = json.loads(data.decode('utf-8'))
+            except ValueError:
+                data = {}
+            if data.get('version') == self.version:
+                self._previous = data['dirs']
+
+    def _list(self, path):
+        """
+        Returns the subdirectories and files in a directory, excluding
+        hidden ones. Symlinks to directories are not included.
+
+        """
+
+        relative_path = os.path.relpath(path, self.root)
+        entry = self._dirs.get(relative_path)
+        if entry:
+            return entry
+
+        stat = os.stat(path)
+        entry = self._previous.get(relative_path)
+        if not entry or entry['ino'] != stat.st_ino or entry['mtime'] != stat.st_mtime_ns:
+            dirs = []
+            files = []
+            for dir_entry in os.scandir(path):
+                if dir_entry.name.startswith('.'):
+                    continue
+                if dir_entry.is_dir(follow_symlinks=False):
+                    dirs.append(dir_entry.name)
+                elif not dir_entry.is_dir():
+                    files.append(dir_entry.name)
+            entry = {
+                'ino': stat.st_ino,
+                'mtime': stat.st_mtime_ns,
+                'dirs': sorted(dirs),
+                'files': sorted(files),
+            }
+
+        self._dirs[relative_path] = entry
+        return entry
+
+    def save(self):
+        """
+        Saves the directories that were listed, along with previously
+        indexed directories that were not visited this time.
+
+        """
+
+        dirs = dict(self._previous, **self._dirs)
+        data = json.dumps({'version': self.version, 'dirs': dirs}, sort_keys=True)
+        cache.write(self._path, data.encode('utf-8'))
+
+    def walk(self, path):
+        """
+        Yields the directory path, subdirectory names and file names
+        for every directory under a path, like os.walk. Subdirectory
+        names can be removed to skip them.
+
+        """
+
+        entry = self._list(path)
+        dir_names = list(entry['dirs'])
+        yield path, dir_names, entry['files']
+        for name in dir_names:
+            yield from self.walk(os.path.join(path, name))
+
+
+def find_stacks(path):
+    """
+    Returns the stack directories under a path, which are directories
+    containing Terraform files without any stacks below them. Files in
+    directories with stacks below them are shared by those stacks.
+    Hidden directories and directories named "modules" are skipped.
+
+    """
+
+    project_index = Index(config.project_root)
+    found = []
+    for dir_path, dir_names, file_names in project_index.walk(path):
+        dir_names[:] = [name for name in dir_names if name != 'modules']
+        if dir_path == config.project_root:
+            continue
+        for name in file_names:
+            if name.lower().endswith(('.tf', '.tfvars')):
+                found.append(dir_path)
+                break
+    project_index.save()
+
+    # Directories are walked in order, so any directories
+    # below a directory are found straight after it.
+    stacks = []
+    for position, dir_path in enumerate(found):
+        next_path = found[position + 1] if position + 1 < len(found) else ''
+        if not next_path.startswith(dir_path + '/'):
+            stacks.append(dir_path)
+    return stacks
+
+
+def get_changed_paths(since):
+    """
+    Returns the absolute paths of files that have changed since a git
+    reference, including uncommitted and untracked files.
+
+    """
+
+    top_level = subprocess.check_output(
+        ['git', 'rev-parse', '--show-toplevel'],
+        cwd=config.project_root,
+    ).decode('utf-8').rstrip('\n')
+
+    changed = set()
+    for command in (
+        ['git', 'diff', '--name-only', '--no-renames', '-z', since, '--'],
+        ['git', 'ls-files', '--others', '--exclude-standard', '-z'],
+    ):
+        output = subprocess.check_output(command, cwd=top_level).decode('utf-8')
+        for name in output.split('\0'):
+            if name:
+                changed.add(os.path.join(top_level, name))
+    return changed
+
+
+def get_affected_stacks(stacks, changed_paths):
+    """
+    Returns the stacks which are affected by changed files. A stack is
+    built from the files in its directory and every parent directory up
+    to the project root, so a change to one of those files affects it,
+    as does a change in its subdirectories, which templates can read.
+    Changes to custom Jinja extensions or the .jinjaformrc file affect
+    every stack, and changes in a "modules" directory affect every stack
+    in the directory containing it, as they may use the modules.
+
+    """
+
+    root = config.project_root
+    shared_dirs = set()
+    for path in changed_paths:
+        if not (path + '/').startswith(root + '/'):
+            continue
+        parts = os.path.relpath(path, root).split(os.sep)
+        if parts[0] in ('.jinja', '.jinjaformrc'):
+            return list(stacks)
+        if any(part.startswith('.') for part in parts):
+            continue
+        if 'modules' in parts[:-1]:
+            parts = parts[:parts.index('modules')]
+        else:
+            parts = parts[:-1]
+        shared_dirs.add(os.path.join(root, *parts))
+
+    affected = []
+    for stack in stacks:
+        if any(path.startswith(stack + '/') for path in shared_dirs):
+            affected.append(stack)
+            continue
+        current = stack
+        while (current + '/').startswith(root + '/'):
+            if current in shared_dirs:
+                affected.append(stack)
+                break
+            current = os.path.dirname(current)
+    return affected
+
+
+def main(args):
+    """
+    Runs the "jinjaform affected" command, which lists the stacks under
+    the current directory that are affected by changes since a git
+    reference. Returns an exit code.
+
+    """
+
+    since = None
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg.startswith('--since='):
+            since = arg[len('--since='):]
+        elif arg == '--since' and args:
+            since = args.pop(0)
+        else:
+            log.bad('affected: unknown argument {}', arg)
+            return 1
+
+    if not since:
+        log.bad('usage: jinjaform affected --since <git-ref>')
+        return 1
+
+    if not config.project_root:
+        log.bad('could not find .jinjaformrc file in current or parent directories')
+        return 1
+
+    try:
+        changed_paths = get_changed_paths(since)
+    except subprocess.CalledProcessError:
+        return 1
+
+    stacks = find_stacks(config.cwd)
+    for stack in get_affected_stacks(stacks, changed_paths):
+        print(os.path.relpath(stack, config.cwd))
+    sys.stdout.flush()
+    return 0
@@ -1,4 +1,20 @@
 import colorama
+import sys
+import threading
+
+from contextlib import contextmanager
+from getpass import getpass
+
+
+# Only one prompt can be shown at a time,
+# when steps are running at the same time.
+prompt_lock = threading.RLock()
+
+# This is False when prompts cannot be answered,
+# such as when running multiple stacks at the same time.
+interactive = True
+
+_local = threading.local()
 
 
 def init(_cache=[]):
@@ -10,14 +26,16 @@ def init(_cache=[]):
 def accept(question, *args, **kwargs):
     if args or kwargs:
         question = question.format(*args, **kwargs)
-    question = '[jinjaform] ' + question + ' [yes/no]: '
+    check_interactive(question)
+    question = get_prefix() + '[jinjaform] ' + question + ' [yes/no]: '
     answer = ''
-    while answer not in ('yes', 'no'):
-        try:
-            answer = input(question).lower()
-        except KeyboardInterrupt:
-            answer = 'no'
-            print()
+    with prompt_lock:
+        while answer not in ('yes', 'no'):
+            try:
+                answer = input(question).lower()
+            except (EOFError, KeyboardInterrupt):
+                answer = 'no'
+                print()
     return answer == 'yes'
 
 
@@ -28,8 +46,67 @@ def bad(message, *args, **kwargs):
     print(colorama.Fore.RED + '[jinjaform] ' + message + colorama.Style.RESET_ALL)
 
 
+def check_interactive(question):
+    """
+    Exits with an error if a question cannot be answered, rather than
+    continuing as though it was answered with no.
+
+    """
+
+    if not interactive:
+        bad('cannot ask "{}" when running stacks in parallel, run it with -j 1', question.strip().rstrip(':'))
+        sys.exit(1)
+
+
+def reset():
+    """
+    Stops wrapping the output streams so that they can be replaced.
+    They are wrapped again when next used.
+
+    """
+
+    colorama.deinit()
+    init.__defaults__[0].clear()
+
+
+def get_prefix():
+    """
+    Returns the prefix for output from the current thread.
+
+    """
+
+    return getattr(_local, 'prefix', '')
+
+
 def ok(message, *args, **kwargs):
     init()
     if args or kwargs:
         message = message.format(*args, **kwargs)
     print(colorama.Fore.CYAN + '[jinjaform] ' + message + colorama.Style.RESET_ALL)
+
+
+def secret(prompt):
+    """
+    Prompts for a value without showing it, such as an MFA token.
+
+    """
+
+    check_interactive(prompt)
+    with prompt_lock:
+        return getpass(prompt)
+
+
+@contextmanager
+def prefix(label):
+    """
+    Sets the label for output from the current thread, which is added
+    to the start of each line while steps are running at the same time,
+    so that their output can be told apart.
+
+    """
+
+    _local.prefix = '[{}] '.format(label)
+    try:
+        yield
+    finally:
+        _local.prefix = ''
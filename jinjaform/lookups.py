@@ -0,0 +1,311 @@
+import asyncio
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+
+from jinjaform import aws, trace
+
+
+# Lookups made by templates within this many milliseconds of each other
+# are combined into one AWS API request.
+batch_window = int(os.environ.get('JINJAFORM_AWS_BATCH_WINDOW', 20)) / 1000
+
+# EC2 resource types that can be looked up by ID, with the describe
+# operation, the filter for IDs, and the response keys for the results.
+ec2_resources = {
+    'image': ('describe_images', 'image-id', 'Images', 'ImageId'),
+    'instance': ('describe_instances', 'instance-id', 'Instances', 'InstanceId'),
+    'security_group': ('describe_security_groups', 'group-id', 'SecurityGroups', 'GroupId'),
+    'subnet': ('describe_subnets', 'subnet-id', 'Subnets', 'SubnetId'),
+    'volume': ('describe_volumes', 'volume-id', 'Volumes', 'VolumeId'),
+    'vpc': ('describe_vpcs', 'vpc-id', 'Vpcs', 'VpcId'),
+}
+
+_lock = threading.Lock()
+_batchers = {}
+
+
+class Batcher(object):
+    """
+    Collects lookups from templates rendering in different threads, and
+    fetches them together with one request per batch. A batch is fetched
+    when the batch window has passed since its first lookup, or straight
+    away when it is full. Each lookup waits for the result of its batch.
+    Results are kept for the rest of the run, so repeated lookups
+    do not make more requests.
+
+    """
+
+    def __init__(self, fetch, max_size):
+        self._fetch = fetch
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._pending = []
+        self._timer = None
+
+    def _take(self):
+        # Must be called with the lock held.
+        batch = self._pending
+        self._pending = []
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _flush(self, batch=None):
+        if batch is None:
+            with self._lock:
+                batch = self._take()
+        if not batch:
+            return
+        with self._lock:
+            futures = {key: self._futures[key] for key in batch}
+        error = None
+        try:
+            results = self._fetch(batch)
+        except BaseException as fetch_error:
+            error = fetch_error
+            results = dict.fromkeys(batch, error)
+        with self._lock:
+            for key in batch:
+                result = results.get(key)
+                if isinstance(result, BaseException) and not isinstance(result, LookupError):
+                    del self._futures[key]
+        for key in batch:
+            result = results.get(key)
+            if isinstance(result, BaseException):
+                futures[key].set_exception(result)
+            else:
+                futures[key].set_result(result)
+        if error is not None and not isinstance(error, Exception):
+            raise error
+
+    def get(self, key):
+        """
+        Returns the result for a key, waiting for its batch to be fetched.
+        When called from an event loop, such as by templates rendered with
+        the async engine, it returns an awaitable instead, which Jinja2
+        awaits automatically, so that other templates on the same loop
+        can add lookups to the batch while it waits.
+
+        """
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        batch = None
+        with self._lock:
+            future = self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = Future()
+                self._pending.append(key)
+                if len(self._pending) >= self._max_size:
+                    # Take the full batch now, so that
+                    # no more lookups are added to it.
+                    batch = self._take()
+                elif not self._timer:
+                    self._timer = threading.Timer(batch_window, self._flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if loop:
+            if batch:
+                loop.run_in_executor(None, self._flush, batch)
+            return asyncio.wrap_future(future, loop=loop)
+        if batch:
+            self._flush(batch)
+        return future.result()
+
+
+def _get_batcher(name, session_kwargs, options, create_fetch, max_size):
+    """
+    Returns the batcher for an operation, using a session
+    created from the specified arguments.
+
+    """
+
+    session = aws.get_session(**session_kwargs)
+    key = (name, session, options)
+    with _lock:
+        batcher = _batchers.get(key)
+        if not batcher:
+            batcher = _batchers[key] = Batcher(create_fetch(session), max_size)
+    return batcher
+
+
+def _get_parameters_fetcher(with_decryption):
+
+    def create_fetch(session):
+        client = aws.get_client(session, 'ssm')
+
+        def fetch(names):
+            start_time = time.time()
+            response = client.get_parameters(Names=names, WithDecryption=with_decryption)
+            trace.add_span('aws batch', start_time, time.time(), operation='ssm:GetParameters', size=len(names))
+
+            # Parameters can be requested by name or ARN,
+            # with a version or label selector.
+            found = {}
+            for parameter in response['Parameters']:
+                for name in (parameter['Name'], parameter.get('ARN')):
+                    if name:
+                        found[name + parameter.get('Selector', '')] = parameter['Value']
+            results = {}
+            for name in names:
+                if name in found:
+                    results[name] = found[name]
+                else:
+                    results[name] = LookupError('SSM parameter not found: {}'.format(name))
+            return results
+
+        return fetch
+
+    return create_fetch
+
+
+def _get_value(secret):
+    if 'SecretString' in secret:
+        return secret['SecretString']
+    return secret['SecretBinary']
+
+
+def _get_secrets_fetcher():
+
+    def create_fetch(session):
+        client = aws.get_client(session, 'secretsmanager')
+
+        def fetch(secret_ids):
+            start_time = time.time()
+            results = {}
+
+            # Older versions of botocore do not have BatchGetSecretValue.
+            if not hasattr(client, 'batch_get_secret_value'):
+                for secret_id in secret_ids:
+                    try:
+                        results[secret_id] = _get_value(client.get_secret_value(SecretId=secret_id))
+                    except client.exceptions.ResourceNotFoundException:
+                        results[secret_id] = LookupError('secret not found: {}'.format(secret_id))
+                trace.add_span('aws batch', start_time, time.time(), operation='secretsmanager:GetSecretValue', size=len(secret_ids))
+                return results
+
+            secrets = []
+            errors = {}
+            kwargs = {'SecretIdList': secret_ids}
+            while True:
+                response = client.batch_get_secret_value(**kwargs)
+                secrets.extend(response.get('SecretValues', []))
+                for error in response.get('Errors', []):
+                    errors[error['SecretId']] = error
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+            trace.add_span('aws batch', start_time, time.time(), operation='secretsmanager:BatchGetSecretValue', size=len(secret_ids))
+
+            # Secrets can be requested by name, ARN, or partial ARN
+            # without the random suffix.
+            for secret_id in secret_ids:
+                for secret in secrets:
+                    if secret_id in (secret['Name'], secret['ARN']) or secret['ARN'].startswith(secret_id + '-'):
+                        results[secret_id] = _get_value(secret)
+                        break
+                else:
+                    error = errors.get(secret_id)
+                    if error:
+                        message = '{}: {}'.format(error.get('ErrorCode'), error.get('Message'))
+                    else:
+                        message = 'secret not found: {}'.format(secret_id)
+                    results[secret_id] = LookupError(message)
+            return results
+
+        return fetch
+
+    return create_fetch
+
+
+def _get_ec2_fetcher(resource_type):
+    operation, filter_name, result_key, id_key = ec2_resources[resource_type]
+
+    def create_fetch(session):
+        client = aws.get_client(session, 'ec2')
+
+        def fetch(resource_ids):
+            start_time = time.time()
+
+            # Filters are used instead of IDs, because requesting
+            # an ID that does not exist fails the whole request.
+            kwargs = {'Filters': [{'Name': filter_name, 'Values': resource_ids}]}
+            if client.can_paginate(operation):
+                pages = client.get_paginator(operation).paginate(**kwargs)
+            else:
+                pages = [getattr(client, operation)(**kwargs)]
+
+            found = {}
+            for page in pages:
+                if result_key == 'Instances':
+                    items = [item for reservation in page['Reservations'] for item in reservation['Instances']]
+                else:
+                    items = page[result_key]
+                for item in items:
+                    found[item[id_key]] = item
+            trace.add_span('aws batch', start_time, time.time(), operation='ec2:' + operation, size=len(resource_ids))
+
+            results = {}
+            for resource_id in resource_ids:
+                if resource_id in found:
+                    results[resource_id] = found[resource_id]
+                else:
+                    results[resource_id] = LookupError('{} not found: {}'.format(resource_type.replace('_', ' '), resource_id))
+            return results
+
+        return fetch
+
+    return create_fetch
+
+
+def ssm_parameter(name, decrypt=True, **session_kwargs):
+    """
+    Returns the value of an SSM parameter. Parameters looked up by
+    templates at the same time are fetched with GetParameters,
+    up to 10 at a time.
+
+    Usage: {{ aws.ssm_parameter('/app/name', region_name='eu-west-1') }}
+
+    """
+
+    batcher = _get_batcher('ssm_parameter', session_kwargs, bool(decrypt), _get_parameters_fetcher(bool(decrypt)), 10)
+    return batcher.get(name)
+
+
+def secret(secret_id, **session_kwargs):
+    """
+    Returns the current value of a Secrets Manager secret. Secrets looked
+    up by templates at the same time are fetched with BatchGetSecretValue,
+    up to 20 at a time.
+
+    Usage: {{ aws.secret('app/password', region_name='eu-west-1') }}
+
+    """
+
+    batcher = _get_batcher('secret', session_kwargs, None, _get_secrets_fetcher(), 20)
+    return batcher.get(secret_id)
+
+
+def ec2(resource_type, resource_id, **session_kwargs):
+    """
+    Returns the description of an EC2 resource, which can be an image,
+    instance, security_group, subnet, volume or vpc. Resources of the same
+    type looked up by templates at the same time are fetched with one
+    describe request, filtered by up to 200 IDs at a time.
+
+    Usage: {{ aws.ec2('vpc', 'vpc-0123456789abcdef0', region_name='eu-west-1').CidrBlock }}
+
+    """
+
+    if resource_type not in ec2_resources:
+        raise ValueError('unsupported EC2 resource type: {}'.format(resource_type))
+    batcher = _get_batcher('ec2', session_kwargs, resource_type, _get_ec2_fetcher(resource_type), 200)
+    return batcher.get(resource_id)
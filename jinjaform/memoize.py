@@ -0,0 +1,247 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+from contextlib import suppress
+from functools import wraps
+
+from jinjaform import cache, config, log, trace
+
+
+# Results stored on disk are kept within this size limit,
+# removing the least recently used results first.
+max_size = int(os.environ.get('JINJAFORM_CONTEXT_CACHE_SIZE', 64)) * 1024 * 1024
+
+version = 1
+
+_lock = threading.Lock()
+
+# Results and expiry times for calls made by this process,
+# and futures for calls that are still running.
+_results = {}
+_running = {}
+
+_stats = {
+    'hits': 0,
+    'disk_hits': 0,
+    'misses': 0,
+    'waits': 0,
+}
+_saved = [False]
+
+
+def _get_cache_dir():
+    return os.path.join(config.jinjaform_root, 'cache', 'context')
+
+
+def _get_key(*values):
+    """
+    Returns a cache key for JSON-serialisable values. Other values are
+    rejected rather than using their repr(), which can be the same for
+    objects that give different results, such as boto3 sessions for
+    different AWS accounts, or contain memory addresses.
+
+    """
+
+    try:
+        data = json.dumps(values, sort_keys=True)
+    except (TypeError, ValueError) as error:
+        raise TypeError('cached call arguments must be JSON-serialisable, or use @cached(key=...): {}'.format(error))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def _load(path):
+    """
+    Returns the result stored on disk at a path and its expiry time,
+    or None if it is missing or has expired.
+
+    """
+
+    data = cache.read(path)
+    if data:
+        with suppress(KeyError, TypeError, ValueError):
+            entry = json.loads(data.decode('utf-8'))
+            if entry['expires'] > time.time():
+                return entry['value'], entry['expires']
+    return None
+
+
+def _save(path, value, expires):
+    """
+    Stores a result on disk. Results that cannot be stored
+    as JSON are only kept in memory.
+
+    """
+
+    try:
+        data = json.dumps({'expires': expires, 'value': value}, sort_keys=True)
+    except (TypeError, ValueError):
+        return
+    cache.write(path, data.encode('utf-8'))
+    _saved[0] = True
+
+
+def _call(key, func, args, kwargs, ttl, persist):
+    """
+    Returns the result of a function call, reusing the result of a
+    previous call with the same key if it has not expired. Only one
+    thread runs the function for each key while others wait for its
+    result. Persistent results are also stored on disk, and a lock is
+    held while running the function so that other processes wait for
+    the result rather than running it too.
+
+    """
+
+    start_time = time.time()
+    with _lock:
+        result = _results.get(key)
+        if result and (result[1] is None or result[1] > start_time):
+            _stats['hits'] += 1
+            trace.add_span('cache hit', start_time, time.time())
+            return result[0]
+        future = _running.get(key)
+        running = future is None
+        if running:
+            future = _running[key] = Future()
+        else:
+            _stats['waits'] += 1
+
+    if not running:
+        try:
+            return future.result()
+        finally:
+            trace.add_span('cache wait', start_time, time.time())
+
+    try:
+        if persist:
+            path = os.path.join(_get_cache_dir(), key)
+            with cache.lock(os.path.join(_get_cache_dir(), '.' + key + '.lock')):
+                stored = _load(path)
+                if stored:
+                    value, expires = stored
+                    outcome = 'disk_hits'
+                else:
+                    value = func(*args, **kwargs)
+                    expires = time.time() + ttl
+                    _save(path, value, expires)
+                    outcome = 'misses'
+        else:
+            value = func(*args, **kwargs)
+            expires = time.time() + ttl if ttl is not None else None
+            outcome = 'misses'
+    except BaseException as error:
+        with _lock:
+            del _running[key]
+        future.set_exception(error)
+        raise
+
+    with _lock:
+        _results[key] = (value, expires)
+        del _running[key]
+        _stats[outcome] += 1
+    future.set_result(value)
+    trace.add_span('cache disk hit' if outcome == 'disk_hits' else 'cache miss', start_time, time.time())
+    return value
+
+
+def cached(ttl=None, persist=None, key=None):
+    """
+    Decorator for functions in custom extensions which caches their
+    results by the function name and arguments. Calls with the same
+    arguments made at the same time, from templates rendered in different
+    threads, share one call. Results are kept for the rest of the run,
+    or for `ttl` seconds when specified, in which case they are also
+    stored on disk and reused by later runs. Use `persist=False` to keep
+    them in memory only. Stored results must be JSON-serialisable,
+    and are returned as they were decoded from JSON.
+
+    Arguments are converted to JSON for the cache key, and calls with
+    other arguments, such as AWS sessions, raise a TypeError. Provide
+    a `key` function, which receives the same arguments and returns
+    a JSON-serialisable value, to cache these calls.
+
+    """
+
+    if persist is None:
+        persist = ttl is not None
+    if persist and ttl is None:
+        raise ValueError('a ttl is required to store results on disk')
+
+    def decorator(func):
+        name = '{}.{}'.format(func.__module__, func.__qualname__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key_value = key(*args, **kwargs) if key else (args, kwargs)
+            call_key = _get_key(version, name, key_value)
+            return _call(call_key, func, args, kwargs, ttl, persist)
+
+        return wrapper
+
+    return decorator
+
+
+def call(func, *args, **kwargs):
+    """
+    Calls a function and caches the result for the rest of the run,
+    with calls from other threads using the same arguments sharing it.
+    This is available in templates as `cached(func, *args, **kwargs)`.
+    The arguments must be JSON-serialisable.
+
+    """
+
+    return _call((func, _get_key(args, kwargs)), func, args, kwargs, None, False)
+
+
+def evict():
+    """
+    Removes the least recently used results from disk
+    if the cache has grown beyond its size limit.
+
+    """
+
+    if _saved[0]:
+        cache.evict(_get_cache_dir(), max_size)
+
+
+def merge(counts, saved):
+    """
+    Adds the counts of calls made by another process, such as a worker
+    process rendering templates, and whether it stored results on disk,
+    so that they are included in the report and eviction.
+
+    """
+
+    with _lock:
+        for name, count in counts.items():
+            _stats[name] += count
+        if saved:
+            _saved[0] = True
+
+
+def report():
+    """
+    Shows how many calls to cached functions were made,
+    if there were any.
+
+    """
+
+    counts = stats()
+    if any(counts.values()):
+        log.ok('cached: {hits} hits, {disk_hits} from disk, {misses} misses, {waits} waits', **counts)
+
+
+def stats():
+    """
+    Returns the number of calls, including those made by worker processes
+    rendering templates, that used a result from memory ("hits"),
+    used a result from disk ("disk_hits"), ran the function ("misses"),
+    or waited for another thread running it ("waits").
+
+    """
+
+    with _lock:
+        return dict(_stats)
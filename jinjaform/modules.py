@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import shutil
+
+from contextlib import suppress
+
+from jinjaform import cache, config, log
+
+
+manifest_name = 'modules.json'
+
+update_args = ('-update', '-update=true', '-upgrade', '-upgrade=true')
+
+# Version control metadata left in module directories by go-getter, which
+# differs between identical checkouts, e.g. timestamps in .git/index.
+vcs_dirs = ('.bzr', '.git', '.hg', '.svn')
+
+
+def get_store_dir():
+    return os.path.join(config.jinjaform_root, 'modules')
+
+
+def get_modules_dir():
+    return os.path.join(config.terraform_dir, 'modules')
+
+
+def _get_index_path(source):
+    return os.path.join(get_store_dir(), 'index', cache.digest(source) + '.json')
+
+
+def _get_tree_path(tree):
+    return os.path.join(get_store_dir(), 'trees', tree)
+
+
+def _get_lock_path(*names):
+    return os.path.join(config.jinjaform_root, 'cache', 'modules', *names) + '.lock'
+
+
+def _is_local(source):
+    return source.startswith(('./', '../', '/'))
+
+
+def _read_json(path):
+    data = cache.read(path)
+    if data:
+        with suppress(ValueError):
+            return json.loads(data.decode('utf-8'))
+    return None
+
+
+def _hash_tree(path):
+    """
+    Returns a digest of the names, contents and permissions
+    of the files in a directory tree. Version control metadata
+    is not included, so identical checkouts have the same digest.
+
+    """
+
+    tree_hash = hashlib.sha256()
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names[:] = sorted(name for name in dir_names if name not in vcs_dirs)
+        for name in sorted(dir_names + file_names):
+            file_path = os.path.join(dir_path, name)
+            relative_path = os.path.relpath(file_path, path)
+            if os.path.islink(file_path):
+                tree_hash.update(b'link\0' + relative_path.encode('utf-8') + b'\0' + os.readlink(file_path).encode('utf-8') + b'\0')
+            elif name in file_names:
+                executable = os.access(file_path, os.X_OK)
+                tree_hash.update(b'file\0' + relative_path.encode('utf-8') + (b'\0x\0' if executable else b'\0\0'))
+                file_hash = hashlib.sha256()
+                with open(file_path, 'rb') as open_file:
+                    for chunk in iter(lambda: open_file.read(1024 * 1024), b''):
+                        file_hash.update(chunk)
+                tree_hash.update(file_hash.digest())
+            else:
+                tree_hash.update(b'dir\0' + relative_path.encode('utf-8') + b'\0')
+    return tree_hash.hexdigest()
+
+
+def _get_module_calls():
+    """
+    Returns the names, sources and version constraints of the modules
+    called by the rendered Terraform files in the workspace.
+    Modules using expressions for these values are not included.
+
+    """
+
+    from jinjaform import scanner
+
+    calls = {}
+    for name in sorted(os.listdir(config.workspace_dir)):
+        if not name.endswith('.tf'):
+            continue
+        with open(os.path.join(config.workspace_dir, name)) as open_file:
+            items = scanner.scan(open_file.read(), types=('module',))
+        for item in items:
+            if isinstance(item, scanner.Block) and item.type == 'module' and item.labels:
+                attributes = item.attributes()
+                source = attributes.get('source')
+                version = attributes.get('version')
+                if isinstance(source, str) and not isinstance(source, scanner.Expression) and not _is_local(source):
+                    if version is None or (isinstance(version, str) and not isinstance(version, scanner.Expression)):
+                        calls[item.labels[0]] = (source, version)
+    return calls
+
+
+def _select_version(versions, constraints):
+    """
+    Returns the newest stored version of a module that satisfies
+    the version constraints of a module call, or None.
+
+    """
+
+    from jinjaform import plugins
+
+    if not constraints:
+        return '' if '' in versions else None
+
+    candidates = []
+    for version in versions:
+        if version:
+            with suppress(ValueError):
+                if plugins.matches(version, constraints):
+                    candidates.append(version)
+    if candidates:
+        return max(candidates, key=lambda version: plugins.parse_version(version)[0])
+    return None
+
+
+def _seed(modules_dir):
+    """
+    Adds modules from the store to the Terraform module manifest of the
+    workspace, so that "terraform init" and "terraform get" use them
+    instead of downloading them again. This is only done for root module
+    calls, and only with the module manifest format where module
+    directories are named after their keys (Terraform 0.12 and later).
+
+    """
+
+    manifest_path = os.path.join(modules_dir, manifest_name)
+    manifest = _read_json(manifest_path) or {'Modules': [{'Key': '', 'Source': '', 'Dir': '.'}]}
+
+    # Forget modules whose directories no longer exist,
+    # so that Terraform downloads them again.
+    entries = manifest.get('Modules', [])
+    manifest['Modules'] = [
+        entry for entry in entries
+        if not entry.get('Key') or os.path.exists(os.path.join(config.workspace_dir, entry.get('Dir', '')))
+    ]
+    changed = len(manifest['Modules']) != len(entries)
+    recorded = {entry.get('Key') for entry in manifest['Modules']}
+
+    for name, (source, constraints) in sorted(_get_module_calls().items()):
+
+        if name in recorded:
+            continue
+
+        index = _read_json(_get_index_path(source))
+        if not index:
+            continue
+        version = _select_version(index['versions'], constraints)
+        if version is None:
+            continue
+        stored = index['versions'][version]
+        tree_path = _get_tree_path(stored['tree'])
+        if not stored.get('named_by_key') or not os.path.isdir(tree_path):
+            continue
+
+        path = os.path.join(modules_dir, name)
+        if os.path.lexists(path):
+            continue
+        os.symlink(tree_path, path)
+
+        entry = {'Key': name, 'Source': source, 'Dir': os.path.join('.terraform', 'modules', name)}
+        if version:
+            entry['Version'] = version
+        manifest['Modules'].append(entry)
+        changed = True
+        log.ok('module: {} from store', name)
+
+    if changed:
+        cache.write(manifest_path, json.dumps(manifest, indent=2).encode('utf-8'))
+
+
+def prepare():
+    """
+    Creates the modules directory in the workspace. Each workspace has its
+    own module manifest, so that stacks do not overwrite each other's
+    manifests, and modules are symlinked from the shared module store.
+
+    """
+
+    modules_dir = get_modules_dir()
+
+    # Previous versions used one modules directory for every stack.
+    if os.path.islink(modules_dir):
+        os.remove(modules_dir)
+    os.makedirs(modules_dir, exist_ok=True)
+
+    # Remove symlinks to module trees that no longer exist,
+    # so that Terraform downloads them again.
+    for entry in os.scandir(modules_dir):
+        if entry.is_symlink() and not os.path.exists(entry.path):
+            os.remove(entry.path)
+
+    _seed(modules_dir)
+
+
+def before_terraform(args):
+    """
+    Prepares the modules directory for a Terraform command. When updating
+    modules, the symlinks to the store are removed first, so that Terraform
+    downloads modules into new directories rather than changing the trees
+    in the store which other stacks are using.
+
+    """
+
+    if not args or args[0] not in ('get', 'init') or not set(args) & set(update_args):
+        return
+
+    modules_dir = get_modules_dir()
+    if os.path.isdir(modules_dir):
+        for entry in os.scandir(modules_dir):
+            if entry.is_symlink():
+                os.remove(entry.path)
+
+
+def store(args):
+    """
+    Moves modules downloaded by Terraform into the shared module store,
+    and replaces them with symlinks. Module trees are stored by the digest
+    of their contents, so identical modules used by many stacks are only
+    stored once, and an index records the tree for each module source
+    and version. Stored trees are never changed. Locks are held while
+    moving modules into the store, so this is safe to run in many
+    stacks at the same time.
+
+    """
+
+    if not args or args[0] not in ('get', 'init'):
+        return
+
+    modules_dir = get_modules_dir()
+    manifest = _read_json(os.path.join(modules_dir, manifest_name))
+    if not manifest:
+        return
+
+    for entry in manifest.get('Modules', []):
+
+        key = entry.get('Key')
+        source = entry.get('Source')
+        if not key or not source or not entry.get('Dir') or _is_local(source):
+            continue
+
+        # Only move module directories that Terraform downloaded
+        # directly into the modules directory.
+        path = os.path.normpath(os.path.join(config.workspace_dir, entry['Dir']))
+        if os.path.dirname(path) != modules_dir or os.path.islink(path) or not os.path.isdir(path):
+            continue
+
+        version = entry.get('Version') or ''
+        tree = _hash_tree(path)
+        tree_path = _get_tree_path(tree)
+
+        with cache.lock(_get_lock_path('trees', tree)):
+            if os.path.isdir(tree_path):
+                shutil.rmtree(path)
+            else:
+                os.makedirs(os.path.dirname(tree_path), exist_ok=True)
+                temp_path = os.path.join(os.path.dirname(tree_path), '.tmp-' + tree)
+                shutil.rmtree(temp_path, ignore_errors=True)
+                shutil.move(path, temp_path)
+                os.rename(temp_path, tree_path)
+        os.symlink(tree_path, path)
+
+        index_path = _get_index_path(source)
+        with cache.lock(_get_lock_path('index', os.path.basename(index_path))):
+            index = _read_json(index_path) or {'source': source, 'versions': {}}
+            index['versions'][version] = {
+                'tree': tree,
+                'named_by_key': os.path.basename(path) == key,
+            }
+            cache.write(index_path, json.dumps(index, indent=2, sort_keys=True).encode('utf-8'))
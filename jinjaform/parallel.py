@@ -0,0 +1,187 @@
+import os
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+
+from queue import Queue
+
+from jinjaform import log
+
+
+_cancelled = threading.Event()
+_lock = threading.Lock()
+_output_lock = threading.Lock()
+_processes = set()
+
+
+class _PrefixedStream:
+    """
+    Wraps an output stream to add the label of the current step to the
+    start of each line written by a step, including output from print()
+    and tracebacks as well as from Jinjaform's own messages. Lines are
+    written whole, so that lines from different steps are not mixed up.
+
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def _write_lines(self, prefix, text):
+        lines = text.splitlines(keepends=True)
+        if not getattr(self._local, 'continued', False):
+            lines[0] = prefix + lines[0]
+        lines[1:] = [prefix + line for line in lines[1:]]
+        with _output_lock:
+            self._stream.write(''.join(lines))
+        self._local.continued = not text.endswith('\n')
+
+    def write(self, text):
+        prefix = log.get_prefix()
+        if not prefix:
+            return self._stream.write(text)
+        complete, newline, pending = (getattr(self._local, 'pending', '') + text).rpartition('\n')
+        if newline:
+            self._write_lines(prefix, complete + newline)
+        self._local.pending = pending
+        return len(text)
+
+    def flush(self):
+        prefix = log.get_prefix()
+        pending = getattr(self._local, 'pending', '')
+        if prefix and pending:
+            self._local.pending = ''
+            self._write_lines(prefix, pending)
+        self._stream.flush()
+
+
+def _cancel():
+    """
+    Stops commands started by steps that are still running,
+    and stops any more from starting.
+
+    """
+
+    with _lock:
+        _cancelled.set()
+        for process in _processes:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def _run_step(label, function, results):
+    exit_code = 1
+    with log.prefix(label):
+        try:
+            function()
+        except SystemExit as error:
+            if error.code is None:
+                exit_code = 0
+            elif isinstance(error.code, int):
+                exit_code = error.code
+            else:
+                print(error.code, file=sys.stderr)
+        except BaseException:
+            traceback.print_exc()
+        else:
+            exit_code = 0
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+    results.put((label, exit_code))
+
+
+def check_cancelled():
+    """
+    Exits the current step if another step in its group has failed.
+    Steps that run inside Jinjaform rather than in a command cannot be
+    stopped from another thread, so they call this between their stages.
+
+    """
+
+    if _cancelled.is_set():
+        sys.exit(1)
+
+
+def call(command, env):
+    """
+    Runs a shell command with its output prefixed by the label of the
+    current step. Returns the exit code. The command is stopped if
+    another step fails.
+
+    """
+
+    with _lock:
+        if _cancelled.is_set():
+            return 1
+        process = subprocess.Popen(
+            command,
+            env=env,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        _processes.add(process)
+    try:
+        for line in process.stdout:
+            sys.stdout.write(line.decode('utf-8', 'replace'))
+            sys.stdout.flush()
+        return process.wait()
+    finally:
+        with _lock:
+            _processes.discard(process)
+
+
+def run(steps):
+    """
+    Runs steps at the same time, each in its own thread, and waits for
+    them to finish. Each step is a label and a function. If a step fails,
+    the others are cancelled and this exits with the failed step's code
+    once they have stopped. Commands are stopped straight away, and other
+    steps stop when they next call check_cancelled().
+
+    """
+
+    _cancelled.clear()
+    results = Queue()
+    failed_exit_code = 0
+
+    # Wrap the output streams after colorama has wrapped them,
+    # because it flushes the stream after every write.
+    log.init()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = _PrefixedStream(stdout), _PrefixedStream(stderr)
+    try:
+
+        for label, function in steps:
+            thread = threading.Thread(target=_run_step, args=(label, function, results), daemon=True)
+            thread.start()
+
+        for _ in steps:
+            try:
+                label, exit_code = results.get()
+            except KeyboardInterrupt:
+                # Commands run in their own sessions, so they do not
+                # receive the interrupt and must be stopped.
+                _cancel()
+                raise
+            if exit_code != 0 and not failed_exit_code:
+                failed_exit_code = exit_code
+                _cancel()
+                log.bad('{} failed, cancelling other steps', label)
+
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        sys.stdout, sys.stderr = stdout, stderr
+
+    if failed_exit_code:
+        sys.exit(failed_exit_code)
@@ -0,0 +1,352 @@
+import hashlib
+import os
+import platform
+import re
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from jinjaform import cache, config, files, log
+
+
+# Set JINJAFORM_PLUGIN_MIRROR to a directory of provider plugins to use
+# with "jinjaform plugins prefetch". It has the same layout as the plugin
+# cache, with the plugins in a directory for each platform, e.g.
+# linux_amd64/terraform-provider-aws_v1.60.0_x4
+mirror_dir = os.environ.get('JINJAFORM_PLUGIN_MIRROR')
+
+plugin_pattern = re.compile(r'^terraform-provider-(?P<name>[\w-]+?)_v(?P<version>\d+(?:\.\d+)*(?:-[\w.]+)?)(?:_x\d+)?(?:\.exe)?$')
+constraint_pattern = re.compile(r'^\s*(?P<operator>~>|>=|<=|!=|=|>|<)?\s*v?(?P<version>\d+(?:\.\d+)*(?:-[\w.]+)?)\s*$')
+
+machines = {
+    'aarch64': 'arm64',
+    'amd64': 'amd64',
+    'arm64': 'arm64',
+    'armv7l': 'arm',
+    'i386': '386',
+    'i686': '386',
+    'x86_64': 'amd64',
+}
+
+
+def get_cache_dir():
+    return os.path.join(config.jinjaform_root, 'plugins')
+
+
+def lock_cache(shared=False):
+    """
+    Returns a context manager that locks the shared plugin cache.
+    "terraform init" holds a shared lock while it runs, so that stacks
+    can still be initialised at the same time, and prefetching holds an
+    exclusive lock while it copies plugins, so that Terraform never
+    sees or writes to a plugin that is being replaced.
+
+    """
+
+    return cache.lock(os.path.join(config.jinjaform_root, 'cache', 'plugins.lock'), shared=shared)
+
+
+def get_platform():
+    """
+    Returns the platform name used by Terraform for plugin directories,
+    e.g. linux_amd64.
+
+    """
+
+    system = platform.system().lower()
+    machine = platform.machine().lower()
+    return '{}_{}'.format(system, machines.get(machine, machine))
+
+
+def parse_version(version):
+    """
+    Returns a version as a tuple that can be compared,
+    and whether it is a pre-release version.
+
+    """
+
+    version, _, prerelease = version.partition('-')
+    return tuple(int(part) for part in version.split('.')), bool(prerelease)
+
+
+def _pad(numbers, length):
+    return numbers + (0,) * (length - len(numbers))
+
+
+def matches(version, constraints):
+    """
+    Returns whether a version satisfies Terraform version constraints,
+    e.g. "~> 1.2, != 1.2.3". Pre-release versions only match constraints
+    that specify them exactly.
+
+    """
+
+    numbers, prerelease = parse_version(version)
+    if prerelease and not constraints:
+        return False
+
+    for constraint in filter(None, (constraints or '').split(',')):
+
+        match = constraint_pattern.match(constraint)
+        if not match:
+            raise ValueError('invalid version constraint: {}'.format(constraint.strip()))
+        operator = match.group('operator') or '='
+        if prerelease and (operator != '=' or match.group('version') != version):
+            return False
+
+        wanted, _ = parse_version(match.group('version'))
+        length = max(len(numbers), len(wanted))
+        actual = _pad(numbers, length)
+        wanted_padded = _pad(wanted, length)
+
+        if operator == '=':
+            ok = actual == wanted_padded
+        elif operator == '!=':
+            ok = actual != wanted_padded
+        elif operator == '>':
+            ok = actual > wanted_padded
+        elif operator == '>=':
+            ok = actual >= wanted_padded
+        elif operator == '<':
+            ok = actual < wanted_padded
+        elif operator == '<=':
+            ok = actual <= wanted_padded
+        else:
+            # Allow only the last specified part of the version to increase,
+            # so "~> 1.2" allows 1.x and "~> 1.2.0" allows 1.2.x.
+            prefix = wanted[:-1] if len(wanted) > 1 else wanted
+            ok = actual >= wanted_padded and numbers[:len(prefix)] == prefix
+
+        if not ok:
+            return False
+
+    return True
+
+
+def _get_constraints(value):
+    """
+    Returns version constraints from an attribute value, or None if there
+    are none or they are not a literal value, which allows any version.
+
+    """
+
+    from jinjaform import scanner
+
+    if isinstance(value, str) and not isinstance(value, scanner.Expression):
+        return value
+    return None
+
+
+def get_requirements(stack):
+    """
+    Returns the provider names and version constraints
+    in the rendered Terraform files of a stack.
+
+    """
+
+    from jinjaform import scanner
+
+    requirements = set()
+    workspace_dir = os.path.join(stack, '.jinjaform')
+    for name in sorted(os.listdir(workspace_dir)):
+        if not name.endswith('.tf'):
+            continue
+        with open(os.path.join(workspace_dir, name)) as open_file:
+            items = scanner.scan(open_file.read(), types=('provider', 'terraform', 'required_providers'))
+        for item in items:
+            if not isinstance(item, scanner.Block):
+                continue
+            if item.type == 'provider' and item.labels:
+                version = item.attributes().get('version')
+                requirements.add((item.labels[0], _get_constraints(version)))
+            elif item.type == 'terraform':
+                for block in item.blocks('required_providers'):
+                    for provider_name, value in block.attributes().items():
+                        if isinstance(value, dict):
+                            value = value.get('version')
+                        requirements.add((provider_name, _get_constraints(value)))
+    return requirements
+
+
+def find_plugins(platform_name):
+    """
+    Returns the plugins in the mirror directory, as a dictionary of
+    provider names to dictionaries of versions to file paths.
+
+    """
+
+    plugins = {}
+    for path in (os.path.join(mirror_dir, platform_name), mirror_dir):
+        if not os.path.isdir(path):
+            continue
+        for entry in os.scandir(path):
+            match = plugin_pattern.match(entry.name)
+            if match and entry.is_file():
+                versions = plugins.setdefault(match.group('name'), {})
+                versions.setdefault(match.group('version'), entry.path)
+    return plugins
+
+
+def select(plugins, name, constraints):
+    """
+    Returns the newest version of a provider in the mirror
+    that satisfies the constraints, or None.
+
+    """
+
+    versions = [
+        version for version in plugins.get(name, {})
+        if matches(version, constraints)
+    ]
+    if versions:
+        # Prefer releases to pre-releases of the same version.
+        return max(versions, key=lambda version: (parse_version(version)[0], not parse_version(version)[1]))
+    return None
+
+
+def _get_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as open_file:
+        for chunk in iter(lambda: open_file.read(files.chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _is_copy(path, source_path):
+    """
+    Checks if a cached plugin is a copy of a plugin in the mirror.
+    Copies are given the modification time of their source, so the
+    files are only compared when their sizes match but their
+    modification times do not.
+
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    source_stat = os.stat(source_path)
+    if stat.st_size != source_stat.st_size:
+        return False
+    if stat.st_mtime_ns != source_stat.st_mtime_ns:
+        if _get_checksum(path) != _get_checksum(source_path):
+            return False
+        os.utime(path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return os.stat(path).st_mode & 0o111 == 0o111
+
+
+def install(source_path, platform_name):
+    """
+    Copies a plugin into the shared plugin cache, unless it is already
+    there. The file is replaced atomically so that Terraform never sees
+    a partially written plugin. The cache must be locked by the caller.
+    Returns whether the plugin was copied.
+
+    """
+
+    path = os.path.join(get_cache_dir(), platform_name, os.path.basename(source_path))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if _is_copy(path, source_path):
+        return False
+    files.copy([source_path], path, mode=0o755)
+    source_stat = os.stat(source_path)
+    os.utime(path, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    return True
+
+
+def prefetch(options):
+    """
+    Renders every stack under the current directory, finds the providers
+    that they use, and copies the matching plugins from the mirror
+    into the shared plugin cache, so that "terraform init" does not need
+    to download them. Stacks are only rendered, so AWS credentials are not
+    set up unless templates use them. Each provider version is only copied
+    once, and plugins are copied at the same time. Returns an exit code.
+
+    """
+
+    from jinjaform import batch, index, workspace
+
+    if not mirror_dir:
+        log.bad('plugins: set JINJAFORM_PLUGIN_MIRROR to a directory of provider plugins')
+        return 1
+    if not os.path.isdir(mirror_dir):
+        log.bad('plugins: {} is not a directory', mirror_dir)
+        return 1
+
+    try:
+        jobs = int(options.get('jobs', 1))
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        log.bad('-j must be a positive number')
+        return 1
+
+    stacks = index.find_stacks(config.cwd)
+    if not stacks:
+        log.bad('no stacks found')
+        return 1
+
+    # Render every stack first, because providers
+    # can be defined in templates.
+    exit_code = batch.run(
+        stacks, ['plugins', 'prefetch'], jobs,
+        target=workspace.render,
+        action='rendering templates',
+        credentials=False,
+    )
+    if exit_code != 0:
+        return exit_code
+
+    requirements = set()
+    for stack in stacks:
+        requirements.update(get_requirements(stack))
+
+    platform_name = get_platform()
+    plugins = find_plugins(platform_name)
+
+    exit_code = 0
+    selected = {}
+    for name, constraints in sorted(requirements, key=lambda requirement: (requirement[0], requirement[1] or '')):
+        try:
+            version = select(plugins, name, constraints)
+        except ValueError as error:
+            log.bad('plugins: {}: {}', name, error)
+            exit_code = 1
+            continue
+        if version:
+            selected[(name, version)] = plugins[name][version]
+        else:
+            log.bad('plugins: {} {} not found in mirror', name, constraints or '(any version)')
+            exit_code = 1
+
+    with lock_cache(), ThreadPoolExecutor(max_workers=max(jobs, 4)) as executor:
+        results = executor.map(lambda source_path: install(source_path, platform_name), selected.values())
+        for (name, version), copied in zip(selected, results):
+            if copied:
+                log.ok('plugins: {} {} copied from mirror', name, version)
+            else:
+                log.ok('plugins: {} {} already cached', name, version)
+
+    sys.stdout.flush()
+    return exit_code
+
+
+def main(args):
+    """
+    Runs the "jinjaform plugins" command. Returns an exit code.
+
+    """
+
+    from jinjaform import batch
+
+    options, remaining_args = batch.parse_args(args[1:])
+    if args[:1] != ['prefetch'] or remaining_args or set(options) - {'jobs'}:
+        log.bad('usage: jinjaform plugins prefetch [-j <jobs>]')
+        return 1
+
+    if not config.project_root:
+        log.bad('could not find .jinjaformrc file in current or parent directories')
+        return 1
+
+    return prefetch(options)
@@ -1,7 +1,7 @@
 import os
+import sys
 
-from jinjaform import log
-from jinjaform.config import cwd, project_root
+from jinjaform import config, log
 
 
 default = '''
@@ -27,7 +27,7 @@ TERRAFORM_RUN
 
 
 def create():
-    path = os.path.join(cwd, '.jinjaformrc')
+    path = os.path.join(config.cwd, '.jinjaformrc')
     try:
         with open(path, 'x') as open_file:
             open_file.write(default)
@@ -36,13 +36,13 @@ def create():
         return 1
     else:
         log.ok('created {}', path)
-        log.ok('your project root directory is {}', cwd)
+        log.ok('your project root directory is {}', config.cwd)
         return 0
 
 
 def read():
 
-    rc_path = os.path.join(project_root, '.jinjaformrc')
+    rc_path = os.path.join(config.project_root, '.jinjaformrc')
     commands = []
     with open(rc_path) as open_file:
         for line in open_file:
@@ -65,3 +65,39 @@ def read():
             yield parts
         else:
             yield command, None
+
+
+def group(commands):
+    """
+    Groups commands between PARALLEL and END lines, which run at the same
+    time. Returns a list of steps, where each step is either a command or
+    a list of commands to run at the same time.
+
+    """
+
+    steps = []
+    parallel = None
+    for rc_cmd, rc_arg in commands:
+        if rc_cmd == 'PARALLEL':
+            if parallel is not None:
+                log.bad('configuration: PARALLEL groups cannot be nested')
+                sys.exit(1)
+            parallel = []
+        elif rc_cmd == 'END':
+            if parallel is None:
+                log.bad('configuration: END must come after PARALLEL')
+                sys.exit(1)
+            if parallel:
+                steps.append(parallel)
+            parallel = None
+        elif parallel is not None:
+            if rc_cmd == 'TERRAFORM_RUN':
+                log.bad('configuration: TERRAFORM_RUN cannot be used in a PARALLEL group')
+                sys.exit(1)
+            parallel.append((rc_cmd, rc_arg))
+        else:
+            steps.append((rc_cmd, rc_arg))
+    if parallel is not None:
+        log.bad('configuration: PARALLEL must be followed by END')
+        sys.exit(1)
+    return steps
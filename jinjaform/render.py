@@ -0,0 +1,1299 @@
+import asyncio
+import importlib.util
+import jinja2
+import json
+import marshal
+import multiprocessing
+import os
+import re
+import sys
+import time
+import traceback
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import suppress
+
+from functools import lru_cache, partial
+
+
+from jinja2 import Environment, StrictUndefined, meta, nodes
+from jinja2.exceptions import UndefinedError
+
+from jinjaform import aws, cache, config, log, lookups, memoize, scanner, trace, __version__
+from jinjaform.cache import digest
+
+from queue import Queue
+
+from threading import Event, Lock, Thread, current_thread
+
+
+variable_block_pattern = re.compile(r'^[ \t]*variable[ \t]+("[^"\n]*"|[^\s"]+)', re.MULTILINE)
+variable_name_pattern = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# The types of top-level blocks that are parsed after rendering templates.
+wanted_block_types = {'provider', 'terraform', 'variable'}
+
+# The renderer used by worker processes, inherited when they are forked.
+_process_renderer = None
+
+# Compiled templates loaded by the daemon, inherited by the
+# processes that it forks to run commands.
+_preloaded_bytecode = {}
+
+
+class BytecodeCache(object):
+    """
+    Stores compiled templates on disk, along with the results of analysing
+    them, so that templates do not need to be parsed and compiled by Jinja2
+    every time. Templates are keyed by their source code rather than
+    their path, allowing identical files to be shared by all stacks.
+
+    """
+
+    version = 2
+
+    def __init__(self, path, prefix, max_size):
+        self._path = path
+        self._prefix = prefix
+        self._max_size = max_size
+        self._saved = False
+
+    def _get_path(self, source_digest):
+        key = digest(self.version, self._prefix, importlib.util.MAGIC_NUMBER.hex(), source_digest)
+        return os.path.join(self._path, key)
+
+    def evict(self):
+        """
+        Removes the least recently used templates if the cache
+        has grown beyond its size limit.
+
+        """
+
+        if self._saved:
+            cache.evict(self._path, self._max_size)
+
+    def load(self, source_digest):
+        """
+        Returns the compiled code and analysis for a template,
+        or None if it has not been cached.
+
+        """
+
+        path = self._get_path(source_digest)
+        data = _preloaded_bytecode.get(path) or cache.read(path)
+        if data:
+            with suppress(EOFError, TypeError, ValueError):
+                code, analysis = marshal.loads(data)
+                return code, analysis
+        return None
+
+    def save(self, source_digest, code, analysis):
+        data = marshal.dumps((code, analysis))
+        cache.write(self._get_path(source_digest), data)
+        self._saved = True
+
+
+class RenderCache(object):
+    """
+    Stores the results of rendering templates on disk, along with the
+    inputs that each result depends on. Results are keyed by the template
+    source code rather than its path, so a template that is used by many
+    stacks can be rendered once and reused by every stack where the
+    environment variables and Terraform variables that it accessed
+    have the same values.
+
+    """
+
+    version = 3
+
+    # The number of results kept for each template,
+    # e.g. one per environment with different variable values.
+    max_variants = 16
+
+    def __init__(self, path, prefix, max_size):
+        self._path = path
+        self._prefix = prefix
+        self._max_size = max_size
+        self._saved = False
+
+    def _get_path(self, source_digest):
+        key = digest(self.version, self._prefix, source_digest)
+        return os.path.join(self._path, key)
+
+    def _load_variants(self, source_digest):
+        data = cache.read(self._get_path(source_digest))
+        if data:
+            with suppress(ValueError):
+                return json.loads(data.decode('utf-8'))
+        return []
+
+    def evict(self):
+        """
+        Removes the least recently used templates if the cache
+        has grown beyond its size limit.
+
+        """
+
+        if self._saved:
+            cache.evict(self._path, self._max_size)
+
+    def load(self, source_digest, environment_digest, var_store):
+        """
+        Returns a previous result of rendering a template, if the
+        environment variables and the values of the Terraform variables
+        that it accessed are all unchanged. Variables that have not been
+        resolved yet never match, so that the template is rendered and
+        waits for them in the usual way.
+
+        """
+
+        for entry in self._load_variants(source_digest):
+            if entry['environment'] != environment_digest:
+                continue
+            var_view = VarView(var_store)
+            for name, value_digest in sorted(entry['variables'].items()):
+                if not var_store._is_resolved(name):
+                    break
+                if var_view._get_variable_digest(name) != value_digest:
+                    break
+            else:
+                return dict(entry, cached=True)
+        return None
+
+    def save(self, entry):
+        """
+        Adds the result of rendering a template to the cache. Results with
+        the same inputs as the new one are replaced, and the oldest results
+        are removed when there are too many.
+
+        """
+
+        variants = [entry]
+        for variant in self._load_variants(entry['source']):
+            if len(variants) >= self.max_variants:
+                break
+            if variant['environment'] != entry['environment'] or variant['variables'] != entry['variables']:
+                variants.append(variant)
+        data = json.dumps(variants, sort_keys=True).encode('utf-8')
+        cache.write(self._get_path(entry['source']), data)
+        self._saved = True
+
+
+class Prompter(object):
+    """
+    Helper class that allows prompts from background threads
+    to occur in the main thread. This avoids issues with
+    pressing Ctrl-C and having threads fail in the background.
+    Worker processes prompt directly, as they cannot use the queue,
+    and so does the thread processing the queue when it renders
+    templates itself.
+
+    """
+
+    def __init__(self, events):
+        self._events = events
+        self._pid = os.getpid()
+        self._thread = current_thread()
+
+    def _ask(self, prompt, event, result):
+        try:
+            result.append(log.secret(prompt))
+        except (KeyboardInterrupt, SystemExit) as error:
+            result.append(error)
+        event.set()
+
+    def prompt(self, prompt):
+        if os.getpid() != self._pid or current_thread() is self._thread:
+            return log.secret(prompt)
+        event = Event()
+        result = []
+        self._events.put(partial(self._ask, prompt, event, result))
+        event.wait()
+        if isinstance(result[0], KeyboardInterrupt):
+            print()
+        if isinstance(result[0], BaseException):
+            raise result[0]
+        return result[0]
+
+
+class Deferred(Exception):
+    """
+    Raised when a template accesses a variable that has not been defined
+    yet, but which could still be defined by another template. Rendering
+    of the template is stopped and it is rendered again later.
+
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.name = name
+
+
+class VarStore(object):
+    """
+    Stores Terraform variable definitions and values.
+
+    """
+
+    def __init__(self):
+
+        self._lock = Lock()
+
+        self._defined = set()
+        self._defaults = dict()
+        self._values = dict()
+
+        # Variables that can no longer be defined by any template.
+        self._abandoned = set()
+
+    def _abandon_variable(self, name):
+        with self._lock:
+            self._abandoned.add(name)
+
+    def _define_variable(self, name, default):
+        with self._lock:
+            self._defined.add(name)
+            if default is not None:
+                self._defaults[name] = default
+
+    def _get_variable(self, name):
+        """
+        Returns a variable value. Raises Deferred if the variable has not
+        been defined yet, or KeyError if it cannot be resolved.
+
+        """
+
+        with self._lock:
+            if name in self._defined:
+                if name in self._values:
+                    return self._values[name]
+                if name in self._defaults:
+                    return self._defaults[name]
+            elif name not in self._abandoned:
+                raise Deferred(name)
+
+        # The variable was not defined, or it was defined without a value,
+        # or it was abandoned because nothing else could define it.
+        raise KeyError(name)
+
+    def _is_defined(self, name):
+        return name in self._defined
+
+    def _is_resolved(self, name):
+        return name in self._defined or name in self._abandoned
+
+    def _restore(self, snapshot):
+        """
+        Updates the variable definitions from another process.
+
+        """
+
+        defined, defaults, abandoned = snapshot
+        with self._lock:
+            self._defined = defined
+            self._defaults = defaults
+            self._abandoned = abandoned
+
+    def _set_variable_value(self, name, value):
+        self._values[name] = value
+
+    def _snapshot(self):
+        """
+        Returns the variable definitions, to be sent to another process.
+        Variable values are not included because they are set before
+        rendering starts, so worker processes inherit them.
+
+        """
+
+        with self._lock:
+            return set(self._defined), dict(self._defaults), set(self._abandoned)
+
+
+class VarView(object):
+    """
+    Exposes the `var.some_name` Terraform variables to a single template,
+    keeping track of which variables the template has accessed.
+
+    """
+
+    def __init__(self, var_store):
+        self._var_store = var_store
+        self._accessed = {}
+        self._unresolved = set()
+
+    def __getitem__(self, key):
+        try:
+            value = self._var_store._get_variable(key)
+        except KeyError:
+            self._accessed[key] = digest(False)
+            self._unresolved.add(key)
+            raise
+        self._accessed[key] = digest(True, value)
+        return value
+
+    def _get_variable_digest(self, name):
+        """
+        Returns a hash of a variable value, in the same way as accessing it.
+
+        """
+
+        with suppress(KeyError):
+            self[name]
+        return self._accessed[name]
+
+
+class AsyncVarView(VarView):
+    """
+    Exposes the `var.some_name` Terraform variables to a template rendered
+    by the asyncio engine. Variables that have not been defined yet are
+    returned as awaitables, which Jinja2 awaits automatically in async mode.
+
+    """
+
+    def __init__(self, renderer, source):
+        super().__init__(renderer._var_store)
+        self._renderer = renderer
+        self._source = source
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except Deferred:
+            return self._renderer._wait_for_variable(self._source, key, self)
+
+
+class TemplateInfo(object):
+    """
+    A template along with the results of statically analysing it.
+
+    """
+
+    def __init__(self, source):
+        self.source = source
+        with open(source) as open_file:
+            self.text = open_file.read()
+        self.digest = digest(self.text)
+        self.template = None
+
+        # Names used from the context.
+        self.names = set()
+
+        # Variables which are accessed directly, e.g. `var.name`.
+        self.references = set()
+
+        # Variables which are accessed directly, but only to check
+        # if they are defined, e.g. `{% if var.name is defined %}`.
+        self.optional_references = set()
+
+        # Variables defined by the template in `variable` blocks.
+        self.definitions = set()
+
+        # If the template accesses variables in ways that cannot be
+        # determined without rendering it, e.g. `var[name]`, or defines
+        # variables with names that are only known after rendering it.
+        self.dynamic_references = False
+        self.dynamic_definitions = False
+
+        for match in variable_block_pattern.finditer(self.text):
+            name = match.group(1).strip('"')
+            if variable_name_pattern.match(name):
+                self.definitions.add(name)
+            else:
+                self.dynamic_definitions = True
+
+    @property
+    def dependencies(self):
+        return self.references | self.optional_references
+
+    def set_analysis(self, analysis):
+        self.names = analysis['names']
+        self.references = analysis['references']
+        self.optional_references = analysis['optional_references']
+        self.dynamic_references = analysis['dynamic_references']
+
+
+def _analyse(ast):
+    """
+    Finds the context names and Terraform variables used by a template.
+
+    """
+
+    references = set()
+    optional_references = set()
+    dynamic_references = []
+
+    def visit(node, optional=False):
+
+        name = _get_variable_name(node)
+        if name:
+            if optional:
+                optional_references.add(name)
+            else:
+                references.add(name)
+            return
+
+        if isinstance(node, nodes.Name) and node.name == 'var':
+            # Any other usage of `var` (e.g. passing it into a macro
+            # or function) means that the variables it uses are not
+            # known until the template is rendered.
+            dynamic_references.append(node)
+            return
+
+        is_defined_test = isinstance(node, nodes.Test) and node.name in ('defined', 'undefined')
+        for child in node.iter_child_nodes():
+            visit(child, optional=is_defined_test and child is node.node)
+
+    visit(ast)
+
+    return {
+        'names': meta.find_undeclared_variables(ast),
+        'references': references,
+        'optional_references': optional_references - references,
+        'dynamic_references': bool(dynamic_references),
+    }
+
+
+def _get_variable_name(node):
+    """
+    Returns the variable name from a `var.name` or `var['name']` node.
+
+    """
+
+    if isinstance(node, nodes.Getattr):
+        if isinstance(node.node, nodes.Name) and node.node.name == 'var':
+            return node.attr
+    elif isinstance(node, nodes.Getitem):
+        if isinstance(node.node, nodes.Name) and node.node.name == 'var':
+            if isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+                return node.arg.value
+    return None
+
+
+def preload_bytecode(project_root):
+    """
+    Loads compiled templates from the cache into memory,
+    except for those that have already been loaded.
+
+    """
+
+    path = os.path.join(project_root, '.jinjaform', 'cache', 'bytecode')
+    with suppress(FileNotFoundError):
+        for entry in os.scandir(path):
+            if entry.name not in _preloaded_bytecode and not entry.name.startswith('.'):
+                with suppress(FileNotFoundError):
+                    with open(entry.path, 'rb') as open_file:
+                        _preloaded_bytecode[entry.path] = open_file.read()
+
+
+@lru_cache()
+def get_environment(project_root, enable_async=False):
+    """
+    Returns a Jinja2 Environment with the custom filters and tests from
+    the project, along with the registry of custom extensions. This is
+    created once per process, and shared by all templates and stacks
+    being rendered. Extension modules are imported when templates use them.
+
+    """
+
+    from jinjaform import extensions
+
+    # Create a Jina2 Environment.
+    env = Environment(
+        undefined=StrictUndefined,
+        keep_trailing_newline=True,
+        extensions=[
+            'jinja2.ext.do',
+            'jinja2.ext.loopcontrols',
+        ],
+        enable_async=enable_async,
+    )
+
+    # Load Jinja2 extensions.
+    registry = extensions.Registry(project_root)
+    registry.install(env)
+
+    return env, registry
+
+
+class RenderOutput(object):
+    """
+    Collects the output of a template as it is generated, scanning it
+    for the blocks that Jinjaform uses. Variables are published as soon
+    as their blocks are complete.
+
+    """
+
+    def __init__(self, publish):
+        self.blocks = []
+        self.chunks = []
+        self.error = None
+        self.scan_time = 0
+        self._publish = publish
+        self._scanner = scanner.Scanner(types=wanted_block_types)
+
+    def _add_blocks(self, blocks):
+        for block in blocks:
+            self.blocks.append(block)
+            if block.type == 'variable' and len(block.labels) == 1:
+                self._publish(block.labels[0], _get_default(block))
+
+    def close(self):
+        if not self.error:
+            try:
+                self._add_blocks(self._scanner.close())
+            except scanner.ScanError as error:
+                self.error = error
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+        if not self.error:
+            start_time = time.perf_counter()
+            try:
+                self._add_blocks(self._scanner.feed(chunk))
+            except scanner.ScanError as error:
+                self.error = error
+            self.scan_time += time.perf_counter() - start_time
+
+
+class MultiTemplateRenderer(object):
+    """
+    Renders multiple templates with variable references between them.
+
+    Templates are statically analysed first to find which variables they
+    reference and define. This is only used to render the templates in
+    dependency order using a bounded pool of worker threads, because
+    references can be in branches that are not taken, or have defaults.
+    Templates which access variables that have not been defined yet are
+    rendered again once those variables have been defined, and errors
+    are only reported for variables that are accessed but cannot be
+    resolved.
+
+    """
+
+    # Whether templates are compiled for the asyncio engine.
+    enable_async = False
+
+    def __init__(self):
+        self._errors = []
+        self._events = Queue()
+        self._pid = os.getpid()
+        self._prompter = Prompter(self._events)
+        self._publications = None
+        self._rendered = {}
+        self._templates = {}
+        self._var_store = VarStore()
+
+        # Scheduling state, only used from the main thread.
+        self._defined_by = defaultdict(set)
+        self._deferred = set()
+        self._running = set()
+        self._waiting = {}
+        self._waiting_for = defaultdict(set)
+        self._waiting_since = {}
+
+        # Create a context for the template to use.
+        # Include environment variables. The `var.some_name` Terraform
+        # variables are added separately for each template.
+        # Custom context values are added for the templates that use them.
+        self._jinja_environment, self._jinja_extensions = get_environment(
+            config.project_root,
+            enable_async=self.enable_async,
+        )
+        self._jinja_context = {
+            'aws': {
+                'client': partial(aws.get_session_client, mfa_prompter=self._prompter.prompt),
+                'session': partial(aws.get_session, mfa_prompter=self._prompter.prompt),
+                'ssm_parameter': partial(lookups.ssm_parameter, mfa_prompter=self._prompter.prompt),
+                'secret': partial(lookups.secret, mfa_prompter=self._prompter.prompt),
+                'ec2': partial(lookups.ec2, mfa_prompter=self._prompter.prompt),
+            },
+            'cached': memoize.call,
+        }
+        self._jinja_context.update(os.environ)
+
+        # Context functions may return different values every time,
+        # so templates that use them cannot be reused from the render cache.
+        self._volatile_names = {'aws', 'cached'} | set(self._jinja_extensions.names['context'])
+
+        self._global_digest = digest(
+            __version__,
+            jinja2.__version__,
+            self._jinja_extensions.files,
+        )
+        self._bytecode_cache = BytecodeCache(
+            path=os.path.join(config.jinjaform_root, 'cache', 'bytecode'),
+            prefix=digest(self._global_digest, self.enable_async),
+            max_size=int(os.environ.get('JINJAFORM_BYTECODE_CACHE_SIZE', 64)) * 1024 * 1024,
+        )
+        self._render_cache = RenderCache(
+            path=os.path.join(config.jinjaform_root, 'cache', 'render'),
+            prefix=self._global_digest,
+            max_size=int(os.environ.get('JINJAFORM_RENDER_CACHE_SIZE', 64)) * 1024 * 1024,
+        )
+
+    def _analyse(self):
+        """
+        Loads and analyses all templates.
+
+        """
+
+        for info in self._templates.values():
+
+            cached = self._bytecode_cache.load(info.digest)
+            if cached:
+                code, analysis = cached
+            else:
+                ast = self._jinja_environment.parse(info.text)
+                analysis = _analyse(ast)
+                code = self._jinja_environment.compile(ast)
+                self._bytecode_cache.save(info.digest, code, analysis)
+
+            info.template = self._jinja_environment.template_class.from_code(
+                self._jinja_environment,
+                code,
+                self._jinja_environment.make_globals(None),
+            )
+            info.set_analysis(analysis)
+
+            for name in info.definitions:
+                self._defined_by[name].add(info.source)
+
+        # Variables that are not defined by any template can never be
+        # defined, unless a template defines variables dynamically, so
+        # templates do not need to wait for them. They are only errors
+        # if a template accesses them without a default.
+        if not any(info.dynamic_definitions for info in self._templates.values()):
+            for info in self._templates.values():
+                for name in info.dependencies:
+                    if name not in self._defined_by:
+                        self._var_store._abandon_variable(name)
+
+    def _completed(self, source, future):
+        """
+        Processes the outcome of rendering a template.
+        This runs in the main thread.
+
+        """
+
+        self._running.discard(source)
+
+        try:
+            result = future.result()
+            if isinstance(self._executor, ProcessPoolExecutor):
+                result, counts, saved = result
+                memoize.merge(counts, saved)
+            entry, deferred, errors = result
+        except Exception as error:
+            entry, deferred, errors = None, None, ['{}: {} in {}'.format(type(error).__name__, error, source)]
+
+        if deferred:
+            self._deferred.add(source)
+            self._wait(source, {deferred})
+            return
+
+        self._finish(source, entry, errors)
+
+    def _create_executor(self):
+        """
+        Returns a pool of worker threads, or worker processes if enabled.
+        Rendering and parsing are CPU bound, so multiple processes can
+        be faster for projects with large or complicated templates.
+
+        """
+
+        processes = int(os.environ.get('JINJAFORM_RENDER_PROCS', 0))
+        if processes:
+            # Worker processes are forked from this process, so they
+            # inherit the compiled templates and Jinja2 environment.
+            global _process_renderer
+            _process_renderer = self
+            # Worker processes send variable definitions back through
+            # a queue, which a thread forwards to the main thread.
+            self._publications = multiprocessing.get_context('fork').SimpleQueue()
+            self._forwarder = Thread(target=self._forward_publications, daemon=True)
+            self._forwarder.start()
+            return ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('fork'),
+            )
+
+        threads = int(os.environ.get('JINJAFORM_RENDER_THREADS', 0))
+        return ThreadPoolExecutor(max_workers=threads or None)
+
+    def _finish(self, source, entry, errors):
+        """
+        Saves the result of rendering a template and defines its variables.
+        This runs in the main thread.
+
+        """
+
+        self._errors.extend(errors)
+
+        if entry is None:
+            return
+
+        # Record what the template used, so that the result can be
+        # reused by other stacks and later builds with the same inputs.
+        if 'source' in entry and not entry.get('cached'):
+            self._render_cache.save(entry)
+
+        result = entry['result']
+
+        # Save rendered templates.
+        self._rendered[source] = result['rendered']
+
+        # Process variables.
+        for name, default in result['variables'].items():
+            self._var_store._define_variable(name, default)
+            self._resolved(name)
+
+        # Process the default AWS provider.
+        for aws_provider in result['aws_providers']:
+            aws.aws_provider.update(aws_provider)
+
+        # Process the S3 backend.
+        if result['s3_backend']:
+            aws.s3_backend.update(result['s3_backend'])
+
+    def _forward_publications(self):
+        """
+        Forwards variable definitions from worker processes to the
+        main thread, until it receives None.
+
+        """
+
+        for name, default in iter(self._publications.get, None):
+            self._events.put(partial(self._published, name, default))
+
+    def _get_entry(self, info, output, var_view):
+        """
+        Returns a cache entry containing the result of rendering a template
+        and the inputs that it used.
+
+        """
+
+        if output.error:
+            log.bad('error parsing {}: {}', info.source, output.error)
+
+        result = {
+            'rendered': ''.join(output.chunks),
+            'variables': {},
+            'aws_providers': [],
+            's3_backend': {},
+        }
+
+        for block in output.blocks:
+
+            # Find variables.
+            if block.type == 'variable' and len(block.labels) == 1:
+                result['variables'][block.labels[0]] = _get_default(block)
+
+            # Find the default AWS provider.
+            elif block.type == 'provider' and block.labels == ['aws']:
+                aws_provider = _get_literal_attributes(block)
+                if not aws_provider.get('alias'):
+                    result['aws_providers'].append(aws_provider)
+
+            # Find the S3 backend.
+            elif block.type == 'terraform':
+                for backend in block.blocks('backend'):
+                    if backend.labels == ['s3']:
+                        result['s3_backend'] = _get_literal_attributes(backend)
+
+        # Templates that use volatile names cannot be reused,
+        # so only return the result without any of its inputs.
+        if info.names & self._volatile_names:
+            return {'result': result}
+
+        return {
+            'source': info.digest,
+            'environment': self._get_environment_digest(info.names),
+            'variables': var_view._accessed,
+            'result': result,
+        }
+
+    def _get_environment_digest(self, names):
+        """
+        Returns a hash of the environment variables used by a template.
+
+        """
+
+        return digest([(name, os.environ.get(name)) for name in sorted(names)])
+
+    def _get_undefined_errors(self, info, var_view, error):
+        """
+        Returns error messages for a template that used an undefined value.
+
+        """
+
+        names = sorted(var_view._unresolved)
+        if not names:
+            return ['{} in {}'.format(error, info.source)]
+        errors = []
+        for name in names:
+            message = "'var.{}' cannot be resolved in {}".format(name, info.source)
+            # Variables that a template would define are unresolved because
+            # that template failed or was waiting for this one, which the
+            # other errors will show, so only the others are not defined.
+            if not self._var_store._is_defined(name) and name not in self._defined_by:
+                message += ' (not defined)'
+            errors.append(message)
+        return errors
+
+    def _publish(self, name, default):
+        """
+        Defines a variable as soon as its block has been rendered, before
+        the rest of the template, so that templates which are waiting for
+        it can start rendering.
+
+        """
+
+        if os.getpid() != self._pid:
+            self._publications.put((name, default))
+        else:
+            self._var_store._define_variable(name, default)
+            self._events.put(partial(self._resolved, name))
+
+    def _published(self, name, default):
+        """
+        Defines a variable from a worker process.
+        This runs in the main thread.
+
+        """
+
+        self._var_store._define_variable(name, default)
+        self._resolved(name)
+
+    def _render(self, info):
+        """
+        Renders a template in a worker. Returns a cache entry containing
+        the result, the name of a variable if the template must wait for it
+        to be defined before rendering again, and any error messages.
+
+        """
+
+        errors = []
+        try:
+            with trace.span('render', template=info.source) as trace_args:
+
+                # Reuse a cached result if the inputs are the same.
+                entry = None
+                if not info.names & self._volatile_names:
+                    entry = self._render_cache.load(
+                        source_digest=info.digest,
+                        environment_digest=self._get_environment_digest(info.names),
+                        var_store=self._var_store,
+                    )
+                if entry is None:
+                    entry = self._render_template(info, errors, trace_args)
+                else:
+                    trace_args['cached'] = True
+
+        except Deferred as deferred:
+            return None, deferred.name, []
+        except KeyboardInterrupt:
+            return None, None, ['interrupted']
+        except Exception as error:
+            etype, value, tb = sys.exc_info()
+            print('Traceback (most recent call last):')
+            traceback.print_tb(tb)
+            return None, None, ['{}: {} in {}'.format(etype.__name__, error, info.source)]
+
+        return entry, None, errors
+
+    def _render_all(self):
+        """
+        Renders all templates using a pool of workers.
+
+        """
+
+        with self._create_executor() as executor:
+            self._executor = executor
+
+            # Start rendering templates that do not need to wait
+            # for variables to be defined by other templates.
+            for source, info in sorted(self._templates.items()):
+                self._wait(source, {
+                    name for name in info.dependencies
+                    if name in self._defined_by
+                })
+
+            # Process results in the main thread, scheduling waiting
+            # templates as the variables they need are defined.
+            while self._running or self._waiting:
+                if not self._running:
+                    self._stalled()
+                    continue
+                callback = self._events.get()
+                callback()
+
+        if self._publications:
+            self._publications.put(None)
+            self._forwarder.join()
+
+    def _render_template(self, info, errors, trace_args):
+
+        # Render the template, scanning the output as it is generated so
+        # that variables can be used by other templates straight away.
+        var_view = VarView(self._var_store)
+        context = dict(self._jinja_context)
+        context.update(self._jinja_extensions.get_context(info.names))
+        context['var'] = var_view
+        output = RenderOutput(self._publish)
+        try:
+            for chunk in info.template.generate(**context):
+                output.write(chunk)
+        except UndefinedError as error:
+            errors.extend(self._get_undefined_errors(info, var_view, error))
+            return None
+        finally:
+            trace_args['scan_seconds'] = round(output.scan_time, 6)
+        output.close()
+
+        return self._get_entry(info, output, var_view)
+
+    def _resolved(self, name):
+        """
+        Schedules templates that were waiting for a variable.
+
+        """
+
+        for source in self._waiting_for.pop(name, ()):
+            waiting = self._waiting.get(source)
+            if waiting is not None:
+                waiting.discard(name)
+                if not waiting:
+                    self._submit(source)
+
+    def _stalled(self):
+        """
+        Handles the situation where templates are waiting for variables
+        but no templates are rendering, so nothing else will define them.
+        Templates that are only waiting for variables found by the static
+        analysis are rendered now, because they might not access them.
+        Otherwise, variables that no waiting template would define are
+        abandoned, allowing those templates to render with errors. If the
+        waiting templates would define each other's variables then they
+        are in a deadlock, so all of their variables are abandoned.
+
+        """
+
+        speculative = sorted(source for source in self._waiting if source not in self._deferred)
+        if speculative:
+            for source in speculative:
+                self._submit(source)
+            return
+
+        waiting_for = set().union(*self._waiting.values())
+        would_define = set().union(*(self._templates[source].definitions for source in self._waiting))
+        abandon = (waiting_for - would_define) or waiting_for
+        for name in sorted(abandon):
+            self._var_store._abandon_variable(name)
+            self._resolved(name)
+
+    def _submit(self, source):
+        if source in self._waiting_since:
+            start_time, names = self._waiting_since.pop(source)
+            trace.add_span('wait', start_time, time.time(), template=source, variables=sorted(names))
+        self._waiting.pop(source, None)
+        self._deferred.discard(source)
+        self._running.add(source)
+        if isinstance(self._executor, ProcessPoolExecutor):
+            future = self._executor.submit(_render_in_process, source, self._var_store._snapshot())
+        else:
+            future = self._executor.submit(self._render, self._templates[source])
+        future.add_done_callback(lambda future: self._events.put(partial(self._completed, source, future)))
+
+    def _wait(self, source, names):
+        """
+        Makes a template wait for variables before it is rendered.
+
+        """
+
+        names = {name for name in names if not self._var_store._is_resolved(name)}
+        if names:
+            if trace.path:
+                self._waiting_since.setdefault(source, (time.time(), set()))[1].update(names)
+            self._waiting[source] = names
+            for name in names:
+                self._waiting_for[name].add(source)
+        else:
+            self._submit(source)
+
+    def add_template(self, source):
+        self._templates[source] = TemplateInfo(source)
+
+    def set_variable_value(self, name, value):
+        self._var_store._set_variable_value(name, value)
+
+    def start(self):
+
+        self._analyse()
+        self._render_all()
+
+        self._bytecode_cache.evict()
+        self._render_cache.evict()
+        memoize.evict()
+        memoize.report()
+        for error in self._errors:
+            log.bad(error)
+        success = not bool(self._errors)
+        return (success, self._rendered)
+
+
+class AsyncTemplateRenderer(MultiTemplateRenderer):
+    """
+    Renders multiple templates concurrently on a single asyncio event loop.
+
+    Every template starts rendering straight away. Accessing a variable
+    that has not been defined yet waits for a future that is resolved when
+    another template defines it, instead of rendering the template again.
+    Each wait is constant time, and a deadlock is detected as soon as every
+    unfinished template is waiting for a variable.
+
+    """
+
+    enable_async = True
+
+    def __init__(self):
+        super().__init__()
+        self._blocked = 0
+        self._futures = {}
+        self._speculative = {}
+        self._unfinished = 0
+        self._waiters = defaultdict(set)
+
+    def _check_stalled(self):
+        """
+        Handles the situation where every unfinished template is waiting
+        for a variable, so nothing else will define them. Templates that
+        have not started rendering, and are only waiting for variables found
+        by the static analysis, start now, because they might not access
+        them. Otherwise, variables that no waiting template would define are
+        abandoned, allowing those templates to render with errors. If the
+        waiting templates would define each other's variables then they are
+        in a deadlock, so all of their variables are abandoned.
+
+        """
+
+        if not self._unfinished or self._blocked < self._unfinished:
+            return
+
+        if self._speculative:
+            for source, (name, future) in sorted(self._speculative.items()):
+                self._waiters[name].discard(source)
+                self._blocked -= 1
+                future.set_result(False)
+            self._speculative.clear()
+            return
+
+        waiting_for = set(self._waiters)
+        would_define = set()
+        for sources in self._waiters.values():
+            for source in sources:
+                would_define |= self._templates[source].definitions
+        abandon = (waiting_for - would_define) or waiting_for
+        for name in sorted(abandon):
+            self._var_store._abandon_variable(name)
+            self._resolved(name)
+
+    def _publish(self, name, default):
+        self._var_store._define_variable(name, default)
+        self._resolved(name)
+
+    def _render_all(self):
+        """
+        Renders all templates on an event loop.
+
+        """
+
+        asyncio.run(self._render_all_async())
+
+    async def _render_all_async(self):
+        self._loop = asyncio.get_running_loop()
+        self._unfinished = len(self._templates)
+        await asyncio.gather(*(
+            self._render_async(info)
+            for source, info in sorted(self._templates.items())
+        ))
+
+    async def _render_async(self, info):
+        """
+        Renders a template and processes the result.
+
+        """
+
+        entry = None
+        errors = []
+        trace_args = {}
+        start_time = None
+        try:
+
+            # Wait for the variables found by the static analysis,
+            # so that a cached result can be used if the inputs are the same.
+            for name in sorted(info.dependencies):
+                if name in self._defined_by:
+                    if not await self._wait_for_dependency(info.source, name):
+                        break
+
+            start_time = time.time()
+            if not info.names & self._volatile_names:
+                entry = self._render_cache.load(
+                    source_digest=info.digest,
+                    environment_digest=self._get_environment_digest(info.names),
+                    var_store=self._var_store,
+                )
+            if entry is None:
+                entry = await self._render_template_async(info, errors, trace_args)
+            else:
+                trace_args['cached'] = True
+
+        except Exception as error:
+            etype, value, tb = sys.exc_info()
+            print('Traceback (most recent call last):')
+            traceback.print_tb(tb)
+            errors = ['{}: {} in {}'.format(etype.__name__, error, info.source)]
+
+        if start_time:
+            trace.add_span('render', start_time, time.time(), template=info.source, **trace_args)
+        self._finish(info.source, entry, errors)
+        self._unfinished -= 1
+        self._check_stalled()
+
+    async def _render_template_async(self, info, errors, trace_args):
+        var_view = AsyncVarView(self, info.source)
+        context = dict(self._jinja_context)
+        context.update(self._jinja_extensions.get_context(info.names))
+        context['var'] = var_view
+        output = RenderOutput(self._publish)
+        try:
+            async for chunk in info.template.generate_async(**context):
+                output.write(chunk)
+        except UndefinedError as error:
+            errors.extend(self._get_undefined_errors(info, var_view, error))
+            return None
+        finally:
+            trace_args['scan_seconds'] = round(output.scan_time, 6)
+        output.close()
+
+        return self._get_entry(info, output, var_view)
+
+    def _resolved(self, name):
+        """
+        Wakes up templates that were waiting for a variable.
+
+        """
+
+        for source in self._waiters.pop(name, ()):
+            self._blocked -= 1
+            speculative = self._speculative.get(source)
+            if speculative and speculative[0] == name:
+                del self._speculative[source]
+                speculative[1].set_result(True)
+        future = self._futures.pop(name, None)
+        if future:
+            future.set_result(None)
+
+    async def _wait_for_dependency(self, source, name):
+        """
+        Waits for a variable found by the static analysis to be defined
+        or abandoned before a template starts rendering. Returns False if
+        the template should start rendering without waiting any longer.
+
+        """
+
+        if self._var_store._is_resolved(name):
+            return True
+        future = self._loop.create_future()
+        self._speculative[source] = (name, future)
+        self._waiters[name].add(source)
+        self._blocked += 1
+        start_time = time.time()
+        self._check_stalled()
+        result = await future
+        trace.add_span('wait', start_time, time.time(), template=source, variables=[name])
+        return result
+
+    async def _wait_for_variable(self, source, name, var_view=None):
+        """
+        Waits for a variable to be defined or abandoned,
+        then returns its value if a view was given.
+
+        """
+
+        if not self._var_store._is_resolved(name):
+            future = self._futures.get(name)
+            if future is None:
+                future = self._futures[name] = self._loop.create_future()
+            self._waiters[name].add(source)
+            self._blocked += 1
+            self._check_stalled()
+            start_time = time.time()
+            await future
+            trace.add_span('wait', start_time, time.time(), template=source, variables=[name])
+
+        if var_view is not None:
+            try:
+                return var_view[name]
+            except KeyError:
+                return self._jinja_environment.undefined(obj=var_view, name=name)
+
+
+def create_renderer():
+    """
+    Returns a template renderer using the engine
+    chosen with the JINJAFORM_RENDER_ENGINE variable.
+
+    """
+
+    engine = os.environ.get('JINJAFORM_RENDER_ENGINE', 'pool')
+    if engine == 'async':
+        return AsyncTemplateRenderer()
+    if engine != 'pool':
+        log.bad('unknown render engine {}, expected "pool" or "async"', engine)
+        sys.exit(1)
+    return MultiTemplateRenderer()
+
+
+def _render_in_process(source, snapshot):
+    """
+    Renders a template in a worker process, using the variable
+    definitions from the main process. Returns the result along with
+    the counts of cached calls made while rendering it, which the main
+    process merges into its own.
+
+    """
+
+    _process_renderer._var_store._restore(snapshot)
+    counts = memoize.stats()
+    result = _process_renderer._render(_process_renderer._templates[source])
+    trace.flush()
+    counts = {name: count - counts[name] for name, count in memoize.stats().items()}
+    return result, counts, memoize._saved[0]
+
+
+def _get_default(block):
+    """
+    Returns the default value of a variable block.
+
+    """
+
+    default = block.to_dict().get('default')
+    if isinstance(default, scanner.Expression):
+        default = str(default)
+    return default
+
+
+def _get_literal_attributes(block):
+    """
+    Returns the attributes of a block that have literal values,
+    leaving out expressions that only Terraform can evaluate.
+
+    """
+
+    attributes = {}
+    for name, value in block.attributes().items():
+        if not isinstance(value, scanner.Expression):
+            attributes[name] = value
+    return attributes
@@ -0,0 +1,589 @@
+import re
+
+
+# Tokens that change the scanner state in expressions and block bodies.
+# Strings without interpolation sequences are matched in one go.
+body_tokens = r'''
+    (?P<simple_string>"(?:[^"\\$%\n]|\\.|[$%](?!\{))*")
+    |(?P<string>")
+    |(?P<comment>\#|//)
+    |(?P<block_comment>/\*)
+    |<<(?P<indent>-)?[ \t]*"?(?P<marker>[A-Za-z_][\w-]*)"?[ \t]*\r?$
+    |(?P<open>[{\[(])
+    |(?P<close>[}\])])
+'''
+body_pattern = re.compile(body_tokens, re.VERBOSE | re.MULTILINE)
+
+# Tokens at the top level of a body, where the header of an item
+# is followed by either an equals sign or the opening brace of a block,
+# and attributes end at the end of the line.
+header_pattern = re.compile(body_tokens + r'|(?P<equals>=(?![=>]))', re.VERBOSE | re.MULTILINE)
+attribute_pattern = re.compile(body_tokens + r'|(?P<newline>\n)', re.VERBOSE | re.MULTILINE)
+
+# Tokens that change the scanner state inside quoted strings.
+string_pattern = re.compile(r'''
+    \\.
+    |\$\$\{|%%\{
+    |(?P<end>")
+    |(?P<interpolation>[$%]\{)
+    |(?P<newline>\n)
+''', re.VERBOSE)
+
+label_pattern = re.compile(r'"((?:[^"\\\n]|\\.)*)"|([^\s"{]+)')
+identifier_pattern = re.compile(r'[A-Za-z_][\w-]*')
+number_pattern = re.compile(r'-?\d+(\.\d+)?([eE][+-]?\d+)?(?![\w.])')
+whitespace_pattern = re.compile(r'(?:\s|#[^\n]*|//[^\n]*|/\*.*?\*/)*', re.DOTALL)
+
+escapes = {
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+    '"': '"',
+    '\\': '\\',
+}
+
+
+class ScanError(ValueError):
+    pass
+
+
+class Expression(str):
+    """
+    The source code of an attribute value that is not a literal value,
+    e.g. a reference to a Terraform variable or a function call.
+
+    """
+
+
+class Item(object):
+    """
+    An attribute or block found by the scanner. The start and end
+    are offsets of the item in the scanned text. The text of the item
+    is only kept if the scanner was asked to keep items of its type.
+
+    """
+
+    def __init__(self, type, labels, start, end, text):
+        self.type = type
+        self.labels = labels
+        self.start = start
+        self.end = end
+        self.text = text
+
+    def __repr__(self):
+        return '<{} {} {}:{}>'.format(
+            type(self).__name__,
+            ' '.join([self.type] + ['"{}"'.format(label) for label in self.labels]),
+            self.start,
+            self.end,
+        )
+
+
+class Attribute(Item):
+    """
+    An attribute such as `name = value`. The type of an attribute is
+    its name, and it has no labels.
+
+    """
+
+    @property
+    def value(self):
+        """
+        Returns the attribute value as a Python object if it is
+        a literal value, otherwise returns an Expression.
+
+        """
+
+        source = self.text[self.text.index('=') + 1:]
+        return parse_value(source)
+
+
+class Block(Item):
+    """
+    A block such as `type "label" { ... }`.
+
+    """
+
+    def __init__(self, type, labels, start, end, text, body_start):
+        super().__init__(type, labels, start, end, text)
+        self._body_start = body_start
+        self._items = None
+
+    def attributes(self):
+        """
+        Returns the attributes in the body of the block as a dictionary.
+
+        """
+
+        return {item.type: item.value for item in self.items() if isinstance(item, Attribute)}
+
+    def to_dict(self):
+        """
+        Returns the body of the block as a dictionary, in the same way as
+        the pyhcl library. Nested blocks become dictionaries nested under
+        their type and labels, and repeated names become lists, so that
+        HCL1 blocks such as `default { env = "dev" }` are maps.
+
+        """
+
+        values = {}
+        repeated = set()
+        for item in self.items():
+            if isinstance(item, Attribute):
+                value = item.value
+            else:
+                value = item.to_dict()
+                for label in reversed(item.labels):
+                    value = {label: value}
+            if item.type not in values:
+                values[item.type] = value
+            elif item.type in repeated:
+                values[item.type].append(value)
+            else:
+                values[item.type] = [values[item.type], value]
+                repeated.add(item.type)
+        return values
+
+    def blocks(self, type=None):
+        """
+        Returns the blocks in the body of the block,
+        optionally only those of the specified type.
+
+        """
+
+        return [item for item in self.items() if isinstance(item, Block) and type in (None, item.type)]
+
+    def items(self):
+        """
+        Returns the attributes and blocks in the body of the block.
+
+        """
+
+        if self._items is None:
+            if self.text is None:
+                raise ScanError('{} was not kept by the scanner'.format(self))
+            body = self.text[self._body_start:-1]
+            scanner = Scanner(offset=self.start + self._body_start)
+            self._items = scanner.feed(body) + scanner.close()
+        return self._items
+
+
+class Scanner(object):
+    """
+    Finds the attributes and blocks in HCL source code in a single pass,
+    without parsing them. The source code can be fed to the scanner in
+    chunks as it is generated, and each item is returned as soon as it
+    is complete. Both HCL1 and HCL2 syntax are supported.
+
+    Only the type, labels and position of each item is recorded, unless
+    the item type is one of the types to keep, in which case its text is
+    kept as well so that it can be parsed further. Keeping everything
+    is the default.
+
+    """
+
+    def __init__(self, types=None, offset=0):
+        self._types = types
+        self._pending = []
+        self._stack = []
+        self._line_number = 1
+        self._offset = offset
+
+        # The current item.
+        self._state = None
+        self._item_start = None
+        self._item_column = 0
+        self._item_parts = []
+        self._header = []
+        self._header_column = 0
+        self._body_start = None
+
+    def _error(self, message, data, pos):
+        line_number = self._line_number + data.count('\n', 0, pos)
+        return ScanError('{} on line {}'.format(message, line_number))
+
+    def _finish(self, data, column, cls):
+        """
+        Creates an item that ends at the specified position in the data.
+
+        """
+
+        if cls is Block:
+            labels = [quoted or bare for quoted, bare in label_pattern.findall(''.join(self._header))]
+            item_type, labels = labels[0], labels[1:]
+        else:
+            item_type = ''.join(self._header).strip()
+            labels = []
+
+        text = None
+        if self._types is None or item_type in self._types:
+            text = ''.join(self._item_parts) + data[self._item_column:column]
+        end = self._offset + column
+        if cls is Block:
+            item = Block(item_type, labels, self._item_start, end, text, self._body_start)
+        else:
+            item = Attribute(item_type, labels, self._item_start, end, text)
+
+        self._state = None
+        self._item_parts = []
+        self._header = []
+        return item
+
+    def _scan(self, data, items):
+        """
+        Scans some data, which must end at the end of a line
+        unless it is the end of the input.
+
+        """
+
+        stack = self._stack
+        pos = 0
+        length = len(data)
+
+        while pos < length:
+
+            if stack:
+                top = stack[-1]
+
+                if top == '"':
+                    match = string_pattern.search(data, pos)
+                    if not match:
+                        pos = length
+                        break
+                    pos = match.end()
+                    kind = match.lastgroup
+                    if kind == 'end':
+                        stack.pop()
+                    elif kind == 'interpolation':
+                        stack.append('$')
+                    elif kind == 'newline':
+                        raise self._error('unterminated string', data, match.start())
+                    continue
+
+                if top == '*':
+                    end = data.find('*/', pos)
+                    if end == -1:
+                        pos = length
+                        break
+                    stack.pop()
+                    pos = end + 2
+                    continue
+
+                if top.__class__ is tuple:
+                    # Find the end of a heredoc.
+                    match = top[0].search(data, pos)
+                    if not match:
+                        pos = length
+                        break
+                    stack.pop()
+                    pos = match.end()
+                    continue
+
+                pattern = body_pattern
+
+            elif self._state is None:
+                # Find the start of the next item.
+                top = None
+                pos = whitespace_pattern.match(data, pos).end()
+                if pos >= length:
+                    break
+                if data.startswith('/*', pos):
+                    stack.append('*')
+                    pos += 2
+                    continue
+                self._state = 'header'
+                self._item_start = self._offset + pos
+                self._item_column = pos
+                self._header_column = pos
+                pattern = header_pattern
+
+            else:
+                top = None
+                pattern = header_pattern if self._state == 'header' else attribute_pattern
+
+            match = pattern.search(data, pos)
+            if not match:
+                pos = length
+                break
+            pos = match.end()
+            kind = match.lastgroup
+
+            if kind == 'simple_string':
+                pass
+
+            elif kind == 'open':
+                if not stack and self._state == 'header' and match.group() == '{':
+                    self._header.append(data[self._header_column:match.start()])
+                    self._state = 'block'
+                    self._body_start = self._offset + pos - self._item_start
+                stack.append(match.group())
+
+            elif kind == 'close':
+                if not stack:
+                    raise self._error("unexpected '{}'".format(match.group()), data, pos)
+                stack.pop()
+                if top == '$':
+                    # Continue scanning the string around the interpolation.
+                    continue
+                if not stack and self._state == 'block':
+                    items.append(self._finish(data, pos, Block))
+
+            elif kind == 'string':
+                stack.append('"')
+
+            elif kind == 'comment':
+                end = data.find('\n', pos)
+                pos = length if end == -1 else end
+
+            elif kind == 'block_comment':
+                stack.append('*')
+
+            elif kind == 'marker':
+                marker = re.compile(r'^[ \t]*{}[ \t]*\r?$'.format(re.escape(match.group('marker'))), re.MULTILINE)
+                stack.append((marker,))
+                end = data.find('\n', pos)
+                pos = length if end == -1 else end + 1
+
+            elif kind == 'equals':
+                self._header.append(data[self._header_column:match.start()])
+                self._state = 'attribute'
+
+            elif kind == 'newline':
+                items.append(self._finish(data, match.start(), Attribute))
+
+        if self._state == 'header':
+            self._header.append(data[self._header_column:])
+            self._header_column = 0
+        if self._state is not None:
+            self._item_parts.append(data[self._item_column:])
+            self._item_column = 0
+
+        self._offset += length
+        self._line_number += data.count('\n')
+
+    def close(self):
+        """
+        Scans any remaining source code and returns the items found.
+        Raises a ScanError if the source code is incomplete.
+
+        """
+
+        items = []
+        remaining = ''.join(self._pending)
+        self._pending = []
+        if remaining:
+            self._scan(remaining, items)
+        if self._stack or self._state == 'header':
+            raise self._error('unexpected end of input', '', 0)
+        if self._state == 'attribute':
+            items.append(self._finish('', 0, Attribute))
+        return items
+
+    def feed(self, text):
+        """
+        Scans a chunk of source code and returns the items that were
+        completed by it. Incomplete lines are kept until the next chunk.
+
+        """
+
+        items = []
+        end = text.rfind('\n') + 1
+        if not end:
+            self._pending.append(text)
+            return items
+        if self._pending:
+            self._pending.append(text[:end])
+            data = ''.join(self._pending)
+        else:
+            data = text[:end]
+        self._pending = [text[end:]] if end < len(text) else []
+        self._scan(data, items)
+        return items
+
+
+def scan(text, types=None):
+    """
+    Returns the attributes and blocks in HCL source code.
+
+    """
+
+    scanner = Scanner(types=types)
+    return scanner.feed(text) + scanner.close()
+
+
+class _Parser(object):
+    """
+    Parses literal values: strings, heredocs, numbers, booleans, null,
+    lists and objects. Raises ValueError for anything else.
+
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def skip(self):
+        self.pos = whitespace_pattern.match(self.text, self.pos).end()
+
+    def expect(self, char):
+        self.skip()
+        if not self.text.startswith(char, self.pos):
+            raise ValueError('expected {!r}'.format(char))
+        self.pos += 1
+
+    def value(self):
+        self.skip()
+        text = self.text
+        char = text[self.pos:self.pos + 1]
+
+        if char == '"':
+            return self.string()
+
+        if text.startswith('<<', self.pos):
+            return self.heredoc()
+
+        if char == '[':
+            self.pos += 1
+            values = []
+            while True:
+                self.skip()
+                if text.startswith(']', self.pos):
+                    self.pos += 1
+                    return values
+                values.append(self.value())
+                self.skip()
+                if text.startswith(',', self.pos):
+                    self.pos += 1
+                elif not text.startswith(']', self.pos):
+                    raise ValueError('expected "," or "]"')
+
+        if char == '{':
+            self.pos += 1
+            values = {}
+            while True:
+                self.skip()
+                if text.startswith('}', self.pos):
+                    self.pos += 1
+                    return values
+                if text.startswith('"', self.pos):
+                    key = self.string()
+                else:
+                    match = identifier_pattern.match(text, self.pos)
+                    if not match:
+                        raise ValueError('expected object key')
+                    key = match.group()
+                    self.pos = match.end()
+                self.skip()
+                if text[self.pos:self.pos + 1] not in ('=', ':'):
+                    raise ValueError('expected "=" or ":"')
+                self.pos += 1
+                values[key] = self.value()
+                self.skip()
+                if text.startswith(',', self.pos):
+                    self.pos += 1
+
+        match = number_pattern.match(text, self.pos)
+        if match:
+            self.pos = match.end()
+            if match.group(1) or match.group(2):
+                return float(match.group())
+            return int(match.group())
+
+        match = identifier_pattern.match(text, self.pos)
+        if match and match.group() in ('true', 'false', 'null'):
+            next_char = text[match.end():match.end() + 1]
+            if next_char not in ('.', '(', '['):
+                self.pos = match.end()
+                return {'true': True, 'false': False, 'null': None}[match.group()]
+
+        raise ValueError('not a literal value')
+
+    def string(self):
+        """
+        Parses a quoted string. Interpolation sequences are left as they
+        are, in the same way as the pyhcl library.
+
+        """
+
+        self.pos += 1
+        text = self.text
+        parts = []
+        depth = 0
+        while True:
+            if self.pos >= len(text):
+                raise ValueError('unterminated string')
+            char = text[self.pos]
+            if char == '\\' and not depth:
+                escape = text[self.pos + 1:self.pos + 2]
+                if escape == 'u':
+                    parts.append(chr(int(text[self.pos + 2:self.pos + 6], 16)))
+                    self.pos += 6
+                else:
+                    parts.append(escapes.get(escape, '\\' + escape))
+                    self.pos += 2
+                continue
+            if char == '"' and not depth:
+                self.pos += 1
+                return ''.join(parts)
+            if text.startswith(('${', '%{'), self.pos) and not text.startswith(('$${', '%%{'), self.pos - 1):
+                depth += 1
+                parts.append(text[self.pos:self.pos + 2])
+                self.pos += 2
+                continue
+            if char == '}' and depth:
+                depth -= 1
+            elif char == '"' and depth:
+                # A string inside an interpolation sequence.
+                end = self.pos + 1
+                while end < len(text) and text[end] != '"':
+                    end += 2 if text[end] == '\\' else 1
+                parts.append(text[self.pos:end])
+                self.pos = end
+                char = text[end:end + 1]
+            parts.append(char)
+            self.pos += 1
+
+    def heredoc(self):
+        text = self.text
+        end = text.find('\n', self.pos)
+        if end == -1:
+            raise ValueError('unterminated heredoc')
+        match = re.match(r'<<(-)?[ \t]*"?([A-Za-z_][\w-]*)"?[ \t]*\r?$', text[self.pos:end])
+        if not match:
+            raise ValueError('invalid heredoc')
+        marker = match.group(2)
+        lines = []
+        self.pos = end + 1
+        while True:
+            if self.pos >= len(text):
+                raise ValueError('unterminated heredoc')
+            end = text.find('\n', self.pos)
+            if end == -1:
+                end = len(text)
+            line = text[self.pos:end]
+            self.pos = end + 1
+            if line.strip() == marker:
+                self.pos = end
+                break
+            lines.append(line + '\n')
+        # Like the pyhcl library, the final newline is not included,
+        # and indentation is kept for "<<-" heredocs.
+        return ''.join(lines)[:-1]
+
+
+def parse_value(source):
+    """
+    Returns a literal HCL value as a Python object, or an Expression
+    containing the source code if it is not a literal value.
+
+    """
+
+    parser = _Parser(source)
+    try:
+        value = parser.value()
+        parser.skip()
+        if parser.pos < len(source):
+            raise ValueError('unexpected text after value')
+    except (IndexError, ValueError):
+        return Expression(source.strip())
+    return value
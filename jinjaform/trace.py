@@ -0,0 +1,171 @@
+import atexit
+import glob
+import json
+import os
+import resource
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from jinjaform import log
+
+
+# Set JINJAFORM_TRACE to a file path to record a timeline of the run
+# in the Chrome trace event format, which can be opened in chrome://tracing
+# or https://ui.perfetto.dev, and to show a summary at the end of the run.
+path = os.environ.get('JINJAFORM_TRACE')
+if path:
+    path = os.path.abspath(path)
+
+_events = []
+_lock = threading.Lock()
+_pid = os.getpid()
+_next_id = [0]
+
+
+def _now():
+    return time.time() * 1000000
+
+
+def _add(event):
+    event.setdefault('pid', os.getpid())
+    event.setdefault('tid', threading.get_ident())
+    with _lock:
+        _events.append(event)
+
+
+def _add_counters(timestamp):
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    _add({
+        'name': 'peak rss (MB)',
+        'ph': 'C',
+        'ts': timestamp,
+        'args': {'rss': round(rss / 1024, 1)},
+    })
+    _add({
+        'name': 'threads',
+        'ph': 'C',
+        'ts': timestamp,
+        'args': {'threads': threading.active_count()},
+    })
+
+
+def add_span(name, start, end, **args):
+    """
+    Records a span with explicit start and end times from time.time().
+    These are shown separately from other spans because they may overlap,
+    e.g. templates waiting for variables.
+
+    """
+
+    if not path:
+        return
+    with _lock:
+        _next_id[0] += 1
+        span_id = '{}.{}'.format(os.getpid(), _next_id[0])
+    event = {'name': name, 'cat': name, 'id': span_id, 'args': args}
+    _add(dict(event, ph='b', ts=start * 1000000))
+    _add(dict(event, ph='e', ts=end * 1000000))
+
+
+def flush():
+    """
+    Writes the events recorded by this process to a file, so that
+    they can be included in the trace written by the main process.
+    This is used by forked processes, which do not write the trace.
+
+    """
+
+    if not path or not _events:
+        return
+    with _lock:
+        events = list(_events)
+        _events.clear()
+    with open('{}.{}.{}.part'.format(path, _pid, os.getpid()), 'a') as open_file:
+        for event in events:
+            open_file.write(json.dumps(event) + '\n')
+
+
+def restart():
+    """
+    Starts a new trace in a process forked by the daemon to run a command,
+    without the events recorded by the daemon.
+
+    """
+
+    global _pid
+    _pid = os.getpid()
+    with _lock:
+        del _events[:]
+
+
+def save():
+    """
+    Writes the trace file, including events from forked processes,
+    and shows a summary of where the time went.
+
+    """
+
+    if os.getpid() != _pid:
+        return
+
+    _add_counters(_now())
+    events = list(_events)
+    for part_path in sorted(glob.glob('{}.{}.*.part'.format(glob.escape(path), _pid))):
+        with open(part_path) as open_file:
+            for line in open_file:
+                events.append(json.loads(line))
+        os.remove(part_path)
+
+    with open(path, 'w') as open_file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, open_file)
+
+    totals = defaultdict(float)
+    counts = defaultdict(int)
+    starts = {}
+    peak_rss = 0
+    peak_threads = 0
+    for event in events:
+        if event['ph'] == 'X':
+            totals[event['name']] += event['dur']
+            counts[event['name']] += 1
+        elif event['ph'] == 'b':
+            starts[event['id']] = event['ts']
+        elif event['ph'] == 'e':
+            totals[event['name']] += event['ts'] - starts.pop(event['id'], event['ts'])
+            counts[event['name']] += 1
+        elif event['name'] == 'peak rss (MB)':
+            peak_rss = max(peak_rss, event['args']['rss'])
+        elif event['name'] == 'threads':
+            peak_threads = max(peak_threads, event['args']['threads'])
+
+    log.ok('trace: written to {}', path)
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]):
+        log.ok('trace: {:<20} {:>5} x {:>9.3f}s', name, counts[name], total / 1000000)
+    log.ok('trace: peak rss {} MB, peak threads {}', peak_rss, peak_threads)
+
+
+@contextmanager
+def span(name, **args):
+    """
+    Records how long the code inside the context takes to run.
+    The timing is only recorded when tracing is enabled.
+
+    """
+
+    if not path:
+        yield args
+        return
+    start = _now()
+    try:
+        yield args
+    finally:
+        end = _now()
+        _add({'name': name, 'ph': 'X', 'ts': start, 'dur': end - start, 'args': args})
+        _add_counters(end)
+
+
+if path:
+    atexit.register(save)
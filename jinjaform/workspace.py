@@ -1,441 +1,103 @@
-import hcl
-import importlib
+import hashlib
+import json
 import os
-import pkgutil
-import re
 import shutil
 import sys
-import traceback
 
 from collections import defaultdict
 from contextlib import suppress
+from functools import lru_cache
 
-from functools import partial
+from jinjaform import config, files, log, modules, trace
 
-from getpass import getpass
 
-from itertools import chain
+manifest_name = '.manifest.json'
 
-from jinja2 import Environment, StrictUndefined
-from jinja2.exceptions import UndefinedError
 
-from jinjaform import aws, log
-from jinjaform.config import cwd, env, jinjaform_root, project_root, terraform_dir, workspace_dir
-
-from queue import Queue
-
-from threading import current_thread, Event, Lock, Thread
-
-
-class Prompter(object):
+class Manifest(object):
     """
-    Helper class that allows prompts from background threads
-    to occur in the main thread. This avoids issues with
-    pressing Ctrl-C and having threads fail in the background.
+    Records the files written by the previous workspace build,
+    so that they can be left untouched when their contents are unchanged.
 
     """
 
-    def __init__(self):
-        self._queue = Queue()
-        self._prompts = {}
-        self._results = {}
-        self._running = True
-
-    def prompt(self, prompt):
-        event = Event()
-        self._prompts[event] = prompt
-        self._queue.put(event)
-        event.wait()
-        result = self._results.get(event, '')
-        if result is KeyboardInterrupt:
-            print()
-            raise KeyboardInterrupt
-        return result
-
-    def start(self):
-        while True:
-            event = self._queue.get()
-            if not event:
-                return
-            if self._running:
-                prompt = self._prompts[event]
-                try:
-                    result = getpass(prompt)
-                except KeyboardInterrupt:
-                    result = KeyboardInterrupt
-                self._results[event] = result
-            event.set()
-
-    def stop(self):
-        self._running = False
-        self._queue.put(None)
-
-
-class VarStore(object):
-
-    def __init__(self, threads):
-
-        self._running = True
-        self._lock = Lock()
-        self._threads = threads
-        self._threads_waiting = defaultdict(dict)
-        self._variables_waiting = defaultdict(list)
-
-        self._defined = set()
-        self._defaults = dict()
-        self._values = dict()
-
-        self._unresolved = defaultdict(set)
-
-    def __getitem__(self, key):
-        """
-        Returns a variable value. If the variable has not been defined
-        then this will block and wait for it.
-
-        """
+    version = 4
 
-        # Wait if the variable has not been defined yet.
-        self._wait_for_variable(key)
+    def __init__(self, path):
+        self._path = path
+        self._previous = {}
+        with suppress(FileNotFoundError, ValueError):
+            with open(path) as open_file:
+                data = json.load(open_file)
+            if data.get('version') == self.version:
+                self._previous = data
+        self._files = {}
 
-        # Return the value if the variable has been defined
-        # with a specific value or a default value.
-        if key in self._defined:
-            if key in self._values:
-                return self._values[key]
-            if key in self._defaults:
-                return self._defaults[key]
-
-        # The variable was not defined, or it was defined without a value,
-        # or it was defined but there was a deadlock when resolving it.
-        self._unresolved[current_thread()].add(key)
-        raise KeyError(key)
-
-    def _cancel(self):
+    def add_file(self, name, digest=None, sources=None):
         """
-        This function will unblock all threads waiting on a variable,
-        allowing them to continue executing without their variable.
-        They will then have an error because the variable isn't defined.
+        Records a file that has been written to the workspace, with either
+        a digest of its contents or the details of the files it was copied
+        from.
 
         """
 
-        self._running = False
-        for event in chain.from_iterable(self._variables_waiting.values()):
-            event.set()
-
-    def _check_deadlock(self):
-        """
-        Checks if there are any free threads. If all threads are blocked
-        waiting for variables to be defined, then no more variables will
-        be defined and the threads will never finish rendering. In that
-        case, cancel rendering and allow errors to be raised.
+        path = os.path.join(os.path.dirname(self._path), name)
+        stat = os.stat(path)
+        self._files[name] = {
+            'digest': digest,
+            'sources': sources,
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+        }
 
+    def file_unchanged(self, name, digest=None, sources=None):
         """
+        Checks if a file in the workspace already has the specified contents,
+        or was copied from the same unchanged source files, and has not been
+        modified since it was written.
 
-        for thread in self._get_free_threads():
-            break
-        else:
-            self._cancel()
-
-    def _define_variable(self, name, default):
         """
-        Adds a variable definition and unblocks any waiting threads.
 
-        """
-
-        with self._lock:
-            self._defined.add(name)
-            if default is not None:
-                self._defaults[name] = default
-            for event in self._variables_waiting.pop(name, []):
-                event.set()
-
-    def _get_free_threads(self):
-        """
-        Returns all threads which are not currently waiting for a variable
-        to be defined. These are important when determining if there is
-        a deadlock; if all threads are blocked waiting for variables to
-        be defined, then no more variables will be define and the threads
-        will never unblock by themselves.
-
-        """
-
-        # Return nothing if the rendering has been cancelled.
-        if not self._running:
-            return
-
-        # Check all running threads.
-        for thread in self._threads:
-            for name in self._threads_waiting[thread].values():
-                if name not in self._defined:
-                    # This thread is waiting on a variable which hasn't been
-                    # defined yet, so it is not free.
-                    break
-            else:
-                # This thread is no waiting on any variables that haven't
-                # been defined yet, so it is free.
-                yield thread
-
-    def _get_unresolved_variables(self):
-        return sorted(self._unresolved.get(current_thread(), set()))
-
-    def _set_variable_value(self, name, value):
-        self._values[name] = value
-
-    def _thread_done(self):
-        """
-        Removes the current thread and checks for a deadlock.
-
-        """
-
-        with self._lock:
-            self._threads.remove(current_thread())
-            self._check_deadlock()
-
-    def _wait_for_variable(self, name):
-        """
-        Waits for a variable to be defined in another template being rendered
-        by another thread. Returns immediately if it is already defined.
-
-        """
-
-        with self._lock:
+        previous = self._previous.get('files', {}).get(name)
+        if not previous or previous['digest'] != digest or previous['sources'] != sources:
+            return False
+        path = os.path.join(os.path.dirname(self._path), name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if stat.st_mtime_ns != previous['mtime'] or stat.st_size != previous['size']:
+            return False
+        self._files[name] = previous
+        return True
+
+    def save(self):
+        data = {
+            'version': self.version,
+            'files': self._files,
+        }
+        with open(self._path, 'w') as open_file:
+            json.dump(data, open_file, sort_keys=True)
 
-            if name in self._defined:
-                return
 
-            # Check if there are any other threads that aren't waiting on
-            # a variable. These other threads may end up defining this
-            # variable, or they may not. If there are no free threads
-            # then there is no way for the variable to be defined, so
-            # cancel the rendering and allow an error to be raised.
-            for thread in self._get_free_threads():
-                if thread != current_thread():
-                    break
-            else:
-                self._cancel()
-                return
-
-            # Create an event that will be used to block execution
-            # in this thread until another thread unblocks it.
-            event = Event()
-
-            # Add a reference to the event by the variable name.
-            # This allows another thread that defines the variable
-            # to find this thread and unblock it.
-            self._variables_waiting[name].append(event)
-
-            # Add a reference to the event by the thread.
-            # This allows other threads to check if this
-            # thread is blocked or not.
-            self._threads_waiting[current_thread()][event] = name
-
-        # Wait for the variable to be defined,
-        # or for rendering to be cancelled.
-        event.wait()
-
-        with self._lock:
-
-            # Remove the reference so this thread can be seen as free.
-            self._threads_waiting[current_thread()].pop(event)
-
-            # Check if the rendering is in a deadlock.
-            self._check_deadlock()
-
-
-class MultiTemplateRenderer(object):
-
-    def __init__(self):
-        self._threads = set()
-        self._var_store = VarStore(self._threads)
-        self._errors = []
-        self._prompter = Prompter()
-        self._rendered = {}
-        self._jinja_context = {}
-        self._jinja_environment = self._create_jinja_environment()
-
-    def _create_jinja_environment(self):
-
-        # Create a Jina2 Environment.
-        env = Environment(
-            undefined=StrictUndefined,
-            keep_trailing_newline=True,
-            extensions=[
-                'jinja2.ext.do',
-                'jinja2.ext.loopcontrols',
-            ],
-        )
-
-        # Create a context for the template to use.
-        # Include environment variables and the var store which
-        # exposes the `var.some_name` Terraform variables.
-        # Custom context values will be added below too.
-        self._jinja_context.update({
-            'aws': {
-                'session': partial(aws.get_session, mfa_prompter=self._prompter.prompt),
-            },
-        })
-        self._jinja_context.update(os.environ)
-        self._jinja_context['var'] = self._var_store
-
-        # Load Jinja2 extensions.
-        jinja_path = os.path.join(project_root, '.jinja')
-        if os.path.exists(jinja_path):
-            sys.path.insert(0, jinja_path)
-
-            context_path = os.path.join(jinja_path, 'context')
-            for module_finder, name, ispkg in pkgutil.iter_modules(path=[context_path]):
-                module = importlib.import_module('context.' + name)
-                for name in getattr(module, '__all__', []):
-                    self._jinja_context[name] = getattr(module, name)
-
-            filters_path = os.path.join(jinja_path, 'filters')
-            for module_finder, name, ispkg in pkgutil.iter_modules(path=[filters_path]):
-                module = importlib.import_module('filters.' + name)
-                for name in getattr(module, '__all__', []):
-                    env.filters[name] = getattr(module, name)
-
-            tests_path = os.path.join(jinja_path, 'tests')
-            for module_finder, name, ispkg in pkgutil.iter_modules(path=[tests_path]):
-                module = importlib.import_module('tests.' + name)
-                for name in getattr(module, '__all__', []):
-                    env.tests[name] = getattr(module, name)
-
-        return env
-
-    def _render(self, source):
-        try:
+def _populate():
+    """
+    Populates the workspace with files from the project directory tree.
+    Returns the names of the files in the workspace.
 
-            # Render the template.
-            with open(source) as open_file:
-                template = self._jinja_environment.from_string(open_file.read())
-            try:
-                rendered = template.render(**self._jinja_context)
-            except UndefinedError as error:
-                names = self._var_store._get_unresolved_variables()
-                for name in names:
-                    error = "'var.{}' cannot be resolved".format(name)
-                    self._errors.append('{} in {}'.format(error, source))
-                if not names:
-                    self._errors.append('{} in {}'.format(error, source))
-                return
-            except KeyboardInterrupt:
-                self._errors.append('interrupted')
-                return
-
-            # Save rendered templates.
-            self._rendered[source] = rendered
-
-            # Parse config.
-            try:
-                parsed = hcl.loads(rendered)
-            except ValueError:
-                parsed = {}
-                in_comment = False
-                for line in rendered:
-                    line = line.lstrip()
-                    if not line:
-                        continue
-                    if line.startswith('/*'):
-                        in_comment = True
-                    elif in_comment:
-                        if line.startswith('*/'):
-                            in_comment = False
-                        elif line.startswith('#'):
-                            continue
-                        else:
-                            log.bad('error parsing {}', source)
-                            break
-
-            # Process variables.
-            variables = parsed.get('variable', {})
-            for name, data in variables.items():
-                default = data.get('default', None)
-                self._var_store._define_variable(name, default)
-
-            # Process the default AWS provider.
-            provider = parsed.get('provider')
-            if provider and provider.get('aws'):
-                # pyhcl is broken and merges blocks
-                # so parse them with a custom function.
-                for aws_provider in _parse_aws_providers(rendered):
-                    if not aws_provider.get('alias'):
-                        aws.aws_provider.update(aws_provider)
-
-            # Process the S3 backend.
-            terraform = parsed.get('terraform')
-            if terraform:
-                backend = terraform.get('backend')
-                if backend:
-                    s3 = backend.get('s3')
-                    if s3:
-                        aws.s3_backend.update(s3)
-
-        except Exception as error:
-            etype, value, tb = sys.exc_info()
-            print('Traceback (most recent call last):')
-            traceback.print_tb(tb)
-            self._errors.append('{}: {} in {}'.format(etype.__name__, error, source))
-        finally:
-            self._var_store._thread_done()
-            if not self._threads:
-                self._prompter.stop()
-
-    def add_template(self, source):
-        self._threads.add(Thread(
-            target=self._render,
-            kwargs={'source': source},
-        ))
-
-    def set_variable_value(self, name, value):
-        self._var_store._set_variable_value(name, value)
-
-    def start(self):
-        threads = self._threads.copy()
-        for thread in threads:
-            thread.start()
-        self._prompter.start()
-        for thread in threads:
-            thread.join()
-        for error in self._errors:
-            log.bad(error)
-        success = not bool(self._errors)
-        return (success, self._rendered)
-
-
-def _parse_aws_providers(rendered):
-    blocks = []
-    buffer = []
-    for line in rendered.splitlines():
-        stripped_line = line.strip()
-        if blocks:
-            buffer.append(line)
-            if stripped_line == '}':
-                blocks.pop()
-                if not blocks:
-                    try:
-                        parsed = hcl.loads('\n'.join(buffer))
-                    except ValueError:
-                        log.bad('Error parsing AWS provider:\n{}', '\n'.join(buffer))
-                        raise
-                    else:
-                        yield parsed['provider']['aws']
-                    buffer.clear()
-            else:
-                match = re.match(r'^([a-z_]+)\s+\{$', stripped_line)
-                if match:
-                    blocks.append(match.group(1))
-        else:
-            match = re.match(r'^(provider\s+"aws")\s+\{$', stripped_line)
-            if match:
-                blocks.append(match.group(1))
-                buffer.append(line)
+    """
 
+    # Import this here rather than at the top of the module,
+    # so that commands which do not create a workspace start quickly.
+    from jinjaform.render import create_renderer
 
-def _populate():
+    # Load the manifest from the previous build, which is used
+    # to avoid writing files when nothing has changed.
+    manifest = Manifest(os.path.join(config.workspace_dir, manifest_name))
 
     # Create a template renderer that can handle multiple files
     # with variable references between files.
-    template_renderer = MultiTemplateRenderer()
+    template_renderer = create_renderer()
 
     # Discover files to create in the workspace. Files in multiple
     # levels of the project directory tree with the same name will
@@ -445,99 +107,152 @@ def _populate():
     tf_files = defaultdict(set)
     other_files = defaultdict(set)
 
-    current = cwd
-    while (current + '/').startswith(project_root + '/'):
-        for name in sorted(os.listdir(current)):
-            if name.startswith('.'):
-                continue
-            path = os.path.join(current, name)
-            if os.path.isdir(path):
-                continue
-            name = name.lower()
-            if name.endswith('.tfvars'):
-                tfvars_files[name].add(path)
-            elif name.endswith('.tf'):
-                tf_files[name].add(path)
-            else:
-                other_files[name].add(path)
-        current = os.path.dirname(current)
+    with trace.span('walk'):
+        current = config.cwd
+        while (current + '/').startswith(config.project_root + '/'):
+            # Directory entries include the file type,
+            # so this does not need to stat every file.
+            for entry in os.scandir(current):
+                if entry.name.startswith('.') or entry.is_dir():
+                    continue
+                path = entry.path
+                name = entry.name.lower()
+                if name.endswith('.tfvars'):
+                    tfvars_files[name].add(path)
+                elif name.endswith('.tf'):
+                    tf_files[name].add(path)
+                else:
+                    other_files[name].add(path)
+            current = os.path.dirname(current)
 
     # Process .tfvars files first, and read their variable values,
     # because they are required when rendering .tf files.
 
-    for name in sorted(tfvars_files):
+    with trace.span('tfvars'):
+        for name in sorted(tfvars_files):
 
-        source_paths = sorted(tfvars_files[name])
-        target_path = os.path.join(workspace_dir, name)
+            source_paths = sorted(tfvars_files[name])
 
-        if len(source_paths) == 1:
-            log.ok('copy: {}', name)
-        else:
-            log.ok('combine: {}', name)
+            if len(source_paths) == 1:
+                log.ok('copy: {}', name)
+            else:
+                log.ok('combine: {}', name)
 
-        with open(target_path, 'w') as output_file:
+            contents = []
 
             for source_path in source_paths:
 
                 with open(source_path) as source_file:
                     source_file_contents = source_file.read()
 
-                relative_source_path = os.path.relpath(source_path, project_root)
-                output_file.write('# jinjaform: {}'.format(relative_source_path))
-                output_file.write('\n\n')
-                output_file.write(source_file_contents)
-                output_file.write('\n')
+                relative_source_path = os.path.relpath(source_path, config.project_root)
+                contents.append('# jinjaform: {}'.format(relative_source_path))
+                contents.append('\n\n')
+                contents.append(source_file_contents)
+                contents.append('\n')
 
                 if name == 'terraform.tfvars':
-                    for key, value in hcl.loads(source_file_contents).items():
+                    for key, value in load_tfvars(source_file_contents).items():
                         template_renderer.set_variable_value(key, value)
 
+            _write_file(manifest, name, ''.join(contents))
+
     # Process .tf files as templates.
 
-    for name in sorted(tf_files):
+    with trace.span('templates'):
+        for name in sorted(tf_files):
 
-        source_paths = sorted(tf_files[name])
+            source_paths = sorted(tf_files[name])
 
-        log.ok('render: {}', name)
+            log.ok('render: {}', name)
 
-        for source_path in source_paths:
-            template_renderer.add_template(source_path)
+            for source_path in source_paths:
+                template_renderer.add_template(source_path)
 
-    success, rendered = template_renderer.start()
+        success, rendered = template_renderer.start()
     if not success:
         sys.exit(1)
 
-    for name in sorted(tf_files):
+    with trace.span('write'):
+        for name in sorted(tf_files):
 
-        source_paths = sorted(tf_files[name])
-        target_path = os.path.join(workspace_dir, name)
+            source_paths = sorted(tf_files[name])
 
-        with open(target_path, 'w') as output_file:
+            contents = []
 
             for source_path in source_paths:
 
-                relative_source_path = os.path.relpath(source_path, project_root)
-                output_file.write('# jinjaform: {}'.format(relative_source_path))
-                output_file.write('\n\n')
-                output_file.write(rendered[source_path])
-                output_file.write('\n')
+                relative_source_path = os.path.relpath(source_path, config.project_root)
+                contents.append('# jinjaform: {}'.format(relative_source_path))
+                contents.append('\n\n')
+                contents.append(rendered[source_path])
+                contents.append('\n')
+
+            _write_file(manifest, name, ''.join(contents))
 
     # Process remaining files. Do not add source comments because
     # the file format is unknown (e.g. json files would break with #).
-    for name in sorted(other_files):
+    with trace.span('copy'):
+        for name in sorted(other_files):
 
-        source_paths = sorted(other_files[name])
-        target_path = os.path.join(workspace_dir, name)
+            source_paths = sorted(other_files[name])
 
-        if len(source_paths) == 1:
-            log.ok('copy: {}', name)
-        else:
-            log.ok('combine: {}', name)
+            if len(source_paths) == 1:
+                log.ok('copy: {}', name)
+            else:
+                log.ok('combine: {}', name)
 
-        with open(target_path, 'w') as output_file:
-            for source_path in source_paths:
-                with open(source_path) as source_file:
-                    output_file.write(source_file.read())
+            _copy_file(manifest, name, source_paths)
+
+    manifest.save()
+
+    return set(tfvars_files) | set(tf_files) | set(other_files)
+
+
+def _copy_file(manifest, name, source_paths):
+    """
+    Copies files to the workspace, combining them if there are multiple,
+    unless the source files and the workspace file have not changed since
+    the previous build, in which case the file is left untouched.
+
+    """
+
+    sources = []
+    for source_path in source_paths:
+        stat = os.stat(source_path)
+        sources.append([source_path, stat.st_ino, stat.st_mtime_ns, stat.st_size])
+
+    if manifest.file_unchanged(name, sources=sources):
+        return
+
+    files.copy(source_paths, os.path.join(config.workspace_dir, name))
+
+    manifest.add_file(name, sources=sources)
+
+
+@lru_cache()
+def get_hcl_parser():
+    """
+    Returns an HCL parser. Creating a parser builds its parsing tables,
+    which takes much longer than parsing a file, so it is reused.
+
+    """
+
+    from hcl.parser import HclParser
+    return HclParser()
+
+
+def load_tfvars(contents):
+    """
+    Returns the variable values in the contents of a .tfvars file,
+    which can be HCL or JSON.
+
+    """
+
+    from hcl.api import isHcl
+    if isHcl(contents):
+        return get_hcl_parser().parse(contents)
+    return json.loads(contents)
 
 
 def _remove(path):
@@ -550,28 +265,65 @@ def _remove(path):
             os.remove(path)
 
 
-def clean():
-    if os.path.exists(workspace_dir):
-        for name in os.listdir(workspace_dir):
-            if name != '.terraform':
-                _remove(os.path.join(workspace_dir, name))
+def _write_file(manifest, name, contents):
+    """
+    Writes a file to the workspace, unless it already exists with
+    the same contents, in which case it is left untouched.
+
+    """
+
+    if isinstance(contents, str):
+        contents = contents.encode('utf-8')
+
+    digest = hashlib.sha256(contents).hexdigest()
+    if manifest.file_unchanged(name, digest):
+        return
+
+    with open(os.path.join(config.workspace_dir, name), 'wb') as output_file:
+        output_file.write(contents)
+
+    manifest.add_file(name, digest)
+
+
+def clean(keep=()):
+    """
+    Removes files from the workspace, except for the .terraform directory,
+    the build manifest, and any other specified file names.
+
+    """
+
+    if os.path.exists(config.workspace_dir):
+        for name in os.listdir(config.workspace_dir):
+            if name not in ('.terraform', manifest_name) and name not in keep:
+                _remove(os.path.join(config.workspace_dir, name))
+
+
+def render():
+    """
+    Renders the Terraform configuration files into the workspace,
+    without preparing it for Terraform to run.
+
+    """
+
+    os.makedirs(config.workspace_dir, exist_ok=True)
+
+    # Populate workspace with Terraform configuration files,
+    # then remove any files left over from previous builds.
+    names = _populate()
+    clean(keep=names)
 
 
 def create():
     # Ensure the .jinjaform/.terraform directory exists.
-    os.makedirs(terraform_dir, exist_ok=True)
-
-    # Create a shared modules directory for the entire project.
-    module_cache_dir = os.path.join(jinjaform_root, 'modules')
-    os.makedirs(module_cache_dir, exist_ok=True)
-    module_link = os.path.join(terraform_dir, 'modules')
-    _remove(module_link)
-    os.symlink(module_cache_dir, module_link)
+    os.makedirs(config.terraform_dir, exist_ok=True)
 
     # Create a shared plugin cache directory for the entire project.
-    plugin_cache_dir = os.path.join(jinjaform_root, 'plugins')
+    plugin_cache_dir = os.path.join(config.jinjaform_root, 'plugins')
     os.makedirs(plugin_cache_dir, exist_ok=True)
-    env['TF_PLUGIN_CACHE_DIR'] = plugin_cache_dir
+    config.env['TF_PLUGIN_CACHE_DIR'] = plugin_cache_dir
+
+    render()
 
-    # Populate workspace with Terraform configuration files.
-    _populate()
+    # Use modules from the module store shared by the entire project.
+    with trace.span('modules'):
+        modules.prepare()
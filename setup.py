@@ -18,7 +18,7 @@ setup(
     ),
     entry_points = {
         'console_scripts': (
-            'jinjaform=jinjaform.__main__:main',
+            'jinjaform=jinjaform.daemon:client_main',
         ),
     },
     install_requires=(
@@ -0,0 +1,9 @@
+from jinjaform.memoize import cached
+
+
+@cached(ttl=60)
+def example_cached_func(name):
+    return 'hello {}'.format(name)
+
+
+__all__ = ['example_cached_func']
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Checks which stacks "jinjaform affected" lists for changes in a git
+repository, and that the project index finds stacks added after it
+was saved.
+
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers.checks import check, finish  # noqa: E402
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+files = {
+    '.gitignore': '.jinjaform/\n',
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    '.jinja/filters/upper.py': '',
+    'README.md': '',
+    'app/shared.tf': '',
+    'app/dev/main.tf': '',
+    'app/prod/main.tf': '',
+    'app/prod/files/policy.json': '',
+    'app/modules/thing/main.tf': '',
+    'dns/main.tf': '',
+}
+
+
+def git(*args):
+    subprocess.check_output(('git',) + args, cwd=project_root, env=env, stderr=subprocess.STDOUT)
+
+
+def write(name, content=''):
+    path = os.path.join(project_root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as open_file:
+        open_file.write(content)
+
+
+def affected(cwd=''):
+    output = subprocess.check_output(
+        [sys.executable, '-m', 'jinjaform', 'affected', '--since', 'HEAD'],
+        cwd=os.path.join(project_root, cwd),
+        env=env,
+    )
+    return output.decode('utf-8').splitlines()
+
+
+def change(description, name, expected):
+    """
+    Changes a file and checks the affected stacks,
+    then reverts the change.
+
+    """
+
+    write(name, 'changed\n')
+    check(description, affected(), expected)
+    git('reset', '--quiet', '--hard')
+    git('clean', '--quiet', '-d', '--force')
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-affected-')
+try:
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_EMAIL='test@example.com',
+        GIT_AUTHOR_NAME='test',
+        GIT_COMMITTER_EMAIL='test@example.com',
+        GIT_COMMITTER_NAME='test',
+        GIT_CONFIG_GLOBAL=os.devnull,
+        GIT_CONFIG_NOSYSTEM='1',
+        PYTHONPATH=os.path.abspath(root),
+    )
+    for name, content in files.items():
+        write(name, content)
+    git('init', '--quiet')
+    git('add', '.')
+    git('commit', '--quiet', '-m', 'project')
+
+    check('nothing is affected without changes', affected(), [])
+    change('changes in a stack affect it', 'app/dev/main.tf', ['app/dev'])
+    change('changes in subdirectories of a stack affect it', 'app/prod/files/policy.json', ['app/prod'])
+    change('changes in a parent directory affect the stacks below it', 'app/shared.tf', ['app/dev', 'app/prod'])
+    change('changes in modules affect the stacks that can use them', 'app/modules/thing/main.tf', ['app/dev', 'app/prod'])
+    change('changes in the project root affect every stack', 'README.md', ['app/dev', 'app/prod', 'dns'])
+    change('changes to extensions affect every stack', '.jinja/filters/upper.py', ['app/dev', 'app/prod', 'dns'])
+    change('changes to .jinjaformrc affect every stack', '.jinjaformrc', ['app/dev', 'app/prod', 'dns'])
+    change('untracked files affect their stacks', 'dns/records.tf', ['dns'])
+    change('new stacks are found', 'web/main.tf', ['web'])
+    change('stacks can have subdirectories', 'web/files/index.html', [])
+
+    write('app/dev/main.tf', 'changed\n')
+    check('only stacks under the current directory are listed', affected('app'), ['dev'])
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
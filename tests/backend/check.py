@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Checks that S3 backend buckets and DynamoDB lock tables are only created
+once when many stacks set up the same backend at the same time, using
+moto to mock AWS. Each thread stands in for a stack, and uses the same
+locks and results cache that separate processes would.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+
+# Use fake credentials so that nothing can reach a real AWS account.
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'eu-west-1',
+    'JINJAFORM_AWS_CREDENTIALS_CACHE': '0',
+})
+os.environ.pop('AWS_PROFILE', None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import botocore.client  # noqa: E402
+
+from moto import mock_aws  # noqa: E402
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import aws, config, log  # noqa: E402
+
+
+region = 'eu-west-1'
+bucket = 'jinjaform-backend-test'
+table = 'jinjaform-backend-test'
+stacks = 4
+
+
+def count_calls(calls):
+    """
+    Records the AWS API operations that are called.
+
+    """
+
+    make_api_call = botocore.client.BaseClient._make_api_call
+
+    def recording_make_api_call(self, operation_name, api_params):
+        calls.append(operation_name)
+        return make_api_call(self, operation_name, api_params)
+
+    botocore.client.BaseClient._make_api_call = recording_make_api_call
+
+
+def reset():
+    """
+    Forgets everything that was verified, like a new process
+    with an empty results cache.
+
+    """
+
+    aws.verified.clear()
+    shutil.rmtree(os.path.join(config.jinjaform_root, 'cache'), ignore_errors=True)
+
+
+def run_stacks(target):
+    errors = []
+
+    def run():
+        try:
+            target()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=run) for _ in range(stacks)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def main():
+
+    config.jinjaform_root = tempfile.mkdtemp(prefix='jinjaform-backend-')
+    log.accept = lambda question, *args, **kwargs: True
+    calls = []
+    count_calls(calls)
+
+    try:
+        with mock_aws():
+            session = aws.get_session(region_name=region)
+            s3_client = aws.get_client(session, 's3')
+            dynamodb_client = aws.get_client(session, 'dynamodb')
+
+            # Every stack checks before any of them creates anything.
+            actions = [aws._check_bucket(s3_client, '123456789012', region, bucket) for _ in range(stacks)]
+            check('every stack finds the bucket missing', actions, ['create'] * stacks)
+            actions = [aws._check_table(dynamodb_client, '123456789012', region, table) for _ in range(stacks)]
+            check('every stack finds the table missing', actions, ['create'] * stacks)
+
+            errors = run_stacks(lambda: aws._create_bucket(s3_client, '123456789012', region, bucket, 'create'))
+            check('creating the bucket from every stack succeeds', errors, [])
+            check('the bucket is created once', calls.count('CreateBucket'), 1)
+            errors = run_stacks(lambda: aws._create_table(dynamodb_client, '123456789012', region, table, 'create'))
+            check('creating the table from every stack succeeds', errors, [])
+            check('the table is created once', calls.count('CreateTable'), 1)
+
+            # Another process created them after this one checked.
+            reset()
+            aws._create_bucket(s3_client, '123456789012', region, bucket, 'create')
+            aws._create_table(dynamodb_client, '123456789012', region, table, 'create')
+            versioning = s3_client.get_bucket_versioning(Bucket=bucket)
+            check('a bucket that already exists is accepted and versioned', versioning.get('Status'), 'Enabled')
+
+            # Set up a new backend from every stack at the same time.
+            reset()
+            del calls[:]
+            aws.aws_provider.update(region=region)
+            aws.s3_backend.update(region=region, bucket=bucket + '-2', dynamodb_table=table + '-2')
+            errors = run_stacks(aws.backend_setup)
+            check('setting up the backend from every stack succeeds', errors, [])
+            check('the new bucket is created once', calls.count('CreateBucket'), 1)
+            check('the new table is created once', calls.count('CreateTable'), 1)
+
+            # Later runs use the results cache.
+            aws.verified.clear()
+            del calls[:]
+            aws.backend_setup()
+            check('a later run makes no AWS requests', calls, [])
+    finally:
+        shutil.rmtree(config.jinjaform_root)
+
+    finish()
+
+
+if __name__ == '__main__':
+    main()
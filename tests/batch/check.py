@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Checks how stacks are found for the -all option, which AWS providers are
+found for getting credentials before running stacks, and that prompts
+fail rather than being answered with "no" when running stacks in parallel.
+
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import batch, config, log  # noqa: E402
+
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'provider.tf': 'provider "aws" {\n  region = "eu-west-1"\n}\n',
+    'app/dev/main.tf': 'provider "aws" {\n  profile = "dev"\n}\n',
+    'app/prod/main.tf': 'provider "aws" {\n  profile = "{{ var.profile }}"\n}\n',
+    'app/shared.tf': 'provider "aws" {\n  alias   = "other"\n  profile = "other"\n}\n',
+    'app/modules/thing/main.tf': '',
+    'dns/main.tf': '',
+    'dns/files/zone.txt': '',
+    'empty/README.md': '',
+    '.hidden/main.tf': '',
+}
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-batch-')
+try:
+    for name, content in files.items():
+        path = os.path.join(project_root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as open_file:
+            open_file.write(content)
+    config.project_root = project_root
+
+    stacks = batch.discover_stacks(project_root)
+    check(
+        'stacks are directories with Terraform files and no stacks below them',
+        [os.path.relpath(stack, project_root) for stack in stacks],
+        ['app/dev', 'app/prod', 'dns'],
+    )
+
+    check(
+        'default AWS providers are found in stacks and parent directories',
+        batch._get_providers(stacks),
+        [{'profile': 'dev'}, {'region': 'eu-west-1'}, {}],
+    )
+
+    log.interactive = False
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            answer = log.accept('backend: create s3://example in eu-west-1')
+    except SystemExit as error:
+        answer = error.code
+    check('prompts fail when they cannot be answered', answer, 1)
+    check(
+        'prompts that cannot be answered are explained',
+        'cannot ask "backend: create s3://example in eu-west-1"' in output.getvalue(),
+        True,
+    )
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Checks that compiled templates are cached on disk and shared by stacks,
+and that they are compiled again when the template source or the custom
+extensions change, when a cache file is damaged, or when the cache is
+evicted.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import jinja2  # noqa: E402
+
+from helpers.checks import check, finish, read, write_files  # noqa: E402
+from jinjaform import config, render, workspace  # noqa: E402
+
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'common.tf': '# common {{ var.name }}\n',
+    'a/main.tf': 'variable "name" {\n  default = "a"\n}\n',
+    'b/main.tf': 'variable "name" {\n  default = "b"\n}\n# {{ "b" }}\n',
+}
+
+compiled = []
+original_compile = jinja2.Environment.compile
+
+
+def count_compile(self, source, *args, **kwargs):
+    compiled.append(source)
+    return original_compile(self, source, *args, **kwargs)
+
+
+jinja2.Environment.compile = count_compile
+
+
+def build(name):
+    """
+    Builds the workspace of a stack, and returns the number
+    of templates that were compiled.
+
+    """
+
+    del compiled[:]
+    config.load(os.path.join(project_root, name), ['plan'])
+    workspace.render()
+    return len(compiled)
+
+
+def cache_files():
+    return sorted(os.listdir(os.path.join(project_root, '.jinjaform', 'cache', 'bytecode')))
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-bytecode-')
+try:
+    write_files(project_root, files)
+
+    check('every template is compiled by the first stack', build('a'), 2)
+    check('compiled templates are stored', len(cache_files()), 2)
+    check('templates shared with another stack are not compiled again', build('b'), 1)
+    check('templates are not compiled by later builds', build('a'), 0)
+    check('cached templates are rendered', read(os.path.join(project_root, 'a', '.jinjaform', 'common.tf')).endswith('# common a\n\n'), True)
+
+    write_files(project_root, {'common.tf': '# common changed {{ var.name }}\n'})
+    check('changed templates are compiled again', build('a'), 1)
+    check('changed templates are rendered', read(os.path.join(project_root, 'a', '.jinjaform', 'common.tf')).endswith('# common changed a\n\n'), True)
+
+    for name in cache_files():
+        write_files(project_root, {os.path.join('.jinjaform', 'cache', 'bytecode', name): 'damaged'})
+    check('damaged cache files are compiled again', build('a'), 2)
+    check('templates from damaged cache files are rendered', read(os.path.join(project_root, 'a', '.jinjaform', 'common.tf')).endswith('# common changed a\n\n'), True)
+
+    # Extensions are read once per process, like the environment.
+    write_files(project_root, {'.jinja/filters/shout.py': 'def shout(value):\n    return value.upper()\n\n\n__all__ = [\'shout\']\n'})
+    render.get_environment.cache_clear()
+    check('templates are compiled again when extensions change', build('a'), 2)
+
+    # The cache is only evicted after it has grown.
+    write_files(project_root, {'common.tf': '# common {{ var.name }}\n'})
+    os.environ['JINJAFORM_BYTECODE_CACHE_SIZE'] = '0'
+    try:
+        build('a')
+    finally:
+        del os.environ['JINJAFORM_BYTECODE_CACHE_SIZE']
+    check('the cache is evicted when it grows beyond its size', cache_files(), [])
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
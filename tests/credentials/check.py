@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Checks that temporary credentials for an assumed role are cached on disk
+and shared by sessions in other processes, so that only one of them calls
+STS, using moto to mock AWS. Each new session stands in for a process,
+and threads stand in for processes starting at the same time.
+
+"""
+
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+
+temp_dir = tempfile.mkdtemp(prefix='jinjaform-credentials-')
+
+# Use a profile that assumes a role using fake credentials, so that
+# nothing can reach a real AWS account, and an empty cache directory.
+config_path = os.path.join(temp_dir, 'config')
+with open(config_path, 'w') as open_file:
+    open_file.write(
+        '[profile base]\n'
+        'aws_access_key_id = testing\n'
+        'aws_secret_access_key = testing\n'
+        'region = eu-west-1\n'
+        '\n'
+        '[profile role]\n'
+        'role_arn = arn:aws:iam::123456789012:role/jinjaform-test\n'
+        'source_profile = base\n'
+        'region = eu-west-1\n'
+    )
+os.environ.update({
+    'AWS_CONFIG_FILE': config_path,
+    'AWS_SHARED_CREDENTIALS_FILE': os.path.join(temp_dir, 'credentials'),
+    'XDG_CACHE_HOME': os.path.join(temp_dir, 'cache'),
+})
+for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE', 'JINJAFORM_AWS_CREDENTIALS_CACHE'):
+    os.environ.pop(name, None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import botocore.client  # noqa: E402
+
+from moto import mock_aws  # noqa: E402
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import aws, credentials  # noqa: E402
+
+
+def count_calls(calls):
+    """
+    Records the AWS API operations that are called.
+
+    """
+
+    make_api_call = botocore.client.BaseClient._make_api_call
+
+    def recording_make_api_call(self, operation_name, api_params):
+        calls.append(operation_name)
+        return make_api_call(self, operation_name, api_params)
+
+    botocore.client.BaseClient._make_api_call = recording_make_api_call
+
+
+def get_access_key():
+    """
+    Returns the access key of a new session for the role profile,
+    like a separate Jinjaform process would use.
+
+    """
+
+    session = aws._create_session(profile_name='role')
+    return session.get_credentials().get_frozen_credentials().access_key
+
+
+try:
+    with mock_aws():
+
+        calls = []
+        count_calls(calls)
+
+        access_key = get_access_key()
+        check('the role is assumed', calls, ['AssumeRole'])
+
+        cache_dir = credentials._get_cache_dir()
+        cache_files = [name for name in os.listdir(cache_dir) if name.endswith('.json')]
+        check('credentials are cached on disk', len(cache_files), 1)
+        cache_path = os.path.join(cache_dir, cache_files[0])
+        check('the cache directory is private', stat.S_IMODE(os.stat(cache_dir).st_mode), 0o700)
+
+        check('other sessions use the cached credentials', get_access_key(), access_key)
+        check('other sessions do not assume the role', calls, ['AssumeRole'])
+
+        # Credentials that will expire soon are replaced.
+        with open(cache_path) as open_file:
+            metadata = json.load(open_file)
+        metadata['expiry_time'] = (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat()
+        with open(cache_path, 'w') as open_file:
+            json.dump(metadata, open_file)
+        del calls[:]
+        access_key = get_access_key()
+        check('credentials that expire soon are refreshed', calls, ['AssumeRole'])
+
+        # Sessions starting at the same time wait for one of them.
+        os.remove(cache_path)
+        del calls[:]
+        with ThreadPoolExecutor(4) as executor:
+            access_keys = list(executor.map(lambda _: get_access_key(), range(4)))
+        check('sessions starting at the same time assume the role once', calls, ['AssumeRole'])
+        check('sessions starting at the same time share credentials', len(set(access_keys)), 1)
+
+finally:
+    shutil.rmtree(temp_dir)
+
+finish()
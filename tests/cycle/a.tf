@@ -0,0 +1,7 @@
+variable "a" {
+  default = "a"
+}
+
+{% if var.b == "never" %}
+# b is never
+{% endif %}
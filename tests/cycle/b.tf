@@ -0,0 +1,7 @@
+variable "b" {
+  default = "b"
+}
+
+{% if false %}
+# {{ var.a }}
+{% endif %}
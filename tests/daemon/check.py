@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Checks that commands run in the daemon for a project with the client's
+terminal and exit code, that commands the daemon cannot run are run by
+the client instead, that commands from other users are refused, and that
+the daemon restarts when the custom extensions change.
+
+"""
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish, read, write_files  # noqa: E402
+from jinjaform import __version__, daemon  # noqa: E402
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    '.jinja/filters/shout.py': "__all__ = ['shout']\n\n\ndef shout(value):\n    return value.upper()\n",
+    'stack/main.tf': '# {{ "quiet" | shout }}\n',
+}
+
+# Exits with the code in an environment variable,
+# to check that the client's environment and exit code are used.
+terraform = '#!/bin/sh\necho "terraform $@"\nexit ${TERRAFORM_EXIT_CODE:-0}\n'
+
+
+def jinjaform(cwd, *args, **env):
+    """
+    Runs the jinjaform command, which uses the daemon if it is running.
+
+    """
+
+    return subprocess.run(
+        [sys.executable, '-c', 'from jinjaform.daemon import client_main; client_main()'] + list(args),
+        cwd=cwd,
+        env=dict(base_env, **env),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        timeout=60,
+    )
+
+
+def status():
+    """
+    Returns the number of commands run by the daemon, waiting
+    for it to start if it is restarting.
+
+    """
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        response = daemon.ping(project_root)
+        if response:
+            return response['commands']
+        time.sleep(0.1)
+    return None
+
+
+temp_dir = tempfile.mkdtemp(prefix='jinjaform-daemon-')
+try:
+    project_root = os.path.join(temp_dir, 'project')
+    stack = os.path.join(project_root, 'stack')
+    write_files(project_root, files)
+
+    bin_dir = os.path.join(temp_dir, 'bin')
+    write_files(bin_dir, {'terraform': terraform})
+    os.chmod(os.path.join(bin_dir, 'terraform'), 0o755)
+
+    runtime_dir = os.path.join(temp_dir, 'run')
+    os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+    base_env = {
+        name: value for name, value in os.environ.items()
+        if not name.startswith('JINJAFORM_')
+    }
+    base_env.update(
+        PATH=bin_dir + os.pathsep + os.environ['PATH'],
+        PYTHONPATH=os.path.abspath(root),
+    )
+
+    socket_path = daemon.get_socket_path(project_root)
+    check('sockets are in a directory for the current user', os.path.dirname(socket_path), os.path.join(runtime_dir, 'jinjaform-{}'.format(os.getuid())))
+    check('socket paths are short', len(socket_path) < len(runtime_dir) + 60, True)
+
+    # Messages and file descriptors are passed over the socket.
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with left, right, tempfile.TemporaryFile() as open_file:
+        daemon._send(left, {'message': 'x' * 100000}, fds=[open_file.fileno()])
+        message, fds = daemon._receive(right)
+        check('large messages are received whole', message, {'message': 'x' * 100000})
+        check('file descriptors are received', [os.fstat(fd).st_ino for fd in fds], [os.fstat(open_file.fileno()).st_ino])
+        for fd in fds:
+            os.close(fd)
+        left.close()
+        check('closed sockets are received as None', daemon._receive(right), (None, []))
+
+    # Commands from other users are refused, and their terminals closed.
+    server = daemon.Server(project_root)
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with left, right:
+        daemon._send(left, {'args': [], 'cwd': stack, 'env': {}, 'version': __version__}, fds=(0, 1, 2))
+        getuid = os.getuid
+        os.getuid = lambda: getuid() + 1
+        try:
+            server._handle(right)
+        finally:
+            os.getuid = getuid
+        check('commands from other users are refused', daemon._receive(left), ({'fallback': 'not the same user'}, []))
+        check('commands from other users are not run', server.count, 0)
+
+    # A socket directory that other users can use is refused.
+    os.makedirs(os.path.dirname(socket_path), mode=0o755)
+    os.chmod(os.path.dirname(socket_path), 0o755)
+    process = jinjaform(project_root, 'daemon', 'run')
+    check('socket directories must only be accessible by the current user', (process.returncode, 'must only be accessible' in process.stdout), (1, True))
+    os.chmod(os.path.dirname(socket_path), 0o700)
+
+    process = jinjaform(stack, 'daemon', 'start')
+    check('the daemon starts', process.returncode, 0)
+    try:
+
+        process = jinjaform(stack, 'get')
+        check('commands write to the client terminal', (process.returncode, 'terraform get' in process.stdout.splitlines()), (0, True))
+        check('commands run in the daemon', status(), 1)
+
+        process = jinjaform(stack, 'get', TERRAFORM_EXIT_CODE='3')
+        check('commands use the client environment and exit code', process.returncode, 3)
+        check('failed commands run in the daemon', status(), 2)
+
+        process = jinjaform(stack, 'get', JINJAFORM_RENDER_THREADS='2')
+        check('commands with different settings run in the client', (process.returncode, 'terraform get' in process.stdout.splitlines()), (0, True))
+        check('commands with different settings do not run in the daemon', status(), 2)
+
+        process = jinjaform(stack, 'get', JINJAFORM_DAEMON='0')
+        check('the daemon can be disabled', (process.returncode, status()), (0, 2))
+
+        pid = daemon.ping(project_root)['pid']
+        write_files(project_root, {'.jinja/filters/shout.py': "__all__ = ['shout']\n\n\ndef shout(value):\n    return value.upper() + '!'\n"})
+        process = jinjaform(stack, 'get')
+        check('commands run in the client when the extensions have changed', (process.returncode, status()), (0, 0))
+        check('changed extensions are used', '# QUIET!' in read(os.path.join(stack, '.jinjaform', 'main.tf')).splitlines(), True)
+        check('the daemon restarts in the same process', daemon.ping(project_root)['pid'], pid)
+
+        process = jinjaform(stack, 'get')
+        check('commands run in the restarted daemon', (process.returncode, status()), (0, 1))
+
+    finally:
+        process = jinjaform(stack, 'daemon', 'stop')
+        check('the daemon stops', (process.returncode, daemon.ping(project_root)), (0, None))
+        check('the socket is removed', os.path.exists(socket_path), False)
+
+finally:
+    shutil.rmtree(temp_dir)
+
+finish()
@@ -0,0 +1,3 @@
+# tags.env = {{ var.tags.env }}
+# heredoc = {{ var.heredoc | tojson }}
+# indented = {{ var.indented | tojson }}
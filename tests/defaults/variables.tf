@@ -0,0 +1,19 @@
+variable "tags" {
+  default {
+    env = "dev"
+  }
+}
+
+variable "heredoc" {
+  default = <<EOF
+line1
+  line2
+EOF
+}
+
+variable "indented" {
+  default = <<-EOF
+    line1
+      line2
+    EOF
+}
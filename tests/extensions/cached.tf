@@ -0,0 +1,2 @@
+# example_cached_func should output hello world: {{ example_cached_func('world') }} {{ example_cached_func('world') }}
+# cached should output 0 1: {% for item in cached(example_func, 2) %}{{ item }} {% endfor %}
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Checks that files copied into the workspace are separate from their
+sources, so that changing a workspace file leaves the project unchanged.
+
+"""
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import files  # noqa: E402
+
+
+def read(path):
+    with open(path) as open_file:
+        return open_file.read()
+
+
+def write(path, content):
+    with open(path, 'w') as open_file:
+        open_file.write(content)
+
+
+temp_dir = tempfile.mkdtemp(prefix='jinjaform-files-')
+try:
+    source = os.path.join(temp_dir, 'source.txt')
+    other = os.path.join(temp_dir, 'other.txt')
+    destination = os.path.join(temp_dir, 'destination.txt')
+    write(source, 'source\n')
+    write(other, 'other\n')
+
+    files.copy([source], destination)
+    check('a single file is copied', read(destination), 'source\n')
+    check('a single file is not hard linked', os.path.samefile(source, destination), False)
+    write(destination, 'changed\n')
+    check('changing the copy leaves the source unchanged', read(source), 'source\n')
+
+    os.remove(destination)
+    os.link(source, destination)
+    files.copy([source], destination, mode=0o755)
+    check('a hard linked destination is replaced', os.path.samefile(source, destination), False)
+    check('the mode is applied', stat.S_IMODE(os.stat(destination).st_mode), 0o755)
+    check('the source mode is unchanged', stat.S_IMODE(os.stat(source).st_mode) == 0o755, False)
+
+    files.copy([source, other], destination)
+    check('multiple files are combined', read(destination), 'source\nother\n')
+
+    check('no temporary files are left', sorted(os.listdir(temp_dir)), ['destination.txt', 'other.txt', 'source.txt'])
+
+finally:
+    shutil.rmtree(temp_dir)
+
+finish()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Checks the git checks against a clone of a local bare repository,
+running "jinjaform apply" in a stack with a stand-in for Terraform.
+Failed checks must stop the command before the workspace is created.
+
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers.checks import check, finish  # noqa: E402
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+files = {
+    '.gitignore': '.jinjaform/\n',
+    '.jinjaformrc': 'GIT_CHECK_BRANCH master\nGIT_CHECK_CLEAN\nGIT_CHECK_REMOTE\nWORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'stack/main.tf': 'output "name" {\n  value = "{{ \'stack\' }}"\n}\n',
+}
+
+
+def git(cwd, *args):
+    return subprocess.check_output(('git',) + args, cwd=cwd, env=env, stderr=subprocess.STDOUT).decode('utf-8')
+
+
+def commit(cwd, name):
+    with open(os.path.join(cwd, name), 'w') as open_file:
+        open_file.write(name + '\n')
+    git(cwd, 'add', name)
+    git(cwd, 'commit', '--quiet', '-m', name)
+
+
+def apply(description, clone, expected_output, expected_code=1):
+    """
+    Runs "jinjaform apply" in the stack and checks that it fails with the
+    expected output, without rendering the stack, or that it succeeds.
+
+    """
+
+    stack = os.path.join(clone, 'stack')
+    shutil.rmtree(os.path.join(stack, '.jinjaform'), ignore_errors=True)
+    process = subprocess.run(
+        [sys.executable, '-m', 'jinjaform', 'apply'],
+        cwd=stack,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    output = process.stdout.decode('utf-8')
+    check(description, (process.returncode, expected_output in output), (expected_code, True))
+    if expected_code:
+        check(description + ' before rendering', os.path.exists(os.path.join(stack, '.jinjaform', 'main.tf')), False)
+
+
+temp_dir = tempfile.mkdtemp(prefix='jinjaform-git-')
+try:
+
+    # A stand-in for Terraform, and git settings that do not
+    # depend on the user's configuration.
+    bin_dir = os.path.join(temp_dir, 'bin')
+    os.makedirs(bin_dir)
+    terraform_path = os.path.join(bin_dir, 'terraform')
+    with open(terraform_path, 'w') as open_file:
+        open_file.write('#!/bin/sh\necho "terraform $@"\n')
+    os.chmod(terraform_path, 0o755)
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_EMAIL='test@example.com',
+        GIT_AUTHOR_NAME='test',
+        GIT_COMMITTER_EMAIL='test@example.com',
+        GIT_COMMITTER_NAME='test',
+        GIT_CONFIG_GLOBAL=os.devnull,
+        GIT_CONFIG_NOSYSTEM='1',
+        PATH=bin_dir + os.pathsep + os.environ['PATH'],
+        PYTHONPATH=os.path.abspath(root),
+    )
+    env.pop('GIT_CHECK', None)
+
+    remote = os.path.join(temp_dir, 'remote.git')
+    clone = os.path.join(temp_dir, 'clone')
+    other = os.path.join(temp_dir, 'other')
+    git(temp_dir, 'init', '--quiet', '--bare', '--initial-branch=master', remote)
+    git(temp_dir, 'clone', '--quiet', remote, clone)
+    git(clone, 'checkout', '--quiet', '-b', 'master')
+    for name, content in files.items():
+        path = os.path.join(clone, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as open_file:
+            open_file.write(content)
+    git(clone, 'add', '.')
+    git(clone, 'commit', '--quiet', '-m', 'project')
+    git(clone, 'push', '--quiet', '-u', 'origin', 'master')
+    git(temp_dir, 'clone', '--quiet', remote, other)
+
+    apply('apply runs when the checks pass', clone, 'terraform apply', expected_code=0)
+
+    with open(os.path.join(clone, 'stack', 'new.tf'), 'w') as open_file:
+        open_file.write('\n')
+    apply('untracked files fail the clean check', clone, 'git: ?? stack/new.tf')
+    os.remove(os.path.join(clone, 'stack', 'new.tf'))
+
+    git(clone, 'checkout', '--quiet', '-b', 'feature')
+    apply('other branches fail the branch check', clone, 'git: working in branch feature')
+
+    git(clone, 'checkout', '--quiet', '--detach', 'master')
+    apply('a detached HEAD fails the branch check', clone, 'git: working in branch HEAD')
+    git(clone, 'checkout', '--quiet', 'master')
+
+    commit(other, 'other.txt')
+    git(other, 'push', '--quiet', 'origin', 'master')
+    apply('new commits upstream fail the remote check', clone, 'git: branch is behind origin/master by 1 commits')
+
+    git(clone, 'merge', '--quiet', '--ff-only', 'origin/master')
+    commit(clone, 'clone.txt')
+    apply('unpushed commits fail the remote check', clone, 'git: branch is ahead of origin/master by 1 commits')
+
+    git(clone, 'push', '--quiet', 'origin', 'master')
+    apply('apply runs again when the branch is pushed', clone, 'terraform apply', expected_code=0)
+
+finally:
+    shutil.rmtree(temp_dir)
+
+finish()
@@ -0,0 +1,48 @@
+"""
+Shared by the check.py scripts in the test directories, which print
+"ok" or "FAIL" for each check and exit with an error if any failed.
+
+"""
+
+import os
+import sys
+
+
+failed = []
+
+
+def check(description, actual, expected):
+    if actual == expected:
+        print('ok: {}'.format(description))
+    else:
+        print('FAIL: {}: expected {!r}, got {!r}'.format(description, expected, actual))
+        failed.append(description)
+
+
+def read(path):
+    with open(path) as open_file:
+        return open_file.read()
+
+
+def write_files(root, files):
+    """
+    Writes files into a directory, such as a temporary project,
+    from a dictionary of relative paths and their contents.
+
+    """
+
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as open_file:
+            open_file.write(content)
+
+
+def finish():
+    """
+    Exits with an error if any checks failed.
+
+    """
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Checks that AWS lookups made by templates at the same time are batched,
+that missing values raise LookupError without being requested again,
+that failed requests are retried by later lookups, and that paginated
+responses are combined, using moto to mock AWS. Each thread stands in
+for a template being rendered, and templates rendered by the async
+engine on one event loop are checked too.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Use fake credentials so that nothing can reach a real AWS account,
+# and a long batch window so that the threads always share batches.
+os.environ.update({
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_SESSION_TOKEN': 'testing',
+    'AWS_DEFAULT_REGION': 'eu-west-1',
+    'JINJAFORM_AWS_BATCH_WINDOW': '200',
+    'JINJAFORM_AWS_CREDENTIALS_CACHE': '0',
+})
+os.environ.pop('AWS_PROFILE', None)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import botocore.client  # noqa: E402
+
+from botocore.exceptions import EndpointConnectionError  # noqa: E402
+from botocore.stub import ANY, Stubber  # noqa: E402
+
+from moto import mock_aws  # noqa: E402
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import aws, config, lookups, render  # noqa: E402
+
+
+region = 'eu-west-1'
+
+
+def count_calls(client, operation_name):
+    """
+    Returns a list which records each request for an operation.
+
+    """
+
+    calls = []
+    client.meta.events.register(
+        'before-call.{}.{}'.format(client.meta.service_model.endpoint_prefix, operation_name),
+        lambda **kwargs: calls.append(operation_name),
+    )
+    return calls
+
+
+def look_up(lookup, keys):
+    """
+    Looks up keys from separate threads at the same time, returning
+    the results, or the types of errors that were raised.
+
+    """
+
+    def get(key):
+        try:
+            return lookup(key)
+        except Exception as error:
+            return type(error)
+
+    with ThreadPoolExecutor(len(keys)) as executor:
+        return list(executor.map(get, keys))
+
+
+with mock_aws():
+
+    session = aws.get_session(region_name=region)
+
+    # SSM parameters are fetched 10 at a time.
+    ssm = aws.get_client(session, 'ssm')
+    names = ['/app/{}'.format(number) for number in range(12)]
+    for name in names:
+        ssm.put_parameter(Name=name, Value=name.upper(), Type='String')
+    calls = count_calls(ssm, 'GetParameters')
+
+    def ssm_parameter(name):
+        return lookups.ssm_parameter(name, region_name=region)
+
+    results = look_up(ssm_parameter, names + ['/app/missing'])
+    check('parameters are found', results[:-1], [name.upper() for name in names])
+    check('missing parameters raise LookupError', results[-1], LookupError)
+    check('parameters are fetched in batches of 10', len(calls), 2)
+
+    results = look_up(ssm_parameter, names[:3] + ['/app/missing'])
+    check('results are reused', results, [name.upper() for name in names[:3]] + [LookupError])
+    check('results and missing parameters are not fetched again', len(calls), 2)
+
+    # Failed requests are not kept, so the next lookup tries again.
+    ssm.put_parameter(Name='/app/flaky', Value='FLAKY', Type='String')
+    errors = [EndpointConnectionError(endpoint_url='https://ssm.{}.amazonaws.com'.format(region))]
+
+    def fail_once(**kwargs):
+        if errors:
+            raise errors.pop()
+
+    ssm.meta.events.register('before-call.ssm.GetParameters', fail_once)
+    check('failed requests raise their error', look_up(ssm_parameter, ['/app/flaky']), [EndpointConnectionError])
+    check('failed requests are tried again', look_up(ssm_parameter, ['/app/flaky']), ['FLAKY'])
+
+    # Secrets are fetched 20 at a time.
+    secretsmanager = aws.get_client(session, 'secretsmanager')
+    secret_ids = ['app/{}'.format(number) for number in range(3)]
+    for secret_id in secret_ids:
+        secretsmanager.create_secret(Name=secret_id, SecretString=secret_id.upper())
+    calls = count_calls(secretsmanager, 'BatchGetSecretValue')
+
+    def secret(secret_id):
+        return lookups.secret(secret_id, region_name=region)
+
+    results = look_up(secret, secret_ids + ['app/missing'])
+    check('secrets are found', results[:-1], [secret_id.upper() for secret_id in secret_ids])
+    check('missing secrets raise LookupError', results[-1], LookupError)
+    check('secrets are fetched in one batch', len(calls), 1)
+
+    # EC2 resources are fetched 200 at a time.
+    ec2 = aws.get_client(session, 'ec2')
+    image_id = ec2.describe_images()['Images'][0]['ImageId']
+    instances = ec2.run_instances(ImageId=image_id, MinCount=7, MaxCount=7)['Instances']
+    instance_ids = [instance['InstanceId'] for instance in instances]
+    calls = count_calls(ec2, 'DescribeInstances')
+
+    def instance(instance_id):
+        return lookups.ec2('instance', instance_id, region_name=region)['InstanceId']
+
+    results = look_up(instance, instance_ids + ['i-0123456789abcdef0'])
+    check('instances are found', results[:-1], instance_ids)
+    check('missing instances raise LookupError', results[-1], LookupError)
+    check('instances are fetched in one batch', len(calls), 1)
+
+    # Templates rendered by the async engine share batches too,
+    # although they all run in one thread.
+    names = ['/async/{}'.format(number) for number in range(4)]
+    for name in names:
+        ssm.put_parameter(Name=name, Value=name.upper(), Type='String')
+
+    # The renderer uses sessions with its own MFA prompter,
+    # so requests from every client are counted.
+    calls = []
+    make_api_call = botocore.client.BaseClient._make_api_call
+
+    def recording_make_api_call(self, operation_name, api_params):
+        calls.append(operation_name)
+        return make_api_call(self, operation_name, api_params)
+
+    botocore.client.BaseClient._make_api_call = recording_make_api_call
+    project_root = tempfile.mkdtemp(prefix='jinjaform-lookups-')
+    try:
+        with open(os.path.join(project_root, '.jinjaformrc'), 'w') as open_file:
+            open_file.write('WORKSPACE_CREATE\n')
+        stack = os.path.join(project_root, 'stack')
+        os.makedirs(stack)
+        config.load(stack, ['get'])
+        renderer = render.AsyncTemplateRenderer()
+        for number, name in enumerate(names):
+            path = os.path.join(stack, '{}.tf'.format(number))
+            with open(path, 'w') as open_file:
+                open_file.write("# {{{{ aws.ssm_parameter('{}', region_name='{}') }}}}\n".format(name, region))
+            renderer.add_template(path)
+        try:
+            success, rendered = renderer.start()
+        finally:
+            botocore.client.BaseClient._make_api_call = make_api_call
+        check('templates in the async engine render lookups', sorted(rendered.values()), ['# {}\n'.format(name.upper()) for name in names])
+        check('templates in the async engine share one request', calls, ['GetParameters'])
+    finally:
+        shutil.rmtree(project_root)
+
+# Moto does not paginate these responses, so the pages
+# are stubbed for a session in another region.
+other_region = 'us-east-1'
+session = aws.get_session(region_name=other_region)
+secretsmanager = aws.get_client(session, 'secretsmanager')
+stubber = Stubber(secretsmanager)
+arn = 'arn:aws:secretsmanager:{}:123456789012:secret:{}-AbCdEf'
+stubber.add_response(
+    'batch_get_secret_value',
+    {'SecretValues': [{'Name': 'one', 'ARN': arn.format(other_region, 'one'), 'SecretString': 'ONE'}], 'NextToken': 'page-2'},
+    {'SecretIdList': ANY},
+)
+stubber.add_response(
+    'batch_get_secret_value',
+    {'SecretValues': [{'Name': 'two', 'ARN': arn.format(other_region, 'two'), 'SecretString': 'TWO'}]},
+    {'SecretIdList': ANY, 'NextToken': 'page-2'},
+)
+with stubber:
+    results = [None, None]
+
+    def secret_from_other_region(position, secret_id):
+        results[position] = lookups.secret(secret_id, region_name=other_region)
+
+    with ThreadPoolExecutor(2) as executor:
+        list(executor.map(secret_from_other_region, (0, 1), ('one', 'two')))
+    check('paginated secrets are combined', results, ['ONE', 'TWO'])
+    stubber.assert_no_pending_responses()
+
+finish()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Checks that building a workspace again only writes the files whose
+contents or sources have changed, using the manifest of the previous
+build, and that files changed or removed outside of Jinjaform are
+written again.
+
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish, read, write_files  # noqa: E402
+from jinjaform import config, workspace  # noqa: E402
+
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'root.tf': '# root {{ var.name }}\n',
+    'stack/main.tf': 'variable "name" {\n  default = "one"\n}\n',
+    'stack/data.json': '{}\n',
+}
+
+
+def build():
+    """
+    Builds the workspace, and returns the modification times of its files.
+    Files which are written again get a new modification time.
+
+    """
+
+    time.sleep(0.05)
+    config.load(stack, ['plan'])
+    workspace.render()
+    return {
+        name: os.stat(os.path.join(config.workspace_dir, name)).st_mtime_ns
+        for name in os.listdir(config.workspace_dir)
+        if name != workspace.manifest_name
+    }
+
+
+def changed(before, after):
+    return sorted(name for name in set(before) | set(after) if before.get(name) != after.get(name))
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-manifest-')
+try:
+    write_files(project_root, files)
+    stack = os.path.join(project_root, 'stack')
+    workspace_dir = os.path.join(stack, '.jinjaform')
+
+    first = build()
+    check('every file is written by the first build', sorted(first), ['data.json', 'main.tf', 'root.tf'])
+    check('templates are rendered', read(os.path.join(workspace_dir, 'root.tf')).endswith('# root one\n\n'), True)
+
+    second = build()
+    check('unchanged files are left untouched', changed(first, second), [])
+
+    write_files(project_root, {'stack/main.tf': 'variable "name" {\n  default = "two"\n}\n'})
+    third = build()
+    check('files affected by a changed template are written', changed(second, third), ['main.tf', 'root.tf'])
+    check('changed templates are rendered', read(os.path.join(workspace_dir, 'root.tf')).endswith('# root two\n\n'), True)
+
+    write_files(stack, {'.jinjaform/data.json': 'changed\n'})
+    fourth = build()
+    check('files changed in the workspace are written', changed(third, fourth), ['data.json'])
+    check('files changed in the workspace are restored', read(os.path.join(workspace_dir, 'data.json')), '{}\n')
+
+    os.remove(os.path.join(workspace_dir, 'main.tf'))
+    fifth = build()
+    check('files removed from the workspace are written', changed(fourth, fifth), ['main.tf'])
+
+    os.remove(os.path.join(stack, 'data.json'))
+    sixth = build()
+    check('files removed from the project are removed', changed(fifth, sixth), ['data.json'])
+
+    manifest_path = os.path.join(workspace_dir, workspace.manifest_name)
+    with open(manifest_path) as open_file:
+        manifest = json.load(open_file)
+    manifest['version'] = workspace.Manifest.version - 1
+    with open(manifest_path, 'w') as open_file:
+        json.dump(manifest, open_file)
+    seventh = build()
+    check('manifests from other versions are ignored', changed(sixth, seventh), ['main.tf', 'root.tf'])
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
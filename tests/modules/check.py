@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+Checks that modules downloaded by Terraform are moved into the shared
+module store once, even when many stacks store them at the same time,
+that other stacks are given stored modules instead of downloading them,
+and that modules missing from the store are downloaded again.
+
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish, write_files  # noqa: E402
+from jinjaform import config, modules, workspace  # noqa: E402
+
+
+module_call = 'module "vpc" {{\n  source  = "example/vpc/aws"\n  version = "{}"\n}}\n\nmodule "local" {{\n  source = "./local"\n}}\n'
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'a/main.tf': module_call.format('~> 1.0'),
+    'b/main.tf': module_call.format('~> 1.0'),
+    'c/main.tf': module_call.format('~> 2.0'),
+}
+parallel_stacks = ['parallel{}'.format(index) for index in range(4)]
+for name in parallel_stacks:
+    files[name + '/main.tf'] = module_call.format('~> 3.0')
+
+
+def prepare(name, *args):
+    """
+    Creates the workspace of a stack for a Terraform command.
+
+    """
+
+    config.load(os.path.join(project_root, name), list(args))
+    workspace.create()
+    modules.before_terraform(config.args)
+
+
+def download(version, metadata):
+    """
+    Does what "terraform init" does for the module call,
+    with version control metadata that differs between downloads.
+
+    """
+
+    modules_dir = modules.get_modules_dir()
+    write_files(modules_dir, {
+        'vpc/main.tf': 'output "version" {{\n  value = "{}"\n}}\n'.format(version.split('.')[0]),
+        'vpc/.git/index': metadata,
+    })
+    manifest = {'Modules': [
+        {'Key': '', 'Source': '', 'Dir': '.'},
+        {'Key': 'vpc', 'Source': 'example/vpc/aws', 'Version': version, 'Dir': '.terraform/modules/vpc'},
+        {'Key': 'local', 'Source': './local', 'Dir': 'local'},
+    ]}
+    write_files(modules_dir, {modules.manifest_name: json.dumps(manifest)})
+    modules.store(config.args)
+
+
+def read_manifest():
+    """
+    Returns the versions of the modules in the module manifest of the
+    workspace, which is only written when modules are added to it.
+
+    """
+
+    path = os.path.join(modules.get_modules_dir(), modules.manifest_name)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as open_file:
+        return {entry['Key']: entry.get('Version') for entry in json.load(open_file)['Modules'] if entry['Key']}
+
+
+def stored_trees():
+    return sorted(os.listdir(os.path.join(modules.get_store_dir(), 'trees')))
+
+
+def module_link():
+    path = os.path.join(modules.get_modules_dir(), 'vpc')
+    return os.path.islink(path) and os.path.dirname(os.readlink(path)) == os.path.join(modules.get_store_dir(), 'trees')
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-modules-')
+try:
+    write_files(project_root, files)
+
+    prepare('a', 'init')
+    check('modules that have not been stored are not added to the manifest', read_manifest(), {})
+    download('1.2.0', 'a')
+    check('downloaded modules are moved into the store', module_link(), True)
+    check('the store has one module', len(stored_trees()), 1)
+
+    prepare('b', 'init')
+    check('stored modules are added to the manifest of other stacks', read_manifest(), {'vpc': '1.2.0'})
+    check('stored modules are linked into other stacks', module_link(), True)
+
+    prepare('c', 'init')
+    check('stored modules are only used if their version matches', read_manifest(), {})
+    download('2.0.0', 'c')
+    check('another version is stored separately', len(stored_trees()), 2)
+
+    prepare('a', 'init', '-upgrade')
+    check('modules are unlinked before upgrading them', os.path.lexists(os.path.join(modules.get_modules_dir(), 'vpc')), False)
+    download('1.3.0', 'upgraded')
+    check('identical modules with different version control metadata are stored once', len(stored_trees()), 2)
+
+    for tree in stored_trees():
+        shutil.rmtree(os.path.join(modules.get_store_dir(), 'trees', tree))
+    prepare('b', 'plan')
+    check('modules missing from the store are unlinked', os.path.lexists(os.path.join(modules.get_modules_dir(), 'vpc')), False)
+    check('modules missing from the store are removed from the manifest', read_manifest(), {})
+
+    # Store the same module from many stacks at the same time.
+    pids = []
+    for index, name in enumerate(parallel_stacks):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                prepare(name, 'init')
+                download('3.0.0', str(index))
+            finally:
+                os._exit(0 if module_link() else 1)
+        pids.append(pid)
+    exit_codes = [os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids]
+    check('modules can be stored by many stacks at the same time', exit_codes, [0] * len(parallel_stacks))
+    check('modules stored at the same time are stored once', len(stored_trees()), 1)
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
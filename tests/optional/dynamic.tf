@@ -0,0 +1,2 @@
+{% set n = 'dyn' %}
+# dyn = {{ var[n] }}
@@ -0,0 +1,3 @@
+# maybe = {{ var.maybe | default('fallback') }}
+# never = {% if false %}{{ var.never }}{% endif %}
+# defined = {{ var.later is defined }}
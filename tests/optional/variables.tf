@@ -0,0 +1,7 @@
+variable "dyn" {
+  default = "dynamic"
+}
+
+variable "later" {
+  default = "{{ var.dyn }}"
+}
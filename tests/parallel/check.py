@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Checks that when a step in a PARALLEL group fails, the other steps are
+stopped before Jinjaform exits, and that all output from the steps is
+prefixed with their labels.
+
+"""
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from contextlib import redirect_stderr, redirect_stdout
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, root)
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import parallel  # noqa: E402
+
+
+rc = '''PARALLEL
+RUN sleep 10; echo slow
+RUN echo failing; exit 3
+WORKSPACE_CREATE
+END
+RUN echo after
+TERRAFORM_RUN
+'''
+
+# Run a step that stops between its stages alongside one that fails.
+
+stages = []
+
+
+def failing():
+    print('failing')
+    raise ValueError('broken')
+
+
+def slow():
+    time.sleep(0.5)
+    stages.append('first')
+    parallel.check_cancelled()
+    stages.append('second')
+
+
+output = io.StringIO()
+try:
+    with redirect_stdout(output), redirect_stderr(output):
+        parallel.run([('failing', failing), ('slow', slow)])
+except SystemExit as error:
+    exit_code = error.code
+check('a failed step exits with its code', exit_code, 1)
+check('other steps stop at their next stage before exiting', stages, ['first'])
+check(
+    'output from print() in steps is prefixed',
+    '[failing] failing\n' in output.getvalue(),
+    True,
+)
+check(
+    'tracebacks from steps are prefixed',
+    '[failing] ValueError: broken\n' in output.getvalue(),
+    True,
+)
+
+# Output from threads after the group has finished is not prefixed.
+
+output = io.StringIO()
+with redirect_stdout(output):
+    parallel.run([('hello', lambda: print('hello'))])
+    thread = threading.Thread(target=print, args=('goodbye',))
+    thread.start()
+    thread.join()
+check('output is only prefixed while steps run', output.getvalue().splitlines(), ['[hello] hello', 'goodbye'])
+
+# Run a .jinjaformrc file with a failing step in a PARALLEL group.
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-parallel-')
+try:
+    with open(os.path.join(project_root, '.jinjaformrc'), 'w') as open_file:
+        open_file.write(rc)
+    stack = os.path.join(project_root, 'stack')
+    os.makedirs(stack)
+    with open(os.path.join(stack, 'main.tf'), 'w') as open_file:
+        open_file.write('# {{ undefined_function() }}\n')
+
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(root))
+    start_time = time.time()
+    process = subprocess.run(
+        [sys.executable, '-m', 'jinjaform', 'plan'],
+        cwd=stack,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    duration = time.time() - start_time
+    lines = process.stdout.splitlines()
+
+    check('the group exits with the failed step\'s code', process.returncode in (1, 3), True)
+    check('running commands are stopped', '[sleep 10; echo slow] slow' in lines, False)
+    check('Jinjaform exits before the commands would finish', duration < 10, True)
+    check('steps after the group do not run', 'after' in process.stdout, False)
+    check('command output is prefixed', '[echo failing; exit 3] failing' in lines, True)
+    check(
+        'lines from steps are not mixed up',
+        [line for line in lines if line.count('[jinjaform]') > 1],
+        [],
+    )
+    check(
+        'errors from workspace creation are prefixed',
+        [line for line in lines if 'undefined_function' in line and not line.startswith('[workspace_create] ')],
+        [],
+    )
+    check(
+        'workspace creation reported its error',
+        any(line.startswith('[workspace_create] ') and 'undefined_function' in line for line in lines),
+        True,
+    )
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
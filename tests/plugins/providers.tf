@@ -0,0 +1,7 @@
+provider "null" {
+  version = "~> {{ 1 + 1 }}.0"
+}
+
+provider "random" {
+  version = ">= 2.1, != 2.2.0"
+}
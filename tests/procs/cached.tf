@@ -0,0 +1 @@
+# cached should output 0 1 2 0 1 2: {{ cached(example_func, 3) | join(' ') }} {{ cached(example_func, 3) | join(' ') }}
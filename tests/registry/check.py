@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Checks that custom extensions are found by reading their __all__ lists
+without importing them, that they are only imported when a template uses
+them, that the names found are cached until the modules change, and
+that modules with other __all__ lists are imported to find their names.
+
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from jinja2 import Environment  # noqa: E402
+
+from helpers.checks import check, finish, read, write_files  # noqa: E402
+from jinjaform import extensions  # noqa: E402
+
+
+files = {
+    '.jinja/filters/shout.py': "__all__ = ['shout']\n\n\ndef shout(value):\n    return value.upper()\n",
+    '.jinja/filters/wrapping/__init__.py': "__all__ = ['wrap']\n__all__ += ['unwrap']\n\n\ndef wrap(value):\n    return '(' + value + ')'\n\n\ndef unwrap(value):\n    return value.strip('()')\n",
+    '.jinja/filters/helpers.py': 'def helper():\n    pass\n',
+    '.jinja/tests/even.py': "__all__ = ['even']\n\n\ndef even(value):\n    return value % 2 == 0\n",
+    '.jinja/context/values.py': "__all__ = [name for name in ['region']]\n\nregion = 'eu-west-1'\n",
+}
+
+
+def imported(registry):
+    """
+    Returns the extension modules of a registry that have been imported.
+
+    """
+
+    prefix = registry.package + '.'
+    return sorted(name[len(prefix):] for name in sys.modules if name.startswith(prefix))
+
+
+def render(registry, source):
+    env = Environment()
+    registry.install(env)
+    return env.from_string(source).render(registry.get_context(['region']))
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-registry-')
+try:
+    write_files(project_root, files)
+    cache_path = os.path.join(project_root, '.jinjaform', 'cache', 'extensions.json')
+
+    registry = extensions.Registry(project_root)
+    check('modules are imported in a private package', registry.package.startswith(extensions.package_prefix), True)
+    check('projects have their own package', extensions.Registry(tempfile.gettempdir()).package == registry.package, False)
+    check(
+        'names are read from __all__ lists',
+        registry.names,
+        {
+            'context': {'region': 'values'},
+            'filters': {'shout': 'shout', 'unwrap': 'wrapping', 'wrap': 'wrapping'},
+            'tests': {'even': 'even'},
+        },
+    )
+    check('modules with other __all__ lists are imported to find their names', imported(registry), ['context', 'context.values'])
+    check('every module is hashed', sorted(registry.files), sorted(os.path.relpath(name, '.jinja') for name in files))
+
+    env = Environment()
+    registry.install(env)
+    check('custom filters are found without importing them', ('shout' in env.filters, 'even' in env.tests), (True, True))
+    check('built-in filters are still found', 'upper' in env.filters, True)
+    check('finding custom filters does not import them', imported(registry), ['context', 'context.values'])
+
+    check('custom filters are imported when used', render(registry, '{{ "a" | shout }}'), 'A')
+    check('only the modules used are imported', imported(registry), ['context', 'context.values', 'filters', 'filters.shout'])
+    check('packages are imported when used', render(registry, '{{ "a" | wrap }} {{ "(b)" | unwrap }}'), '(a) b')
+    check('custom tests are imported when used', render(registry, '{{ 2 is even }}'), 'True')
+    check('custom context values are used', render(registry, '{{ region }}'), 'eu-west-1')
+    check('modules without names are not imported', 'filters.helpers' in imported(registry), False)
+
+    check('names are cached', sorted(json.loads(read(cache_path))['files']), sorted(registry.files))
+
+    # A module which changes without changing its size or modification
+    # time is not read again, so the cache is what provides its names.
+    path = os.path.join(project_root, '.jinja', 'filters', 'shout.py')
+    stat = os.stat(path)
+    write_files(project_root, {'.jinja/filters/shout.py': files['.jinja/filters/shout.py'].replace('shout', 'SHOUT')})
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    check('cached names are used for unchanged modules', extensions.Registry(project_root).names['filters'].get('shout'), 'shout')
+
+    write_files(project_root, {'.jinja/filters/shout.py': "__all__ = ['shout', 'whisper']\n"})
+    check('modules are read again when they change', sorted(extensions.Registry(project_root).names['filters']), ['shout', 'unwrap', 'whisper', 'wrap'])
+
+    write_files(project_root, {os.path.relpath(cache_path, project_root): 'damaged'})
+    check('damaged caches are ignored', sorted(extensions.Registry(project_root).names['filters']), ['shout', 'unwrap', 'whisper', 'wrap'])
+    check('damaged caches are replaced', 'files' in json.loads(read(cache_path)), True)
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
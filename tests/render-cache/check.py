@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Checks that rendered templates are reused by stacks and later builds
+when the variables and environment variables that they used have the
+same values, and that templates using context functions are always
+rendered.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish, read, write_files  # noqa: E402
+from jinjaform import config, render, workspace  # noqa: E402
+
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'common.tf': '# {{ var.region }} {{ JINJAFORM_TEST_ENVIRONMENT | default("none") }}\n',
+    'volatile.tf': '# {{ cached(range, 1) | list }}\n',
+    'a/main.tf': 'variable "region" {\n  default = "eu-west-1"\n}\n',
+    'b/main.tf': 'variable "region" {\n  default = "eu-west-1"\n}\n',
+    'c/main.tf': 'variable "region" {\n  default = "us-east-1"\n}\n',
+}
+
+rendered = []
+original_render_template = render.MultiTemplateRenderer._render_template
+
+
+def count_render_template(self, info, *args, **kwargs):
+    rendered.append(os.path.basename(info.source))
+    return original_render_template(self, info, *args, **kwargs)
+
+
+render.MultiTemplateRenderer._render_template = count_render_template
+
+
+def build(name):
+    """
+    Builds the workspace of a stack, and returns the names
+    of the templates that were rendered rather than reused.
+
+    """
+
+    del rendered[:]
+    config.load(os.path.join(project_root, name), ['plan'])
+    workspace.render()
+    return sorted(rendered)
+
+
+def cache_files():
+    return sorted(os.listdir(os.path.join(project_root, '.jinjaform', 'cache', 'render')))
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-render-cache-')
+try:
+    write_files(project_root, files)
+
+    check('every template is rendered by the first stack', build('a'), ['common.tf', 'main.tf', 'volatile.tf'])
+    check('templates are reused by stacks with the same variable values', build('b'), ['volatile.tf'])
+    check('reused templates are written', read(os.path.join(project_root, 'b', '.jinjaform', 'common.tf')).endswith('# eu-west-1 none\n\n'), True)
+    check('templates are rendered for stacks with other variable values', build('c'), ['common.tf', 'main.tf', 'volatile.tf'])
+    check('templates are rendered with the other values', read(os.path.join(project_root, 'c', '.jinjaform', 'common.tf')).endswith('# us-east-1 none\n\n'), True)
+    check('results for each set of values are kept', build('a'), ['volatile.tf'])
+
+    os.environ['JINJAFORM_TEST_ENVIRONMENT'] = 'test'
+    try:
+        check('templates are rendered when their environment variables change', build('a'), ['common.tf', 'volatile.tf'])
+        check('templates are rendered with the changed environment', read(os.path.join(project_root, 'a', '.jinjaform', 'common.tf')).endswith('# eu-west-1 test\n\n'), True)
+    finally:
+        del os.environ['JINJAFORM_TEST_ENVIRONMENT']
+
+    write_files(project_root, {'a/main.tf': 'variable "region" {\n  default = "eu-west-2"\n}\n'})
+    check('templates are rendered when their variables change', build('a'), ['common.tf', 'main.tf', 'volatile.tf'])
+
+    write_files(project_root, {'common.tf': '# changed {{ var.region }}\n'})
+    check('changed templates are rendered', build('b'), ['common.tf', 'volatile.tf'])
+
+    for name in cache_files():
+        write_files(project_root, {os.path.join('.jinjaform', 'cache', 'render', name): 'damaged'})
+    check('damaged cache files are ignored', build('b'), ['common.tf', 'main.tf', 'volatile.tf'])
+    check('templates from damaged cache files are rendered', read(os.path.join(project_root, 'b', '.jinjaform', 'common.tf')).endswith('# changed eu-west-1\n\n'), True)
+
+    os.environ['JINJAFORM_RENDER_CACHE_SIZE'] = '0'
+    try:
+        build('c')
+    finally:
+        del os.environ['JINJAFORM_RENDER_CACHE_SIZE']
+    check('the cache is evicted when it grows beyond its size', cache_files(), [])
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
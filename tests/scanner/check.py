@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""
+Checks that the scanner finds the same blocks and values as pyhcl, returns
+each block as soon as it is complete when fed in chunks, and that variables
+are published to other templates before the template defining them has
+finished rendering.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+import hcl  # noqa: E402
+
+from helpers.checks import check, finish, write_files  # noqa: E402
+from jinjaform import config, render, scanner  # noqa: E402
+
+
+text = '''# A comment with a { brace
+variable "name" {
+  default = "value with } brace and \\"quotes\\""
+}
+
+variable "map" {
+  default {
+    one = 1
+    two = "2"
+  }
+}
+
+variable "list" {
+  type    = "list"
+  default = ["a", "b"] // another } comment
+}
+
+/* a block comment
+variable "commented" {}
+*/
+
+provider "aws" {
+  region  = "eu-west-1"
+  profile = "${var.name}"
+}
+
+resource "aws_s3_bucket" "bucket" {
+  bucket = <<EOF
+}
+EOF
+}
+
+terraform {
+  backend "s3" {
+    bucket = "state"
+  }
+}
+'''
+
+types = {'provider', 'terraform', 'variable'}
+
+
+def describe(items):
+    return [(item.type, item.labels, item.text is not None) for item in items]
+
+
+check(
+    'blocks are found with their labels, and only wanted types are kept',
+    describe(scanner.scan(text, types=types)),
+    [
+        ('variable', ['name'], True),
+        ('variable', ['map'], True),
+        ('variable', ['list'], True),
+        ('provider', ['aws'], True),
+        ('resource', ['aws_s3_bucket', 'bucket'], False),
+        ('terraform', [], True),
+    ],
+)
+
+blocks = scanner.scan(text)
+parsed = hcl.loads(text)
+check(
+    'variable blocks have the same values as pyhcl',
+    {block.labels[0]: block.to_dict() for block in blocks if block.type == 'variable'},
+    parsed['variable'],
+)
+check(
+    'heredocs are read like pyhcl',
+    [block.to_dict() for block in blocks if block.type == 'resource'],
+    [parsed['resource']['aws_s3_bucket']['bucket']],
+)
+provider = [block for block in blocks if block.type == 'provider'][0]
+check('literal values are parsed', provider.attributes()['region'], 'eu-west-1')
+check('interpolated strings are strings', provider.attributes()['profile'], '${var.name}')
+expression = scanner.scan('provider "aws" {\n  profile = var.name\n}\n')[0].attributes()['profile']
+check('other values are expressions', (type(expression), expression), (scanner.Expression, 'var.name'))
+terraform = [block for block in blocks if block.type == 'terraform'][0]
+check('nested blocks are found', [(block.type, block.labels) for block in terraform.blocks('backend')], [('backend', ['s3'])])
+
+# Feeding one character at a time finds the same items.
+feeder = scanner.Scanner()
+items = []
+for char in text:
+    items.extend(feeder.feed(char))
+items.extend(feeder.close())
+check('chunks are scanned like the whole text', describe(items), describe(blocks))
+check('chunks have the same positions', [(item.start, item.end) for item in items], [(item.start, item.end) for item in blocks])
+
+# Blocks are returned by the chunk that completes them.
+feeder = scanner.Scanner()
+completed = []
+for line_number, line in enumerate(text.splitlines(keepends=True), 1):
+    completed.extend((item.type, line_number) for item in feeder.feed(line))
+check(
+    'blocks are returned as soon as they are complete',
+    completed,
+    [('variable', 4), ('variable', 11), ('variable', 16), ('provider', 25), ('resource', 31), ('terraform', 37)],
+)
+
+try:
+    scanner.scan('variable "name" {\n  default = "value"\n')
+except scanner.ScanError as error:
+    message = str(error)
+else:
+    message = None
+check('incomplete blocks are errors', message, 'unexpected end of input on line 3')
+
+# A template that waits for another template, after defining a variable
+# which that template uses, only finishes if the variable is published
+# before the rest of the template is rendered.
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nTERRAFORM_RUN\n',
+    'stack/first.tf': 'variable "name" {\n  default = "first"\n}\n# {{ wait_for_second() }}\n',
+    'stack/second.tf': '# {{ var.name }}{{ second_done() }}\n',
+}
+second_rendered = threading.Event()
+
+
+def wait_for_second():
+    return 'after second' if second_rendered.wait(timeout=10) else 'before second'
+
+
+def second_done():
+    second_rendered.set()
+    return ''
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-scanner-')
+try:
+    write_files(project_root, files)
+    stack = os.path.join(project_root, 'stack')
+    config.load(stack, ['plan'])
+    renderer = render.MultiTemplateRenderer()
+    renderer._jinja_context.update(wait_for_second=wait_for_second, second_done=second_done)
+    for name in ('first.tf', 'second.tf'):
+        renderer.add_template(os.path.join(stack, name))
+    os.environ['JINJAFORM_RENDER_THREADS'] = '2'
+    try:
+        success, rendered = renderer.start()
+    finally:
+        del os.environ['JINJAFORM_RENDER_THREADS']
+    check('templates using published variables are rendered', success, True)
+    check('variables are published before the rest of the template renders', rendered[os.path.join(stack, 'first.tf')].splitlines()[-1], '# after second')
+    check('published variables have their values', rendered[os.path.join(stack, 'second.tf')], '# first\n')
+
+finally:
+    shutil.rmtree(project_root)
+
+finish()
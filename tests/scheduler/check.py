@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Checks that every render engine renders templates in dependency order,
+including long chains of variables and dynamic references, and that
+deadlocks and undefined variables are reported rather than hanging.
+
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish, write_files  # noqa: E402
+from jinjaform import config, render  # noqa: E402
+
+
+chain_length = 30
+
+# Each template uses a variable defined by the next one, so rendering
+# them in name order would wait for every variable.
+chain = {
+    't{:02}.tf'.format(index): 'variable "v{}" {{\n  default = "{{{{ var.v{} }}}}"\n}}\n'.format(index, index + 1)
+    for index in range(chain_length - 1)
+}
+chain['t{:02}.tf'.format(chain_length - 1)] = 'variable "v{}" {{\n  default = "end"\n}}\n'.format(chain_length - 1)
+
+dynamic = {
+    'dynamic.tf': '{% set name = "dyn" %}# {{ var[name] }}\n',
+    'dyn.tf': 'variable "dyn" {\n  default = "{{ var.base }}"\n}\n',
+    'base.tf': 'variable "base" {\n  default = "base"\n}\n',
+}
+
+deadlock = {
+    'a.tf': 'variable "a" {\n  default = "{{ var.b }}"\n}\n',
+    'b.tf': 'variable "b" {\n  default = "{{ var.a }}"\n}\n',
+}
+
+undefined = {
+    'undefined.tf': '# {{ var.missing }}\n',
+}
+
+engines = {
+    'pool': (render.MultiTemplateRenderer, {}),
+    'processes': (render.MultiTemplateRenderer, {'JINJAFORM_RENDER_PROCS': '2'}),
+    'async': (render.AsyncTemplateRenderer, {}),
+}
+
+rendered_sources = []
+original_render_template = render.MultiTemplateRenderer._render_template
+
+
+def count_render_template(self, info, *args, **kwargs):
+    rendered_sources.append(info.source)
+    return original_render_template(self, info, *args, **kwargs)
+
+
+render.MultiTemplateRenderer._render_template = count_render_template
+
+started_threads = []
+original_thread_start = threading.Thread.start
+
+
+def count_thread_start(self):
+    started_threads.append(self)
+    return original_thread_start(self)
+
+
+threading.Thread.start = count_thread_start
+
+
+def run(engine, name, templates):
+    """
+    Renders templates in a new stack, in a separate project for each
+    engine so that they do not share cached results. Returns whether it
+    succeeded, the rendered templates by name, and the errors with paths
+    relative to the stack.
+
+    """
+
+    renderer_class, env = engines[engine]
+    stack = os.path.join(project_root, engine, name)
+    write_files(stack, templates)
+    write_files(project_root, {os.path.join(engine, '.jinjaformrc'): 'WORKSPACE_CREATE\nTERRAFORM_RUN\n'})
+    config.load(stack, ['plan'])
+    os.environ.update(env)
+    try:
+        renderer = renderer_class()
+        for template_name in sorted(templates):
+            renderer.add_template(os.path.join(stack, template_name))
+        success, rendered = renderer.start()
+    finally:
+        for key in env:
+            del os.environ[key]
+    rendered = {os.path.relpath(source, stack): text for source, text in rendered.items()}
+    errors = sorted(error.replace(stack + os.sep, '') for error in renderer._errors)
+    return success, rendered, errors
+
+
+project_root = tempfile.mkdtemp(prefix='jinjaform-scheduler-')
+try:
+    for engine in engines:
+
+        del rendered_sources[:]
+        del started_threads[:]
+        success, rendered, errors = run(engine, 'chain', chain)
+        check('{}: chains of variables are rendered'.format(engine), (success, errors), (True, []))
+        check('{}: chains of variables are resolved'.format(engine), rendered['t00.tf'], 'variable "v0" {\n  default = "end"\n}\n')
+        if engine == 'pool':
+            check('pool: templates in a chain are only rendered once', len(rendered_sources), chain_length)
+        if engine == 'async':
+            check('async: templates are rendered without threads', started_threads, [])
+
+        success, rendered, errors = run(engine, 'dynamic', dynamic)
+        check('{}: dynamic references are rendered'.format(engine), (success, errors), (True, []))
+        check('{}: dynamic references are resolved'.format(engine), rendered['dynamic.tf'], '# base\n')
+
+        success, rendered, errors = run(engine, 'deadlock', deadlock)
+        check(
+            '{}: deadlocks are reported'.format(engine),
+            (success, errors),
+            (False, ["'var.a' cannot be resolved in b.tf", "'var.b' cannot be resolved in a.tf"]),
+        )
+
+        success, rendered, errors = run(engine, 'undefined', undefined)
+        check(
+            '{}: undefined variables are reported'.format(engine),
+            (success, errors),
+            (False, ["'var.missing' cannot be resolved in undefined.tf (not defined)"]),
+        )
+
+finally:
+    threading.Thread.start = original_thread_start
+    shutil.rmtree(project_root)
+
+finish()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Checks that AWS sessions are created once for each set of arguments, with
+different ones created at the same time, and that clients are shared by
+every thread, with each session creating one client at a time because
+sessions are not thread safe. Sessions and clients are replaced by
+slow stand-ins, so that threads asking for them overlap.
+
+"""
+
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from helpers.checks import check, finish  # noqa: E402
+from jinjaform import aws  # noqa: E402
+
+
+class Activity(object):
+    """
+    Records calls and how many were running at the same time.
+
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.peak = 0
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def run(self, call):
+        with self._lock:
+            self.calls.append(call)
+            self._running += 1
+            self.peak = max(self.peak, self._running)
+        time.sleep(0.2)
+        with self._lock:
+            self._running -= 1
+
+
+class Session(object):
+
+    def __init__(self, profile_name):
+        self.profile_name = profile_name
+
+    def client(self, service_name, region_name=None, config=None):
+        client_activity.run((self.profile_name, service_name, region_name))
+        return {
+            'service_name': service_name,
+            'region_name': region_name,
+            'max_pool_connections': config.max_pool_connections,
+        }
+
+
+def create_session(profile_name):
+    session_activity.run(profile_name)
+    return Session(profile_name)
+
+
+def run_threads(func, args):
+    with ThreadPoolExecutor(len(args)) as executor:
+        return list(executor.map(func, args))
+
+
+aws._create_session = create_session
+
+session_activity = Activity()
+profiles = ['a', 'b', 'c', 'a', 'b', 'c', 'a']
+sessions = run_threads(lambda profile_name: aws.get_session(profile_name=profile_name), profiles)
+check('each session is created once', sorted(session_activity.calls), ['a', 'b', 'c'])
+check('threads get sessions for their profiles', [session.profile_name for session in sessions], profiles)
+check('threads with the same profile share a session', len(set(map(id, sessions))), 3)
+check('different sessions are created at the same time', session_activity.peak, 3)
+
+client_activity = Activity()
+session_a, session_b = aws.get_session(profile_name='a'), aws.get_session(profile_name='b')
+requests = [
+    (session_a, 's3', None),
+    (session_a, 's3', None),
+    (session_a, 'ssm', None),
+    (session_a, 'ssm', 'us-east-1'),
+    (session_b, 's3', None),
+    (session_b, 's3', None),
+]
+clients = run_threads(lambda request: aws.get_client(*request), requests)
+check(
+    'each client is created once',
+    sorted(client_activity.calls, key=str),
+    sorted([('a', 's3', None), ('a', 'ssm', None), ('a', 'ssm', 'us-east-1'), ('b', 's3', None)], key=str),
+)
+check('threads share clients', clients[0] is clients[1] and clients[4] is clients[5], True)
+check('clients for different sessions are created at the same time', client_activity.peak, 2)
+check('clients have enough connections for every thread', clients[0]['max_pool_connections'], aws._get_max_pool_connections())
+check('clients have at least the default number of connections', aws._get_max_pool_connections() >= 10, True)
+
+finish()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Checks that commands which bypass Jinjaform start quickly, by running
+"jinjaform fmt" with a fake terraform binary and checking which modules
+were imported and how long importing Jinjaform took.
+
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+# Modules which take a long time to import and are not needed
+# unless a workspace is created.
+slow_modules = ('boto3', 'botocore', 'boto_source_profile_mfa', 'hcl', 'jinja2')
+
+# The maximum time in milliseconds for importing Jinjaform,
+# which is generous to avoid failing on slow machines.
+max_import_time = 100
+
+
+def main():
+
+    bin_dir = tempfile.mkdtemp(prefix='jinjaform-startup-')
+    try:
+        terraform_path = os.path.join(bin_dir, 'terraform')
+        with open(terraform_path, 'w') as open_file:
+            open_file.write('#!/bin/sh\necho "terraform $@"\n')
+        os.chmod(terraform_path, 0o755)
+
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ['PATH'])
+        env.pop('JINJAFORM_TRACE', None)
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-m', 'jinjaform', 'fmt'],
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    finally:
+        shutil.rmtree(bin_dir)
+
+    top_level = {}
+    modules = set()
+    errors = []
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:'):
+            self_time, cumulative, name = line[len('import time:'):].split('|')
+            modules.add(name.strip())
+            # Only count modules imported directly by the main module,
+            # because their times include the modules they import.
+            if cumulative.strip().isdigit() and not name.startswith('  '):
+                top_level[name.strip()] = int(cumulative)
+        else:
+            errors.append(line)
+
+    if process.returncode or 'terraform fmt' not in process.stdout.splitlines():
+        sys.exit('jinjaform fmt failed:\n{}{}'.format(process.stdout, '\n'.join(errors)))
+
+    failed = False
+
+    for name in slow_modules:
+        if name in modules:
+            print('{} was imported'.format(name))
+            failed = True
+
+    import_time = sum(time for name, time in top_level.items() if name.startswith('jinjaform')) / 1000
+    print('jinjaform imported in {:.1f}ms'.format(import_time))
+    if import_time > max_import_time:
+        print('importing jinjaform should take less than {}ms'.format(max_import_time))
+        failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Checks that JINJAFORM_TRACE writes a timeline covering each phase of a run,
+including templates waiting for variables and stacks run in forked
+processes, and shows a summary at the end.
+
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from helpers.checks import check, finish, write_files  # noqa: E402
+
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+files = {
+    '.jinjaformrc': 'WORKSPACE_CREATE\nRUN true\nTERRAFORM_RUN\n',
+    'one/first.tf': '# {{ var.name }}\n',
+    'one/second.tf': 'variable "name" {\n  default = "value"\n}\n',
+    'two/main.tf': '',
+}
+
+
+def run(cwd, *args):
+    """
+    Runs Jinjaform with tracing enabled, and returns its output
+    and the events in the trace.
+
+    """
+
+    trace_path = os.path.join(temp_dir, 'trace.json')
+    process = subprocess.run(
+        [sys.executable, '-m', 'jinjaform'] + list(args),
+        cwd=cwd,
+        env=dict(env, JINJAFORM_TRACE=trace_path),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    if process.returncode != 0:
+        print(process.stdout)
+    with open(trace_path) as open_file:
+        events = json.load(open_file)['traceEvents']
+    os.remove(trace_path)
+    return process.stdout, events
+
+
+def names(events):
+    return {event['name'] for event in events}
+
+
+temp_dir = tempfile.mkdtemp(prefix='jinjaform-trace-')
+try:
+    project_root = os.path.join(temp_dir, 'project')
+    write_files(project_root, files)
+
+    bin_dir = os.path.join(temp_dir, 'bin')
+    write_files(bin_dir, {'terraform': '#!/bin/sh\necho "terraform $@"\n'})
+    os.chmod(os.path.join(bin_dir, 'terraform'), 0o755)
+    env = dict(
+        os.environ,
+        PATH=bin_dir + os.pathsep + os.environ['PATH'],
+        PYTHONPATH=os.path.abspath(root),
+    )
+
+    output, events = run(os.path.join(project_root, 'one'), 'get')
+    check(
+        'each phase of the run is recorded',
+        {'workspace', 'walk', 'templates', 'render', 'write', 'modules', 'run', 'terraform'} - names(events),
+        set(),
+    )
+    check(
+        'each template render is recorded',
+        sorted(os.path.basename(event['args']['template']) for event in events if event['name'] == 'render' and event['ph'] in ('X', 'b')),
+        ['first.tf', 'second.tf'],
+    )
+    check(
+        'templates waiting for variables are recorded',
+        [event['args']['variables'] for event in events if event['name'] == 'wait' and event['ph'] == 'b'],
+        [['name']],
+    )
+    check(
+        'the command run by terraform is recorded',
+        [event['args']['args'] for event in events if event['name'] == 'terraform'],
+        [['get']],
+    )
+    check('memory and thread counts are recorded', {'peak rss (MB)', 'threads'} - names(events), set())
+    check('a summary is shown', 'trace: written to' in output, True)
+
+    output, events = run(project_root, '-all', '-j', '2', 'get')
+    stacks = [event for event in events if event['name'] == 'stack']
+    check(
+        'each stack is recorded',
+        sorted(os.path.basename(event['args']['stack']) for event in stacks if event['ph'] == 'b'),
+        ['one', 'two'],
+    )
+    check(
+        'events from forked processes are included',
+        len({event['pid'] for event in events if event['name'] == 'terraform'}),
+        2,
+    )
+    check('files from forked processes are removed', [name for name in os.listdir(temp_dir) if name.endswith('.part')], [])
+
+finally:
+    shutil.rmtree(temp_dir)
+
+finish()